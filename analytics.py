@@ -0,0 +1,96 @@
+import time
+
+from cube import get_cube
+from data_sources import is_snapshot
+from db import apply_schema, read_sql, read_sql_many, stay_sql
+from local_engine import get_table
+from queries import merge_queries, split_result, tab_queries
+from query_metrics import query_metrics, query_section
+from settings import getenv
+
+# Where tab aggregates come from:
+#   'cube'  - roll up the in-memory aggregate cube, SQL for anything it cannot answer exactly
+#   'local' - load patients once into columnar arrays and answer every tab in process
+#   'sql'   - query MySQL for every chart, or scan the snapshot when DATA_SOURCE=parquet
+AGGREGATE_BACKEND = getenv('AGGREGATE_BACKEND', 'cube')
+
+
+# The shared in-memory store for the configured backend, built or reloaded
+# on first use and whenever the table version moves
+def _backend(engine):
+    if AGGREGATE_BACKEND == 'cube':
+        return get_cube(engine)
+    if AGGREGATE_BACKEND == 'local':
+        return get_table(engine)
+    return None
+
+
+# Answer from the in-memory backend, recorded under its name; None falls
+# back to SQL, which read_sql records itself. Every path returns the
+# spec's schema, so results look the same whichever backend answered.
+def _answer_in_memory(engine, spec):
+    backend = _backend(engine)
+    if backend is None:
+        return None
+    started = time.perf_counter()
+    df = backend.answer(spec)
+    if df is not None:
+        df = apply_schema(df, spec.schema())
+        query_metrics.record(spec.to_sql(), AGGREGATE_BACKEND, (time.perf_counter() - started) * 1000, rows=len(df))
+    return df
+
+
+# Answer from a Parquet snapshot: a filtered scan of the needed columns
+def _answer_snapshot(source, spec):
+    started = time.perf_counter()
+    df = apply_schema(source.answer(spec), spec.schema())
+    query_metrics.record(spec.to_sql(), 'parquet', (time.perf_counter() - started) * 1000, rows=len(df))
+    return df
+
+
+def run_query(engine, spec):
+    df = _answer_in_memory(engine, spec)
+    if df is None and is_snapshot(engine):
+        df = _answer_snapshot(engine, spec)
+    if df is None:
+        df = read_sql(engine, spec.to_sql(stay_sql(engine)), spec.params(), schema=spec.schema())
+    return df
+
+
+# Run a tab's queries together: whatever the in-memory backend cannot answer
+# goes to MySQL with siblings sharing filters and grouping merged into one
+# statement, and the remaining statements run in parallel. A snapshot
+# answers each of them with its own scan instead.
+def run_queries(engine, specs):
+    results = {}
+    pending = {}
+    for name, spec in specs.items():
+        with query_section(name):
+            df = _answer_in_memory(engine, spec)
+        if df is None:
+            pending[name] = spec
+        else:
+            results[name] = df
+
+    if is_snapshot(engine):
+        for name, spec in pending.items():
+            with query_section(name):
+                results[name] = _answer_snapshot(engine, spec)
+        return {name: results[name] for name in specs}
+
+    # Merged statements are labelled with all of their member names
+    batches = merge_queries(pending)
+    frames = read_sql_many(engine, {'+'.join(names): (query.to_sql(stay_sql(engine)), query.params(), query.schema()) for query, names in batches})
+    for _, names in batches:
+        for name in names:
+            frame = frames['+'.join(names)]
+            results[name] = frame if len(names) == 1 else split_result(pending[name], frame)
+
+    return {name: results[name] for name in specs}
+
+
+# Every query of an analysis tab for a filter selection, keyed by query name:
+# the numbers the dashboard charts, for use outside Streamlit
+def run_tab(engine, tab, filters=None, age_range=None):
+    with query_section(tab):
+        return run_queries(engine, tab_queries(tab, filters, age_range))
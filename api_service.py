@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from analytics import run_tab
+from data_sources import create_data_source
+from heavy_hitters import HEAVY_HITTER_COLUMNS, get_heavy_hitters
+from queries import AGE_RANGE, TAB_FILTERS, TAB_QUERIES, TREND_GRAINS, trend_query
+from query_cache import query_cache
+from query_metrics import query_metrics, query_section
+from settings import getenv
+from trends import run_trend
+
+# Headless JSON API over the dashboard's query layer, for tools that need the
+# same numbers without Streamlit. It is a small HTTP/1.1 server on asyncio
+# streams; queries run on a thread pool through the same backends, connection
+# pool and result cache as the dashboard. Responses are cached per table
+# version and carry an ETag, so clients revalidate with If-None-Match and get
+# 304 Not Modified while the data is unchanged, and identical requests that
+# arrive while one is being computed wait for that result instead of
+# querying again.
+#
+#   python api_service.py
+#   curl 'http://127.0.0.1:8502/tabs/insurance?medical_condition=Cancer'
+#
+#   GET /tabs                             tabs, their filters and queries
+#   GET /tabs/<tab>?<filter>=<value>...   every query of a tab; age_min and
+#                                         age_max add an inclusive age range
+#   GET /tabs/<tab>/<query>?...           one query of a tab
+#   GET /trends/<day|week|month>?...      admission trend (trends filters)
+#   GET /top/<doctor|hospital>?by=admissions|billing&k=10
+#   GET /health                           table version and cache statistics
+#   GET /metrics                          Prometheus text format
+
+API_HOST = getenv('API_HOST', '127.0.0.1')
+API_PORT = int(getenv('API_PORT', '8502'))
+API_WORKERS = int(getenv('API_WORKERS', '8'))
+API_CACHE_TTL = float(getenv('API_CACHE_TTL', '300'))
+API_CACHE_MAX_ENTRIES = int(getenv('API_CACHE_MAX_ENTRIES', '2048'))
+# Longest request line or header line accepted
+MAX_LINE_BYTES = 16 * 1024
+TOP_LIMIT = 100
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_value(value):
+    if value is pd.NaT or value is pd.NA or value is None:
+        return None
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    elif isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, datetime):
+        return value.date().isoformat() if value == pd.Timestamp(value).normalize() else value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+# A result DataFrame as a list of row objects with plain JSON values
+def frame_records(df):
+    columns = list(df.columns)
+    return [{column: _json_value(value) for column, value in zip(columns, row)} for row in df.itertuples(index=False, name=None)]
+
+
+def encode(payload):
+    return json.dumps(payload, separators=(',', ':'), default=_json_value).encode()
+
+
+# Equality filters and an optional age range from the query string, checked
+# against the filters the tab offers
+def _filters(allowed, params):
+    unknown = sorted(set(params) - set(allowed) - {'age_min', 'age_max'})
+    if unknown:
+        raise HTTPError(400, f"Unknown parameter(s): {', '.join(unknown)}; filters are {', '.join(allowed)}, age_min and age_max")
+    filters = {column: params[column] for column in allowed if column in params}
+    age_range = None
+    if 'age_min' in params or 'age_max' in params:
+        try:
+            age_range = (int(params.get('age_min', AGE_RANGE[0])), int(params.get('age_max', AGE_RANGE[1])))
+        except ValueError:
+            raise HTTPError(400, "age_min and age_max must be whole numbers")
+    return filters, age_range
+
+
+def _tab(tab):
+    if tab not in TAB_QUERIES:
+        raise HTTPError(404, f"Unknown tab {tab!r}; tabs are {', '.join(TAB_QUERIES)}")
+    return tab
+
+
+# Route a GET to a callable computing its payload on the worker pool
+def route(engine, parts, params):
+    if parts == ['tabs']:
+        if params:
+            raise HTTPError(400, "/tabs takes no parameters")
+        return lambda: {'tabs': {tab: {'filters': list(TAB_FILTERS[tab]), 'queries': list(queries)} for tab, queries in TAB_QUERIES.items()}}
+
+    if len(parts) in (2, 3) and parts[0] == 'tabs':
+        tab = _tab(parts[1])
+        name = parts[2] if len(parts) == 3 else None
+        if name is not None and name not in TAB_QUERIES[tab]:
+            raise HTTPError(404, f"Unknown query {name!r} for tab {tab!r}; queries are {', '.join(TAB_QUERIES[tab])}")
+        filters, age_range = _filters(TAB_FILTERS[tab], params)
+
+        def compute():
+            results = run_tab(engine, tab, filters, age_range)
+            if name is not None:
+                results = {name: results[name]}
+            return {'tab': tab, 'filters': filters, 'age_range': age_range, 'results': {key: frame_records(df) for key, df in results.items()}}
+        return compute
+
+    if len(parts) == 2 and parts[0] == 'trends':
+        grain = parts[1]
+        if grain not in TREND_GRAINS:
+            raise HTTPError(404, f"Unknown grain {grain!r}; grains are {', '.join(TREND_GRAINS)}")
+        filters, age_range = _filters(TAB_FILTERS['trends'], params)
+        if age_range is not None:
+            raise HTTPError(400, "Trends do not take an age range")
+
+        def compute():
+            with query_section('trends'):
+                trend = run_trend(engine, trend_query(grain, filters))
+            return {'grain': grain, 'filters': filters, 'results': frame_records(trend)}
+        return compute
+
+    if len(parts) == 2 and parts[0] == 'top':
+        column = parts[1]
+        if column not in HEAVY_HITTER_COLUMNS:
+            raise HTTPError(404, f"Unknown column {column!r}; columns are {', '.join(HEAVY_HITTER_COLUMNS)}")
+        unknown = sorted(set(params) - {'by', 'k'})
+        by = params.get('by', 'admissions')
+        if unknown or by not in ('admissions', 'billing'):
+            raise HTTPError(400, "/top takes by=admissions|billing and k")
+        try:
+            k = int(params.get('k', 10))
+        except ValueError:
+            raise HTTPError(400, "k must be a whole number")
+        if not 1 <= k <= TOP_LIMIT:
+            raise HTTPError(400, f"k must be between 1 and {TOP_LIMIT}")
+
+        def compute():
+            with query_section('heavy hitters'):
+                sketch = get_heavy_hitters(engine).column(column)
+            return {'column': column, 'by': by, 'exact': sketch.exact, 'distinct': sketch.distinct(), 'results': frame_records(sketch.top(column, k, by))}
+        return compute
+
+    raise HTTPError(404, "Not found")
+
+
+class AggregateService:
+    def __init__(self, engine, workers=API_WORKERS, cache_ttl=API_CACHE_TTL, max_entries=API_CACHE_MAX_ENTRIES):
+        self.engine = engine
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api')
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.requests = {}
+        self.cache_hits = 0
+        self.not_modified = 0
+        self.coalesced = 0
+        self.computed = 0
+        self.seconds = 0.0
+
+    # The table version probe is throttled by query_cache, so most calls do not query
+    async def _version(self):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, query_cache.check_version, self.engine)
+
+    # (body, etag) for a payload, computed once per key however many
+    # requests ask for it at the same time. Queries are labelled 'api/...'
+    # in query_metrics, apart from the dashboard's.
+    async def _payload(self, key, compute):
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > now:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return entry[1], entry[2]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        def labelled():
+            with query_section('api'):
+                return encode(compute())
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._inflight[key] = future
+        try:
+            body = await loop.run_in_executor(self.executor, labelled)
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters get the exception; mark it retrieved for when there are none
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._inflight[key]
+
+        etag = '"' + hashlib.sha1(body).hexdigest()[:24] + '"'
+        self.computed += 1
+        if self.cache_ttl > 0:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, body, etag)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        future.set_result((body, etag))
+        return body, etag
+
+    # (status, headers, body) for one request
+    async def respond(self, method, target, headers):
+        if method not in ('GET', 'HEAD'):
+            return 405, {'Allow': 'GET, HEAD'}, encode({'error': f"{method} is not supported"})
+        url = urlsplit(target)
+        parts = [part for part in url.path.split('/') if part]
+        params = dict(parse_qsl(url.query, keep_blank_values=False))
+
+        if parts == ['metrics']:
+            return 200, {'Content-Type': 'text/plain; version=0.0.4'}, self.prometheus_text().encode()
+        try:
+            version = await self._version()
+            if parts == ['health']:
+                return 200, {}, encode({'status': 'ok', 'version': version, 'query_cache': query_cache.stats(), 'response_cache_entries': len(self._cache)})
+            compute = route(self.engine, parts, params)
+            key = (tuple(parts), tuple(sorted(params.items())), version)
+            body, etag = await self._payload(key, compute)
+        except HTTPError as e:
+            return e.status, {}, encode({'error': str(e)})
+        except Exception as e:
+            return 500, {}, encode({'error': f"{type(e).__name__}: {e}"})
+
+        cache_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+            self.not_modified += 1
+            return 304, cache_headers, b''
+        return 200, cache_headers, body
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, protocol = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._write(writer, 400, {}, encode({'error': "Malformed request line"}), False, True)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get('content-length'):
+                    await reader.readexactly(int(headers['content-length']))
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if protocol == 'HTTP/1.0' else connection != 'close'
+                started = time.perf_counter()
+                status, response_headers, body = await self.respond(method, target, headers)
+                self.seconds += time.perf_counter() - started
+                self.requests[status] = self.requests.get(status, 0) + 1
+                await self._write(writer, status, response_headers, body, keep_alive, method != 'HEAD')
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _write(self, writer, status, headers, body, keep_alive, send_body):
+        headers = {'Content-Type': 'application/json', **headers, 'Content-Length': str(len(body)), 'Connection': 'keep-alive' if keep_alive else 'close'}
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n" + ''.join(f"{name}: {value}\r\n" for name, value in headers.items()) + "\r\n"
+        writer.write(head.encode('latin-1') + (body if send_body else b''))
+        await writer.drain()
+
+    # The dashboard's query metrics plus the service's own counters
+    def prometheus_text(self):
+        lines = [query_metrics.prometheus_text().rstrip('\n')]
+        lines.append('# HELP api_requests_total HTTP requests by response status.')
+        lines.append('# TYPE api_requests_total counter')
+        lines.extend(f'api_requests_total{{status="{status}"}} {count}' for status, count in sorted(self.requests.items()))
+        for name, help_text, value in (
+            ('api_response_cache_hits_total', 'Responses served from the response cache.', self.cache_hits),
+            ('api_not_modified_total', 'Requests answered 304 Not Modified.', self.not_modified),
+            ('api_coalesced_requests_total', 'Requests that waited for an identical in-flight request.', self.coalesced),
+            ('api_computed_total', 'Responses computed from the query layer.', self.computed),
+            ('api_request_seconds_total', 'Time spent answering requests.', f"{self.seconds:.6f}"),
+        ):
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} counter', f'{name} {value}'])
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host=API_HOST, port=API_PORT):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_LINE_BYTES)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the dashboard's aggregates as a JSON HTTP API.")
+    parser.add_argument('--host', default=API_HOST, help=f"interface to listen on (default {API_HOST})")
+    parser.add_argument('--port', type=int, default=API_PORT, help=f"port to listen on (default {API_PORT})")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_data_source()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    print(f"Serving aggregates on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(AggregateService(engine).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,168 @@
+import argparse
+import importlib.util
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+import analytics
+from data_sources import create_data_source
+from dictionaries import get_dictionaries
+from figures import CHARTS, TAB_CHARTS, chart_data
+from queries import AGE_RANGE, FILTER_OPTIONS, TAB_FILTERS, TAB_QUERIES, filter_combinations, tab_queries
+from query_cache import query_cache
+from query_metrics import query_section
+
+# Batch export of every analysis tab under every filter selection, the
+# matrix otherwise only reachable by clicking through the dashboard.
+# Segments are answered by the dashboard's own query layer: with the default
+# cube backend the whole matrix comes from the one GROUP BY scan that builds
+# the aggregate cube, and segments run on a thread pool so the SQL backend
+# overlaps its round trips. Each tab query is written as one CSV or Parquet
+# table holding every segment, with the filter selection as leading columns.
+# Charts are drawn as the dashboard draws them and rendered on a process
+# pool, one file per segment and chart.
+#
+#   python batch_export.py
+#   python batch_export.py --format parquet --charts png --workers 8
+#   python batch_export.py --tabs insurance medication --charts html
+
+IMAGE_FORMATS = ('png', 'svg', 'pdf')
+
+
+# Filter values the dashboard offers, as found in the data; the known
+# values when the dictionaries cannot be loaded
+def filter_values(source):
+    try:
+        dictionaries = get_dictionaries(source)
+    except Exception as e:
+        print(f"Warning: could not load the filter values ({e}); using the known values")
+        return {}
+    return {column: dictionaries.values(column) for column in FILTER_OPTIONS}
+
+
+# The dashboard's label for a selection: the value, or the "all" option
+def segment_labels(tab, filters):
+    return {column: filters.get(column, FILTER_OPTIONS[column][1]) for column in TAB_FILTERS[tab]}
+
+
+def segment_slug(tab, filters):
+    labels = segment_labels(tab, filters).values()
+    return '__'.join(re.sub(r'[^A-Za-z0-9]+', '_', label).strip('_') for label in labels)
+
+
+def answer_segment(source, tab, filters):
+    age_range = AGE_RANGE if tab == 'medical_conditions' else None
+    with query_section(f"export/{tab}"):
+        return filters, analytics.run_queries(source, tab_queries(tab, filters, age_range))
+
+
+# Every segment of a tab as {query name: [(filters, result), ...]}
+def answer_tab(source, tab, values, workers):
+    results = {name: [] for name in TAB_QUERIES[tab]}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export') as executor:
+        segments = executor.map(lambda filters: answer_segment(source, tab, filters), filter_combinations(tab, values))
+        for filters, answers in segments:
+            for name, df in answers.items():
+                results[name].append((filters, df))
+    return results
+
+
+# One table per query: the segment's filter labels, then its result rows
+def stack_segments(tab, segments):
+    lengths = [len(df) for _, df in segments]
+    labels = [segment_labels(tab, filters) for filters, _ in segments]
+    columns = {column: np.repeat([label[column] for label in labels], lengths) for column in TAB_FILTERS[tab]}
+    rows = pd.concat([df for _, df in segments], ignore_index=True)
+    return pd.concat([pd.DataFrame(columns), rows], axis=1)
+
+
+def write_table(df, path, file_format):
+    if file_format == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+# Render one segment's charts; runs in a worker process
+def write_charts(charts, chart_format):
+    for path, kind, df, spec in charts:
+        fig = CHARTS[kind](df, **spec)
+        if chart_format == 'html':
+            fig.write_html(path, include_plotlyjs='cdn')
+        else:
+            fig.write_image(path, format=chart_format)
+    return len(charts)
+
+
+def chart_jobs(output_dir, tab, results, chart_format):
+    jobs = {}
+    for name, (kind, spec) in TAB_CHARTS.get(tab, {}).items():
+        for filters, df in results[name]:
+            if df is None or df.empty:
+                continue
+            directory = os.path.join(output_dir, 'charts', tab, segment_slug(tab, filters))
+            path = os.path.join(directory, f"{name}.{chart_format}")
+            jobs.setdefault(directory, []).append((path, kind, chart_data(tab, name, df), spec))
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export every analysis tab under every filter combination to files.")
+    parser.add_argument('--tabs', nargs='+', choices=list(TAB_QUERIES), default=list(TAB_QUERIES), help="tabs to export (default: all of them)")
+    parser.add_argument('--output-dir', default='exports', help="directory to write to (default exports)")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help="table format (default csv)")
+    parser.add_argument('--charts', choices=IMAGE_FORMATS + ('html',), help="also write each segment's charts; images need the kaleido package")
+    parser.add_argument('--backend', choices=['cube', 'local', 'sql'], help="aggregate backend (default AGGREGATE_BACKEND)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="threads for segments and processes for charts (default: CPU count)")
+    args = parser.parse_args()
+
+    if args.charts in IMAGE_FORMATS:
+        if importlib.util.find_spec('kaleido') is None:
+            sys.exit("Chart images need the kaleido package: pip install kaleido (or use --charts html)")
+
+    load_dotenv()
+    source = create_data_source()
+    if source is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+    if args.backend:
+        analytics.AGGREGATE_BACKEND = args.backend
+    # Every segment is asked once, so caching results only costs memory
+    query_cache.disable()
+
+    started = time.perf_counter()
+    values = filter_values(source)
+    tables = 0
+    segments = 0
+    chart_futures = []
+    # Chart worker processes are only started when charts are asked for
+    with ProcessPoolExecutor(max_workers=args.workers) if args.charts else nullcontext() as charts_executor:
+        for tab in args.tabs:
+            tab_started = time.perf_counter()
+            results = answer_tab(source, tab, values, args.workers)
+            tab_segments = len(next(iter(results.values())))
+            os.makedirs(os.path.join(args.output_dir, tab), exist_ok=True)
+            for name, tab_results in results.items():
+                write_table(stack_segments(tab, tab_results), os.path.join(args.output_dir, tab, f"{name}.{args.format}"), args.format)
+                tables += 1
+            segments += tab_segments
+            print(f"{tab:20} {tab_segments:5} segments  {len(results)} tables  {time.perf_counter() - tab_started:6.2f}s")
+
+            if args.charts:
+                for directory, charts in chart_jobs(args.output_dir, tab, results, args.charts).items():
+                    os.makedirs(directory, exist_ok=True)
+                    chart_futures.append(charts_executor.submit(write_charts, charts, args.charts))
+        try:
+            charts = sum(future.result() for future in chart_futures)
+        except Exception as e:
+            sys.exit(f"Could not write the charts: {e}")
+
+    print(f"Exported {segments:,} segments to {tables} tables"
+          + (f" and {charts:,} {args.charts} charts" if args.charts else "")
+          + f" in {args.output_dir}/ in {time.perf_counter() - started:.1f}s ({analytics.AGGREGATE_BACKEND} backend)")
@@ -0,0 +1,199 @@
+import argparse
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from data_sources import group_rows
+from db import create_db_engine, read_sql, stay_sql
+from queries import AGE_RANGE, DIMENSIONS, TAB_QUERIES, filter_combinations, tab_queries
+from query_cache import INCREMENTAL_REFRESH, appended_range, query_cache
+from query_metrics import query_section
+from rollup import ROLLUP_METRICS, filter_mask, rollup
+
+# Aggregate cube over every combination of DIMENSIONS.
+# One GROUP BY scan of patients materializes SUM/COUNT/MIN/MAX per cell; the
+# tab queries are then answered by rolling cells up in memory.
+
+# (aggregate, column) per measure, as data_sources.group_rows takes them
+MEASURES = {
+    'n': ('COUNT', '*'),
+    'billing_sum': ('SUM', 'billing_amount'),
+    'billing_min': ('MIN', 'billing_amount'),
+    'billing_max': ('MAX', 'billing_amount'),
+    'stay_sum': ('SUM', '{stay}'),
+    'stay_min': ('MIN', '{stay}'),
+    'stay_max': ('MAX', '{stay}'),
+    'age_sum': ('SUM', 'age'),
+    'age_min': ('MIN', 'age'),
+    'age_max': ('MAX', 'age'),
+}
+
+# How cells for the same dimension values combine when rows are appended
+MERGE = {name: 'sum' if name == 'n' or name.endswith('_sum') else name[-3:] for name in MEASURES}
+
+
+def _cells(frame):
+    frame = frame.copy()
+    for name in MEASURES:
+        frame[name] = pd.to_numeric(frame[name]).astype(float)
+    return frame
+
+
+# Combine two sets of cells; the work is proportional to the number of cells
+def merge_cells(cells, delta):
+    combined = pd.concat([cells, _cells(delta)], ignore_index=True)
+    return combined.groupby(DIMENSIONS, dropna=False, sort=False).agg(MERGE).reset_index()
+
+
+class AggregateCube:
+    def __init__(self, frame, version=None):
+        self.version = version
+        self.cells = _cells(frame)
+        self.size = len(frame)
+        self.categories = {}
+        self.codes = {}
+        self.lookup = {}
+        self.nullable = set()
+        for dim in DIMENSIONS:
+            values = pd.Categorical(frame[dim])
+            self.categories[dim] = values.categories
+            self.codes[dim] = values.codes.astype(np.int64)
+            self.lookup[dim] = {value: code for code, value in enumerate(values.categories)}
+            if (values.codes < 0).any():
+                self.nullable.add(dim)
+        self.measures = {name: self.cells[name].to_numpy() for name in MEASURES}
+
+    @classmethod
+    def build(cls, engine, version=None):
+        with query_section('cube build'):
+            return cls(group_rows(engine, DIMENSIONS, MEASURES), version)
+
+    # New cube with the rows appended since this one's version folded in, so
+    # the refresh scans only the new rows. None when the table changed in any
+    # other way and the cube has to be rebuilt.
+    def extend(self, engine, version):
+        params = appended_range(self.version, version)
+        if params is None:
+            return None
+        with query_section('cube refresh'):
+            delta = group_rows(engine, DIMENSIONS, MEASURES, params)
+        if int(pd.to_numeric(delta['n']).sum()) != version[0] - self.version[0]:
+            return None
+        return AggregateCube(merge_cells(self.cells, delta), version)
+
+    # Cells are not split by age, so an age range is only answerable when
+    # every cell lies entirely inside or outside it
+    def _age_mask(self, age_range):
+        low, high = age_range
+        inside = (self.measures['age_min'] >= low) & (self.measures['age_max'] <= high)
+        outside = (self.measures['age_max'] < low) | (self.measures['age_min'] > high)
+        if not np.all(inside | outside):
+            return None
+        return inside
+
+    # Roll the cube up for an AggregateQuery; None when it cannot be answered exactly
+    def answer(self, spec):
+        columns = set(spec.group_by) | {column for column, _ in spec.filters}
+        if not columns <= set(DIMENSIONS) or columns & self.nullable:
+            return None
+        if any(metric not in ROLLUP_METRICS for _, metric in spec.metrics):
+            return None
+
+        mask = filter_mask(spec, self.codes, self.lookup, self.size)
+        if spec.age_range is not None:
+            age_mask = self._age_mask(spec.age_range)
+            if age_mask is None:
+                return None
+            mask &= age_mask
+        return rollup(spec, self.codes, self.categories, self.measures, mask)
+
+
+# Shared cube for every session in the process, rebuilt when the table version moves
+_cube = None
+_cube_lock = threading.Lock()
+
+
+def get_cube(engine):
+    global _cube
+    version = query_cache.check_version(engine)
+    with _cube_lock:
+        if _cube is not None and _cube.version != version and INCREMENTAL_REFRESH:
+            _cube = _cube.extend(engine, version)
+        if _cube is None or _cube.version != version:
+            _cube = AggregateCube.build(engine, version)
+        return _cube
+
+
+def refresh_cube(engine):
+    global _cube
+    with _cube_lock:
+        _cube = AggregateCube.build(engine, query_cache.check_version(engine, force=True))
+        return _cube
+
+
+def frames_match(spec, expected, actual):
+    if list(expected.columns) != list(actual.columns) or len(expected) != len(actual):
+        return False
+    # Rows tied on the ORDER BY columns may come back in any order, so compare
+    # the sort-column sequence first and then the rows keyed by group
+    for column, _ in spec.order_by:
+        if column in spec.group_by:
+            same = list(expected[column]) == list(actual[column])
+        else:
+            same = np.allclose(_as_float(expected[column]), _as_float(actual[column]), rtol=0, atol=1e-6, equal_nan=True)
+        if not same:
+            return False
+    if spec.group_by:
+        expected = expected.sort_values(list(spec.group_by)).reset_index(drop=True)
+        actual = actual.sort_values(list(spec.group_by)).reset_index(drop=True)
+        for column in spec.group_by:
+            if list(expected[column]) != list(actual[column]):
+                return False
+    for alias, _ in spec.metrics:
+        if not np.allclose(_as_float(expected[alias]), _as_float(actual[alias]), rtol=0, atol=1e-6, equal_nan=True):
+            return False
+    return True
+
+
+def _as_float(series):
+    return pd.to_numeric(series).astype(float).to_numpy()
+
+
+# Check cube answers against the SQL for every tab and filter combination
+def verify(engine, cube=None):
+    cube = cube or AggregateCube.build(engine)
+    checked = 0
+    mismatches = []
+    for tab in TAB_QUERIES:
+        age_range = AGE_RANGE if tab == 'medical_conditions' else None
+        for filters in filter_combinations(tab):
+            for name, spec in tab_queries(tab, filters, age_range).items():
+                expected = read_sql(engine, spec.to_sql(stay_sql(engine)), spec.params(), cache=None, metrics=None)
+                actual = cube.answer(spec)
+                if actual is None or not frames_match(spec, expected, actual):
+                    mismatches.append((tab, name, filters))
+                checked += 1
+    return checked, mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the aggregate cube and optionally verify it against SQL.")
+    parser.add_argument('--verify', action='store_true', help="compare every tab query and filter combination with SQL")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    cube = AggregateCube.build(engine)
+    print(f"Cube built: {cube.size:,} cells over {len(DIMENSIONS)} dimensions")
+    if args.verify:
+        checked, mismatches = verify(engine, cube)
+        for tab, name, filters in mismatches:
+            print(f"MISMATCH {tab}.{name} {filters}")
+        print(f"{checked - len(mismatches)}/{checked} queries match")
+        sys.exit(1 if mismatches else 0)
@@ -0,0 +1,340 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from pyarrow import fs
+from sqlalchemy import Date, DateTime, Float, Integer, Numeric, inspect, text
+
+from db import create_db_engine, read_sql, stay_sql
+from queries import STAY_COLUMN
+from query_cache import APPENDED_ROWS
+from rollup import AVERAGES, sort_result, sql_average
+from settings import getenv
+
+# Where the dashboard reads the patients table from:
+#   'database' - MySQL (or DATABASE_URL) through SQLAlchemy
+#   'parquet'  - a columnar snapshot of the table, memory-mapped, with only
+#                the needed columns read and filters pushed into the scan
+#
+#   python data_sources.py                       export patients to PARQUET_PATH
+#   python data_sources.py --output snap.parquet --row-group-rows 250000
+#
+# Code that reads rows or groups goes through read_chunks() and group_rows(),
+# which take either a SQLAlchemy engine or a ParquetSource.
+
+DEFAULT_PARQUET_PATH = 'patients.parquet'
+EXPORT_CHUNK_ROWS = 100_000
+
+TABLE = 'patients'
+
+# Billing amounts in whole cents, projected from the snapshot so sums are exact
+BILLING_CENTS = 'billing_cents'
+
+# Arrow aggregate per SQL aggregate function; COUNT(*) counts rows and
+# COUNT(column) its non-null values
+ARROW_AGGREGATES = {'COUNT': 'count', 'SUM': 'sum', 'MIN': 'min', 'MAX': 'max', 'AVG': 'mean'}
+
+# queries.METRICS as (SQL function, column) pairs; answer() applies MySQL's rounding
+METRIC_AGGREGATES = {
+    'count': ('COUNT', '*'),
+    'avg_billing': ('AVG', BILLING_CENTS),
+    'avg_stay': ('AVG', STAY_COLUMN),
+    'min_age': ('MIN', 'age'),
+    'max_age': ('MAX', 'age'),
+    'avg_age': ('AVG', 'age'),
+}
+
+
+def _kind(column_type):
+    if isinstance(column_type, pa.DataType):
+        if pa.types.is_date(column_type) or pa.types.is_timestamp(column_type):
+            return 'date'
+        if pa.types.is_integer(column_type) or pa.types.is_floating(column_type) or pa.types.is_decimal(column_type):
+            return 'numeric'
+        return 'text'
+    if isinstance(column_type, (Date, DateTime)):
+        return 'date'
+    if isinstance(column_type, (Integer, Numeric, Float)):
+        return 'numeric'
+    return 'text'
+
+
+class ParquetSource:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.url = f"parquet://{self.path}"
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._dataset = None
+        self._version = None
+        self.dataset()
+
+    # The snapshot is replaced atomically by the exporter; reopen it when it changes
+    def dataset(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with self._lock:
+            if mtime != self._mtime:
+                self._dataset = ds.dataset(self.path, format='parquet', filesystem=fs.LocalFileSystem(use_mmap=True))
+                self._version = self._read_version()
+                self._mtime = mtime
+            return self._dataset
+
+    # (row count, max patient_id) like query_cache.VERSION_QUERY, from the
+    # Parquet footer and row group statistics without reading any rows
+    def _read_version(self):
+        metadata = pq.ParquetFile(self.path, memory_map=True).metadata
+        column = metadata.schema.to_arrow_schema().get_field_index('patient_id')
+        maxima = []
+        for idx in range(metadata.num_row_groups):
+            statistics = metadata.row_group(idx).column(column).statistics
+            if statistics is not None and statistics.has_min_max:
+                maxima.append(statistics.max)
+        return metadata.num_rows, max(maxima) if maxima else None
+
+    def table_version(self):
+        self.dataset()
+        return self._version
+
+    def column_kinds(self):
+        return {field.name: _kind(field.type) for field in self.dataset().schema}
+
+    # Projection for the requested columns; the length of stay is computed from
+    # the dates unless the snapshot stores it, and BILLING_CENTS from the amounts
+    def _projection(self, columns):
+        names = self.dataset().schema.names
+        projection = {}
+        for column in columns:
+            if column == STAY_COLUMN and column not in names:
+                projection[column] = pc.days_between(ds.field('date_of_admission'), ds.field('discharge_date'))
+            elif column == BILLING_CENTS:
+                projection[column] = pc.round(pc.multiply(ds.field('billing_amount'), 100))
+            else:
+                projection[column] = ds.field(column)
+        return projection
+
+    def to_table(self, columns, filter=None):
+        return self.dataset().to_table(columns=self._projection(columns), filter=filter)
+
+    def batches(self, columns, filter=None, batch_rows=100_000):
+        return self.dataset().to_batches(columns=self._projection(columns), filter=filter, batch_size=batch_rows)
+
+    # GROUP BY over the filtered rows; aggregates map output names to
+    # (SQL function, column) pairs, with '*' for COUNT(*)
+    def group_by(self, group_by, aggregates, filter=None):
+        columns = set(group_by) | {column for _, column in aggregates.values() if column != '*'}
+        table = self.to_table(sorted(columns), filter)
+        # Arrow names each result "<column>_<aggregate>", or "count_all"
+        outputs = {}
+        arrow_aggregates = {}
+        for name, (func, column) in aggregates.items():
+            if column == '*':
+                outputs[name] = 'count_all'
+                arrow_aggregates['count_all'] = ([], 'count_all')
+            else:
+                outputs[name] = f"{column}_{ARROW_AGGREGATES[func]}"
+                arrow_aggregates[outputs[name]] = (column, ARROW_AGGREGATES[func])
+        frame = table.group_by(list(group_by), use_threads=False).aggregate(list(arrow_aggregates.values())).to_pandas()
+        return pd.DataFrame({column: frame[column] for column in group_by} | {name: frame[output] for name, output in outputs.items()})
+
+    # Answer an AggregateQuery with the same rounding and ordering as MySQL;
+    # averages come from exact sums and counts through rollup.sql_average()
+    def answer(self, spec):
+        aggregates = {}
+        for alias, metric in spec.metrics:
+            func, column = METRIC_AGGREGATES[metric]
+            if func == 'AVG':
+                aggregates[alias] = ('SUM', column)
+                aggregates[f"{alias}__count"] = ('COUNT', column)
+            else:
+                aggregates[alias] = (func, column)
+        df = self.group_by(spec.group_by, aggregates, spec_filter(spec))
+        for alias, metric in spec.metrics:
+            if metric in AVERAGES:
+                df[alias] = sql_average(metric, df[alias], df.pop(f"{alias}__count"))
+        # Arrow emits groups in hash order; sort by key like the in-memory backends
+        if spec.group_by:
+            df = df.sort_values(list(spec.group_by), kind='stable').reset_index(drop=True)
+        return sort_result(spec, df)
+
+
+# AND of filter expressions, skipping None; None when nothing is left
+def all_of(*expressions):
+    combined = None
+    for expression in expressions:
+        if expression is not None:
+            combined = expression if combined is None else combined & expression
+    return combined
+
+
+# Filter expression for (column, value) equality pairs
+def equality_filter(pairs):
+    return all_of(*(ds.field(column) == value for column, value in pairs))
+
+
+# Filter expression for an AggregateQuery's equality filters and age range
+def spec_filter(spec):
+    age = None
+    if spec.age_range is not None:
+        age = (ds.field('age') >= int(spec.age_range[0])) & (ds.field('age') <= int(spec.age_range[1]))
+    return all_of(equality_filter(spec.filters), age)
+
+
+# Filter expression for query_cache.APPENDED_ROWS; patient_id row group
+# statistics let the scan skip every row group written before the watermark
+def appended_filter(params):
+    if params is None:
+        return None
+    return (ds.field('patient_id') > params['low']) & (ds.field('patient_id') <= params['high'])
+
+
+def is_snapshot(source):
+    return isinstance(source, ParquetSource)
+
+
+# Source name recorded in query_metrics for reads that bypass read_sql
+def source_label(source):
+    return 'parquet' if is_snapshot(source) else 'database'
+
+
+# Snapshot location from PARQUET_PATH
+def parquet_path():
+    return getenv('PARQUET_PATH', DEFAULT_PARQUET_PATH)
+
+
+# The dashboard's data: the Parquet snapshot when DATA_SOURCE=parquet,
+# otherwise a database engine (None without credentials). Both settings are
+# read on every call, so .env and the process environment both apply.
+def create_data_source():
+    if getenv('DATA_SOURCE', 'database') == 'parquet':
+        return ParquetSource(parquet_path())
+    return create_db_engine()
+
+
+def column_kinds(source):
+    if is_snapshot(source):
+        return source.column_kinds()
+    return {column['name']: _kind(column['type']) for column in inspect(source).get_columns(TABLE)}
+
+
+# Text of a column scan as recorded in query_metrics: the SELECT statement,
+# or the snapshot and its projection
+def scan_sql(source, columns, appended=False):
+    if is_snapshot(source):
+        return f"SCAN {source.url} ({', '.join(columns)})" + (f" WHERE {APPENDED_ROWS}" if appended else '')
+    stay = stay_sql(source)
+    select = ', '.join(f"{stay} AS {STAY_COLUMN}" if column == STAY_COLUMN and stay != STAY_COLUMN else column for column in columns)
+    return f"SELECT {select} FROM {TABLE}" + (f" WHERE {APPENDED_ROWS}" if appended else '')
+
+
+# DataFrame chunks of patients columns (STAY_COLUMN allowed), optionally only
+# the rows appended between two watermarks (query_cache.appended_range)
+def read_chunks(source, columns, appended=None, chunk_rows=100_000):
+    if is_snapshot(source):
+        for batch in source.batches(columns, appended_filter(appended), chunk_rows):
+            if batch.num_rows:
+                yield batch.to_pandas(date_as_object=False)
+        return
+    sql = scan_sql(source, columns, appended is not None)
+    with source.connect().execution_options(stream_results=True) as conn:
+        yield from pd.read_sql(text(sql), conn, params=appended, chunksize=chunk_rows)
+
+
+# GROUP BY statement over patients; aggregates map output names to
+# (SQL function, column) pairs, where '{stay}' is the length of stay
+def group_sql(group_by, aggregates, stay=None, appended=False):
+    select = list(group_by) + [f"{func}({column.format(stay=stay)}) AS {name}" for name, (func, column) in aggregates.items()]
+    where = f" WHERE {APPENDED_ROWS}" if appended else ''
+    grouping = f" GROUP BY {', '.join(group_by)}" if group_by else ''
+    return f"SELECT {', '.join(select)} FROM {TABLE}{where}{grouping}"
+
+
+# Grouped aggregates from either source, as a DataFrame with the group_by
+# columns followed by one column per aggregate
+def group_rows(source, group_by, aggregates, appended=None):
+    if is_snapshot(source):
+        snapshot_aggregates = {name: (func, STAY_COLUMN if column == '{stay}' else column) for name, (func, column) in aggregates.items()}
+        return source.group_by(group_by, snapshot_aggregates, appended_filter(appended))
+    sql = group_sql(group_by, aggregates, stay_sql(source), appended=appended is not None)
+    return read_sql(source, sql, appended, cache=None)
+
+
+# Arrow type per column of the database table; dates stay dates and
+# DECIMAL billing amounts become float64 for fast vectorized reads
+def _arrow_schema(engine):
+    fields = []
+    for column in inspect(engine).get_columns(TABLE):
+        kind = _kind(column['type'])
+        if kind == 'date':
+            arrow_type = pa.timestamp('us') if isinstance(column['type'], DateTime) else pa.date32()
+        elif isinstance(column['type'], Integer):
+            arrow_type = pa.int64()
+        elif kind == 'numeric':
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column['name'], arrow_type))
+    return pa.schema(fields)
+
+
+def _to_arrow(chunk, schema):
+    arrays = []
+    for field in schema:
+        values = chunk[field.name]
+        if pa.types.is_date(field.type) or pa.types.is_timestamp(field.type):
+            array = pa.array(pd.to_datetime(values), type=pa.timestamp('ns'), from_pandas=True).cast(field.type)
+        elif pa.types.is_integer(field.type) or pa.types.is_floating(field.type):
+            array = pa.array(pd.to_numeric(values).astype(float), from_pandas=True).cast(field.type)
+        else:
+            array = pa.array(values.astype(object).where(values.notna(), None), type=field.type)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+# Stream the table in patient_id order into a Parquet file, so the row
+# group statistics on patient_id are tight and appended rows land in the
+# last row groups. Written beside the target and renamed over it, so readers
+# never see a partial snapshot; a failed or interrupted export removes the
+# partial file.
+def export_snapshot(engine, path=None, row_group_rows=EXPORT_CHUNK_ROWS):
+    path = path or parquet_path()
+    schema = _arrow_schema(engine)
+    temp_path = f"{path}.tmp"
+    rows = 0
+    try:
+        with pq.ParquetWriter(temp_path, schema, compression='zstd') as writer:
+            with engine.connect().execution_options(stream_results=True) as conn:
+                sql = f"SELECT {', '.join(schema.names)} FROM {TABLE} ORDER BY patient_id"
+                for chunk in pd.read_sql(text(sql), conn, chunksize=row_group_rows):
+                    writer.write_table(_to_arrow(chunk, schema), row_group_size=row_group_rows)
+                    rows += len(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the patients table to a Parquet snapshot for DATA_SOURCE=parquet.")
+    parser.add_argument('--output', help=f"snapshot path (default PARQUET_PATH, or {DEFAULT_PARQUET_PATH})")
+    parser.add_argument('--row-group-rows', type=int, default=EXPORT_CHUNK_ROWS, help=f"rows per row group (default {EXPORT_CHUNK_ROWS:,})")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    output = args.output or parquet_path()
+    started = time.perf_counter()
+    rows = export_snapshot(engine, output, args.row_group_rows)
+    print(f"Exported {rows:,} rows to {output} ({os.path.getsize(output) / 1e6:.1f} MB) in {time.perf_counter() - started:.1f}s")
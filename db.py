@@ -0,0 +1,222 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from sqlalchemy import create_engine, event, inspect, text
+
+from queries import STAY_COLUMN, STAY_SQL
+from query_cache import query_cache
+from query_metrics import query_metrics, query_section
+from settings import getenv
+
+# Bounded worker pool shared by every session for independent queries
+QUERY_WORKERS = int(getenv('DB_QUERY_WORKERS', '8'))
+_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix='db-query')
+
+
+# Connection pool settings; the defaults leave room for many concurrent
+# Streamlit sessions each running a few queries at once
+def pool_options():
+    return {
+        'pool_size': int(getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(getenv('DB_MAX_OVERFLOW', '20')),
+        'pool_timeout': float(getenv('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+
+
+# Engine for an explicit URL, DATABASE_URL, or the DB_* environment
+# variables; None when none of them are set
+def create_db_engine(url=None):
+    url = url or getenv('DATABASE_URL')
+    if url is None:
+        db_user = getenv('DB_USER')
+        db_password = getenv('DB_PASSWORD')
+        db_host = getenv('DB_HOST')
+        db_name = getenv('DB_NAME')
+
+        if not all([db_user, db_password, db_host, db_name]):
+            return None
+        url = f'mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}'
+
+    if url.startswith('sqlite'):
+        engine = create_engine(url)
+        event.listen(engine, 'connect', _add_sqlite_functions)
+        return engine
+    return create_engine(url, **pool_options())
+
+
+# SQLite stand-in for local runs: provide the MySQL functions the queries use.
+# AVG() and ROUND() are replaced as well: SQLite adds doubles in row order,
+# so which way an average of exactly half a cent rounds would depend on the
+# scan, where MySQL averages DECIMAL and integer columns exactly.
+def _add_sqlite_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function('DATEDIFF', 2, _datediff, deterministic=True)
+    dbapi_connection.create_aggregate('AVG', 1, _MySQLAverage)
+    dbapi_connection.create_function('ROUND', 1, _round, deterministic=True)
+    dbapi_connection.create_function('ROUND', 2, _round, deterministic=True)
+
+
+def _datediff(end, start):
+    if end is None or start is None:
+        return None
+    return (date.fromisoformat(str(end)[:10]) - date.fromisoformat(str(start)[:10])).days
+
+
+# MySQL AVG(): the exact mean, rounded half away from zero to 4 more decimals
+# than the values. REAL columns hold DECIMAL amounts, which the shortest
+# repr() of each double gives back exactly.
+class _MySQLAverage:
+    def __init__(self):
+        self.total = Decimal(0)
+        self.count = 0
+
+    def step(self, value):
+        if value is not None:
+            self.total += Decimal(repr(value)) if isinstance(value, float) else value
+            self.count += 1
+
+    def finalize(self):
+        if not self.count:
+            return None
+        scale = 4 - min(self.total.as_tuple().exponent, 0)
+        numerator = int(self.total.scaleb(scale))
+        quotient, remainder = divmod(abs(numerator), self.count)
+        quotient += 2 * remainder >= self.count
+        return float(Decimal(quotient if numerator >= 0 else -quotient).scaleb(-scale))
+
+
+# MySQL ROUND() of an exact value: half away from zero. Doubles are taken as
+# the decimal of their shortest repr(), which is how AVG() above returns them.
+def _round(value, decimals=0):
+    if value is None or isinstance(value, int) and decimals >= 0:
+        return value
+    return float(Decimal(repr(float(value))).quantize(Decimal(1).scaleb(-decimals), rounding=ROUND_HALF_UP))
+
+
+# Length of stay expression for an engine's schema, looked up once per database
+_stay_sql = {}
+
+
+def stay_sql(engine):
+    key = str(engine.url)
+    if key not in _stay_sql:
+        columns = {column['name'] for column in inspect(engine).get_columns('patients')}
+        _stay_sql[key] = STAY_COLUMN if STAY_COLUMN in columns else STAY_SQL
+    return _stay_sql[key]
+
+
+# Cast a result to a schema of column -> dtype: 'category' for repeated
+# labels, or a NumPy numeric dtype (DECIMAL values included). Integer
+# columns holding NULLs stay float64; columns not in the schema are kept.
+def apply_schema(df, schema):
+    if not schema:
+        return df
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        dtype = schema.get(column)
+        if dtype == 'category':
+            values = values.astype('category')
+        elif dtype is not None:
+            values = pd.to_numeric(values)
+            if not (np.issubdtype(np.dtype(dtype), np.integer) and values.isna().any()):
+                values = values.astype(dtype)
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+# Concatenate typed chunks; categoricals are unioned so they stay categorical
+def concat_frames(frames):
+    if len(frames) == 1:
+        return frames[0]
+    columns = {}
+    for column in frames[0].columns:
+        parts = [frame[column] for frame in frames]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            columns[column] = pd.Categorical(union_categoricals(parts, sort_categories=True))
+        else:
+            columns[column] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+# Execute and fetch, then build the DataFrame the way pd.read_sql does,
+# timing the two halves separately. With chunk_rows the result is streamed
+# and each chunk is typed as it arrives, so only one chunk of Python row
+# tuples is ever held at once.
+def fetch_frame(engine, query, params=None, schema=None, chunk_rows=None):
+    started = time.perf_counter()
+    frames = []
+    frame_ms = 0.0
+    with engine.connect() as conn:
+        options = {'stream_results': True} if chunk_rows else {}
+        result = conn.execution_options(**options).execute(text(query), params or {})
+        columns = list(result.keys())
+        for rows in result.partitions(chunk_rows) if chunk_rows else [result.fetchall()]:
+            building = time.perf_counter()
+            frames.append(apply_schema(pd.DataFrame.from_records(rows, columns=columns, coerce_float=True), schema))
+            frame_ms += (time.perf_counter() - building) * 1000
+    building = time.perf_counter()
+    df = concat_frames(frames) if frames else apply_schema(pd.DataFrame(columns=columns), schema)
+    frame_ms += (time.perf_counter() - building) * 1000
+    return df, (time.perf_counter() - started) * 1000 - frame_ms, frame_ms
+
+
+# Run a query through the shared result cache, recording its cost in query_metrics.
+# schema and chunk_rows are passed to fetch_frame; the schema is part of the cache key.
+# Cached DataFrames are shared between sessions, so callers must not modify them in place.
+def read_sql(engine, query, params=None, cache=query_cache, metrics=query_metrics, schema=None, chunk_rows=None):
+    started = time.perf_counter()
+    use_cache = cache is not None and cache.enabled
+    try:
+        if use_cache:
+            cache.check_version(engine)
+            key = cache.make_key(query, params, schema)
+            df = cache.get(key)
+            if df is not None:
+                if metrics is not None:
+                    metrics.record(query, 'cache', (time.perf_counter() - started) * 1000, rows=len(df))
+                return df
+        df, db_ms, frame_ms = fetch_frame(engine, query, params, schema, chunk_rows)
+        if use_cache:
+            cache.put(key, df)
+    except Exception as e:
+        if metrics is not None:
+            metrics.record(query, 'database', (time.perf_counter() - started) * 1000, error=f"{type(e).__name__}: {e}")
+        raise
+    if metrics is not None:
+        metrics.record(query, 'database', (time.perf_counter() - started) * 1000, db_ms, frame_ms, len(df))
+    return df
+
+
+# Run independent callables on the worker pool. Results come back keyed in
+# the order the tasks were given; the first failure in that order is raised.
+# Each task runs in a copy of the caller's context, so the query section
+# label follows it onto the worker thread.
+def run_parallel(tasks):
+    if len(tasks) <= 1:
+        return {name: task() for name, task in tasks.items()}
+    futures = {name: _executor.submit(contextvars.copy_context().run, task) for name, task in tasks.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+# queries maps names to SQL text, (SQL text, bound parameters) pairs or
+# (SQL text, bound parameters, schema) triples; each name is added to the
+# query section its metrics are recorded under
+def read_sql_many(engine, queries):
+    tasks = {}
+    for name, query in queries.items():
+        sql, params, schema = (query, None, None) if isinstance(query, str) else (*query, None)[:3]
+        tasks[name] = lambda name=name, sql=sql, params=params, schema=schema: _read_sql_in_section(engine, name, sql, params, schema)
+    return run_parallel(tasks)
+
+
+def _read_sql_in_section(engine, name, sql, params, schema=None):
+    with query_section(str(name)):
+        return read_sql(engine, sql, params, schema=schema)
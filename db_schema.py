@@ -0,0 +1,243 @@
+import argparse
+import sys
+
+from dotenv import load_dotenv
+from sqlalchemy import inspect, text
+
+from db import create_db_engine, stay_sql
+from queries import FILTER_OPTIONS, METRIC_COLUMNS, RECORD_SORT_COLUMNS, STAY_COLUMN, STAY_SQL, TAB_FILTERS, TAB_QUERIES, tab_queries
+
+# Schema management for the patients table.
+#
+#   python db_schema.py indexes                   report the covering indexes the dashboard needs
+#   python db_schema.py indexes --apply           create the missing ones, with EXPLAIN before/after
+#   python db_schema.py length-of-stay [--apply]  add the stored length_of_stay column
+
+TABLE = 'patients'
+
+# Range-filtered columns per tab; they go after the equality columns in an index
+TAB_RANGES = {'medical_conditions': ('age',)}
+
+# Column definitions of the patients table, as loaded from the Kaggle CSV
+COLUMNS = {
+    'patient_id': 'INTEGER PRIMARY KEY',
+    'name': 'VARCHAR(100)',
+    'age': 'INTEGER',
+    'gender': 'VARCHAR(10)',
+    'blood_type': 'VARCHAR(5)',
+    'medical_condition': 'VARCHAR(50)',
+    'date_of_admission': 'DATE',
+    'doctor': 'VARCHAR(100)',
+    'hospital': 'VARCHAR(100)',
+    'insurance_provider': 'VARCHAR(50)',
+    'billing_amount': 'DECIMAL(12, 2)',
+    'room_number': 'INTEGER',
+    'admission_type': 'VARCHAR(20)',
+    'discharge_date': 'DATE',
+    'medication': 'VARCHAR(50)',
+    'test_results': 'VARCHAR(20)',
+}
+
+# Length of stay as a stored generated column per dialect
+STORED_STAY = {
+    'mysql': f"SMALLINT AS ({STAY_SQL}) STORED",
+    'sqlite': "INTEGER AS (CAST(julianday(discharge_date) - julianday(date_of_admission) AS INTEGER)) STORED",
+}
+
+
+def _unique(columns):
+    seen = []
+    for column in columns:
+        if column not in seen:
+            seen.append(column)
+    return seen
+
+
+# Derive composite covering indexes from the query shapes the tabs emit.
+# Each index leads with the GROUP BY columns so MySQL can group in index
+# order, then the tab's equality filters, range filters and finally every
+# column the aggregates read, so no query has to touch the table rows.
+# The record explorer's sort columns get (column, patient_id) indexes.
+def advise_indexes(stored_stay=False):
+    metric_columns = dict(METRIC_COLUMNS)
+    if stored_stay:
+        metric_columns['avg_stay'] = (STAY_COLUMN,)
+
+    shapes = {}
+    ungrouped = {}
+    for tab, queries in TAB_QUERIES.items():
+        for group_by, metrics, _ in queries.values():
+            measured = [column for _, metric in metrics for column in metric_columns[metric]]
+            columns = list(TAB_FILTERS[tab]) + list(TAB_RANGES.get(tab, ())) + measured
+            if group_by:
+                shapes.setdefault(group_by, []).extend(columns)
+            else:
+                ungrouped.setdefault(tab, []).extend(columns)
+
+    indexes = {}
+    for group_by, columns in shapes.items():
+        indexes[f"ix_{TABLE}_{'_'.join(group_by)}_cover"] = _unique(list(group_by) + columns)
+
+    # Ungrouped queries only need some index holding all of their columns
+    for tab, columns in ungrouped.items():
+        if not any(set(columns) <= set(index) for index in indexes.values()):
+            indexes[f"ix_{TABLE}_{tab}_cover"] = _unique(columns)
+
+    # Record explorer pages seek on (sort column, patient_id)
+    for column in RECORD_SORT_COLUMNS:
+        if column != 'patient_id':
+            indexes[f"ix_{TABLE}_{column}_keyset"] = [column, 'patient_id']
+
+    # Drop indexes that are a prefix of another one
+    for name, columns in list(indexes.items()):
+        for other, other_columns in indexes.items():
+            if other != name and other_columns[:len(columns)] == columns:
+                del indexes[name]
+                break
+    return indexes
+
+
+def create_table_sql(dialect, stored_stay=False):
+    columns = dict(COLUMNS)
+    if dialect == 'mysql':
+        columns['patient_id'] = 'INT AUTO_INCREMENT PRIMARY KEY'
+    elif dialect == 'sqlite':
+        # SQLite has no DECIMAL storage class
+        columns['billing_amount'] = 'REAL'
+    if stored_stay:
+        columns[STAY_COLUMN] = STORED_STAY[dialect]
+    definitions = ',\n    '.join(f"{name} {definition}" for name, definition in columns.items())
+    return f"CREATE TABLE {TABLE} (\n    {definitions}\n)"
+
+
+def existing_indexes(engine):
+    return {index['name']: list(index['column_names']) for index in inspect(engine).get_indexes(TABLE)}
+
+
+# Indexes whose column list is not already served by an existing index prefix
+def missing_indexes(engine, indexes):
+    existing = existing_indexes(engine).values()
+    return {
+        name: columns for name, columns in indexes.items()
+        if not any(have[:len(columns)] == columns for have in existing)
+    }
+
+
+def has_stored_stay(engine):
+    return STAY_COLUMN in {column['name'] for column in inspect(engine).get_columns(TABLE)}
+
+
+# MySQL cannot index TEXT/BLOB columns without a prefix length
+def unindexable_columns(engine, columns):
+    if engine.dialect.name != 'mysql':
+        return []
+    types = {column['name']: str(column['type']).upper() for column in inspect(engine).get_columns(TABLE)}
+    return [column for column in columns if 'TEXT' in types.get(column, '') or 'BLOB' in types.get(column, '')]
+
+
+# One query per tab with every filter applied, plus the unfiltered variant
+def sample_queries():
+    samples = []
+    for tab in TAB_QUERIES:
+        filters = {column: FILTER_OPTIONS[column][2][0] for column in TAB_FILTERS[tab]}
+        age_range = (30, 60) if tab == 'medical_conditions' else None
+        for applied in ({}, filters):
+            for name, spec in tab_queries(tab, applied, age_range).items():
+                samples.append((f"{tab}.{name}{' (filtered)' if applied else ''}", spec))
+    return samples
+
+
+def explain(engine, sql, params):
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    with engine.connect() as conn:
+        result = conn.execute(text(prefix + sql), params)
+        return [dict(row._mapping) for row in result]
+
+
+def _plan_summary(engine, rows):
+    if engine.dialect.name == 'sqlite':
+        return '; '.join(str(row.get('detail')) for row in rows)
+    return '; '.join(
+        f"type={row.get('type')} key={row.get('key')} rows={row.get('rows')} extra={row.get('Extra')}"
+        for row in rows
+    )
+
+
+def report_plans(engine, title):
+    print(f"\n== EXPLAIN {title} ==")
+    for label, spec in sample_queries():
+        print(f"{label}: {_plan_summary(engine, explain(engine, spec.to_sql(stay_sql(engine)), spec.params()))}")
+
+
+def create_indexes(engine, indexes):
+    existing = existing_indexes(engine)
+    with engine.begin() as conn:
+        for name, columns in indexes.items():
+            # An advised index whose columns changed (e.g. after length_of_stay was added) is rebuilt
+            if name in existing:
+                drop = f"DROP INDEX {name}" if engine.dialect.name == 'sqlite' else f"DROP INDEX {name} ON {TABLE}"
+                conn.execute(text(drop))
+                print(f"Dropped {name} ({', '.join(existing[name])})")
+            conn.execute(text(f"CREATE INDEX {name} ON {TABLE} ({', '.join(columns)})"))
+            print(f"Created {name} ({', '.join(columns)})")
+
+
+def indexes_command(engine, apply):
+    advised = advise_indexes(has_stored_stay(engine))
+    missing = missing_indexes(engine, advised)
+    print("Covering indexes for the dashboard query shapes:")
+    for name, columns in advised.items():
+        state = 'missing' if name in missing else 'present'
+        print(f"  [{state}] {name} ({', '.join(columns)})")
+
+    blocked = unindexable_columns(engine, sorted({column for columns in missing.values() for column in columns}))
+    if blocked:
+        print(f"\nThese columns are TEXT/BLOB and must be converted (e.g. ALTER TABLE {TABLE} MODIFY {blocked[0]} VARCHAR(64)) before indexing: {', '.join(blocked)}")
+        return 1
+    if not apply or not missing:
+        return 0
+
+    report_plans(engine, 'before')
+    create_indexes(engine, missing)
+    report_plans(engine, 'after')
+    return 0
+
+
+# Stored generated column, so length of stay is computed once per row on
+# write instead of with DATEDIFF on every scan, and can be indexed
+def length_of_stay_command(engine, apply):
+    if has_stored_stay(engine):
+        print(f"{TABLE}.{STAY_COLUMN} already exists")
+        return 0
+    if engine.dialect.name != 'mysql':
+        print(f"Adding a stored generated column in place needs MySQL; create {STAY_COLUMN} when loading the table instead")
+        return 1
+
+    ddl = f"ALTER TABLE {TABLE} ADD COLUMN {STAY_COLUMN} SMALLINT AS ({STAY_SQL}) STORED"
+    print(ddl)
+    if not apply:
+        return 0
+    with engine.begin() as conn:
+        conn.execute(text(ddl))
+    print(f"Added {TABLE}.{STAY_COLUMN}; run 'python db_schema.py indexes --apply' to cover it")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Schema management for the patients table.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    index_parser = commands.add_parser('indexes', help="report or create the covering indexes the dashboard needs")
+    index_parser.add_argument('--apply', action='store_true', help="create missing indexes and show EXPLAIN before/after")
+    stay_parser = commands.add_parser('length-of-stay', help="add the stored length_of_stay generated column")
+    stay_parser.add_argument('--apply', action='store_true', help="run the ALTER TABLE instead of printing it")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    if args.command == 'indexes':
+        sys.exit(indexes_command(engine, args.apply))
+    if args.command == 'length-of-stay':
+        sys.exit(length_of_stay_command(engine, args.apply))
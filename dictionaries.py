@@ -0,0 +1,96 @@
+import threading
+
+import pandas as pd
+
+from data_sources import appended_filter, is_snapshot
+from db import read_sql
+from db_schema import TABLE
+from queries import DIMENSIONS
+from query_cache import APPENDED_ROWS, INCREMENTAL_REFRESH, appended_range, query_cache
+from query_metrics import query_section
+
+# Distinct values and row counts of every categorical column.
+# Each column is counted by its own small GROUP BY, and the SQL backends send
+# them as one UNION ALL statement, so the result is one row per value rather
+# than the joint cross product of every column. The filter widgets and the
+# column details panel read from here instead of running SELECT DISTINCT per click.
+
+
+COUNTS = {'n': ('COUNT', '*')}
+
+
+# (dimension, value, n) rows for every column; appended restricts each scan
+# to the patient_id watermark range in APPENDED_ROWS
+def dictionary_sql(appended=False):
+    where = f" WHERE {APPENDED_ROWS}" if appended else ''
+    return ' UNION ALL '.join(
+        f"SELECT '{column}' AS dimension, {column} AS value, COUNT(*) AS n FROM {TABLE}{where} GROUP BY {column}"
+        for column in DIMENSIONS
+    )
+
+
+def _value_counts(source, appended=None):
+    if is_snapshot(source):
+        frames = [
+            source.group_by([column], COUNTS, appended_filter(appended)).rename(columns={column: 'value'}).assign(dimension=column)
+            for column in DIMENSIONS
+        ]
+        counts = pd.concat(frames, ignore_index=True)[['dimension', 'value', 'n']]
+    else:
+        counts = read_sql(source, dictionary_sql(appended is not None), appended, cache=None)
+    return counts.assign(n=pd.to_numeric(counts['n']).astype('int64'))
+
+
+class ValueDictionaries:
+    # counts holds (dimension, value, n) rows, NULL values included
+    def __init__(self, counts, version=None):
+        self.version = version
+        self.value_counts = counts
+        columns = {column: counts[counts['dimension'] == column] for column in DIMENSIONS}
+        self.total = int(columns[DIMENSIONS[0]]['n'].sum())
+        self._counts = {
+            column: rows.dropna(subset=['value']).groupby('value')['n'].sum().rename_axis(column).sort_index()
+            for column, rows in columns.items()
+        }
+
+    @classmethod
+    def build(cls, engine, version=None):
+        with query_section('dictionaries build'):
+            return cls(_value_counts(engine), version)
+
+    # New dictionaries with the rows appended since this version counted in;
+    # None when the table changed in any other way
+    def extend(self, engine, version):
+        params = appended_range(self.version, version)
+        if params is None:
+            return None
+        with query_section('dictionaries refresh'):
+            delta = _value_counts(engine, params)
+        if int(delta.loc[delta['dimension'] == DIMENSIONS[0], 'n'].sum()) != version[0] - self.version[0]:
+            return None
+        counts = pd.concat([self.value_counts, delta], ignore_index=True)
+        return ValueDictionaries(counts.groupby(['dimension', 'value'], dropna=False, sort=False)['n'].sum().reset_index(), version)
+
+    # Sorted distinct non-null values of a column
+    def values(self, column):
+        return self._counts[column].index.tolist()
+
+    # DataFrame of (column, count), sorted by value
+    def counts(self, column):
+        return self._counts[column].rename('count').reset_index()
+
+
+# Shared dictionaries for every session in the process, refreshed when the table version moves
+_dictionaries = None
+_dictionaries_lock = threading.Lock()
+
+
+def get_dictionaries(engine):
+    global _dictionaries
+    version = query_cache.check_version(engine)
+    with _dictionaries_lock:
+        if _dictionaries is not None and _dictionaries.version != version and INCREMENTAL_REFRESH:
+            _dictionaries = _dictionaries.extend(engine, version)
+        if _dictionaries is None or _dictionaries.version != version:
+            _dictionaries = ValueDictionaries.build(engine, version)
+        return _dictionaries
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+from settings import getenv
+
+# Shared, process-wide cache of the dashboard's Plotly figures.
+# Building a figure with plotly.express costs tens of milliseconds even for a
+# handful of bars, and every rerun of every session used to rebuild each one.
+# Figures are keyed by a hash of the plotted data plus the chart spec, so an
+# unchanged result reuses the figure built for any session, and a changed
+# one simply misses; no version check is needed. Entries are evicted least
+# recently used once the estimated size of the cached figures passes the cap.
+# Series longer than CHART_MAX_POINTS are thinned before plotting.
+# The cache holds figures rather than their JSON: st.plotly_chart serializes
+# whatever it is given, and a dict or JSON spec is first rebuilt into a
+# validated Figure, which costs several times the serialization it would save.
+
+FIGURE_CACHE_MAX_MB = float(getenv('FIGURE_CACHE_MAX_MB', '32'))
+CHART_MAX_POINTS = int(getenv('CHART_MAX_POINTS', '2000'))
+
+# Serialized size of a figure's layout and template, on top of its data
+FIGURE_OVERHEAD_BYTES = 8 * 1024
+
+CHARTS = {'bar': px.bar, 'pie': px.pie, 'line': px.line, 'scatter': px.scatter}
+
+# Chart of each analysis tab query as (kind, spec), shared by the dashboard
+# and batch_export.py; queries without one are only shown as tables
+TAB_CHARTS = {
+    'demographics': {
+        'gender': ('pie', {'names': 'gender', 'values': 'count', 'title': "Gender Distribution"}),
+        'blood_type': ('bar', {'x': 'blood_type', 'y': 'count', 'title': "Blood Type Distribution"}),
+        'billing': ('bar', {'x': 'gender', 'y': 'avg_billing', 'title': "Avg Billing by Gender", 'labels': {'avg_billing': 'Avg Billing ($)'}}),
+    },
+    'medical_conditions': {
+        'billing': ('bar', {'x': 'medical_condition', 'y': 'avg_billing', 'title': "Avg Billing by Condition"}),
+        'stay': ('bar', {'x': 'medical_condition', 'y': 'avg_stay', 'title': "Avg Length of Stay by Condition"}),
+        'test_results': ('bar', {'barmode': 'group', 'title': "Test Results by Medical Condition"}),
+    },
+    'insurance': {
+        'count': ('pie', {'names': 'insurance_provider', 'values': 'patient_count', 'title': "Patient Distribution by Insurance"}),
+        'billing': ('bar', {'x': 'insurance_provider', 'y': 'avg_billing', 'title': "Avg Billing by Insurance"}),
+        'stay': ('bar', {'x': 'insurance_provider', 'y': 'avg_stay', 'title': "Avg Length of Stay by Insurance"}),
+    },
+    'admission_type': {
+        'count': ('bar', {'x': 'admission_type', 'y': 'count', 'title': "Patient Count by Admission Type"}),
+        'billing': ('bar', {'x': 'admission_type', 'y': 'avg_billing', 'title': "Avg Billing by Admission Type"}),
+        'stay': ('bar', {'x': 'admission_type', 'y': 'avg_stay', 'title': "Avg Length of Stay by Admission Type"}),
+    },
+    'medication': {
+        'count': ('bar', {'x': 'medication', 'y': 'count', 'title': "Patient Count by Medication"}),
+        'billing': ('bar', {'x': 'medication', 'y': 'avg_billing', 'title': "Avg Billing by Medication"}),
+        'stay': ('bar', {'x': 'medication', 'y': 'avg_stay', 'title': "Avg Length of Stay by Medication"}),
+    },
+}
+
+
+# A tab query's result as its chart plots it: test results become one group
+# of bars per condition
+def chart_data(tab, name, df):
+    if (tab, name) == ('medical_conditions', 'test_results'):
+        return df.pivot(index='medical_condition', columns='test_results', values='count').fillna(0)
+    return df
+
+
+# Content hash of a DataFrame: column names, dtypes, index and values
+def frame_hash(df):
+    digest = hashlib.sha256()
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+# Rows to plot for a line or scatter series: per bucket of consecutive points
+# the minimum and maximum of y (plus both ends), so peaks and dips survive
+def _min_max_rows(df, y, max_points):
+    if len(df) <= max_points:
+        return df
+    buckets = max(max_points // 2, 1)
+    bucket = np.arange(len(df)) * buckets // len(df)
+    values = pd.Series(df[y].to_numpy(), index=np.arange(len(df)))
+    keep = np.unique(np.concatenate([
+        values.groupby(bucket).idxmin().to_numpy(),
+        values.groupby(bucket).idxmax().to_numpy(),
+        [0, len(df) - 1],
+    ]))
+    return df.iloc[keep]
+
+
+# Data thinned to about max_points marks. Lines and scatters keep each
+# series' extremes per bucket; bars keep the largest values; pies fold the
+# smallest slices into "Other" so the total is unchanged.
+def downsample(kind, df, spec, max_points=CHART_MAX_POINTS):
+    if len(df) <= max_points:
+        return df
+    if kind == 'pie':
+        names, values = spec.get('names'), spec.get('values')
+        return df if names is None or values is None else _fold_slices(df, names, values, max_points)
+    x, y = spec.get('x'), spec.get('y')
+    if x is None or not isinstance(y, str):
+        return df
+    if kind in ('line', 'scatter'):
+        color = spec.get('color')
+        if color is None:
+            return _min_max_rows(df, y, max_points)
+        groups = df.groupby(color, sort=False, observed=True)
+        per_series = max(max_points // max(groups.ngroups, 1), 2)
+        return pd.concat([_min_max_rows(group, y, per_series) for _, group in groups])
+    if kind == 'bar':
+        return df.loc[df[y].nlargest(max_points).index.sort_values()]
+    return df
+
+
+def _fold_slices(df, names, values, max_points):
+    order = df[values].sort_values(ascending=False).index
+    kept, rest = df.loc[order[:max_points - 1]], df.loc[order[max_points - 1:]]
+    other = pd.DataFrame({names: ['Other'], values: [rest[values].sum()]})
+    return pd.concat([kept[[names, values]].astype({names: object}), other], ignore_index=True)
+
+
+class FigureCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_points=CHART_MAX_POINTS):
+        self.max_bytes = max_bytes
+        self.max_points = max_points
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(max_bytes=int(FIGURE_CACHE_MAX_MB * 1024 * 1024), max_points=CHART_MAX_POINTS)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    # The plotly.express figure of `kind` for df and the keyword spec, built
+    # once per distinct data and spec. Cached figures are shared between
+    # sessions, so callers must not modify them.
+    def figure(self, kind, df, **spec):
+        key = (kind, frame_hash(df), json.dumps(spec, sort_keys=True, default=str))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        plotted = downsample(kind, df, spec, self.max_points)
+        fig = CHARTS[kind](plotted, **spec)
+        if not self.enabled:
+            return fig
+
+        # Estimated from the plotted data, which the figure holds a copy of;
+        # serializing the figure just to measure it would cost as much as a render
+        size = FIGURE_OVERHEAD_BYTES + int(plotted.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return fig
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (size, fig)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    self._bytes -= self._entries.popitem(last=False)[1][0]
+                    self.evictions += 1
+        return fig
+
+    # The chart of a tab query, as listed in TAB_CHARTS
+    def tab_figure(self, tab, name, df):
+        kind, spec = TAB_CHARTS[tab][name]
+        return self.figure(kind, chart_data(tab, name, df), **spec)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Module-level instance so every Streamlit session in the process shares it
+figure_cache = FigureCache.from_env()
@@ -1,13 +1,25 @@
 import streamlit as st
 import pandas as pd
-from sqlalchemy import create_engine
-import plotly.express as px
-import os
 from dotenv import load_dotenv
 
-# Load environment variables
+# Load environment variables before the project modules, which read their
+# settings when imported
 load_dotenv()
 
+from data_sources import create_data_source
+from queries import AGE_RANGE, FILTER_OPTIONS, RECORD_SORT_COLUMNS, TREND_GRAINS, FilterSpec, active_filters, tab_queries, trend_query
+from analytics import run_queries
+from dictionaries import get_dictionaries
+from figures import figure_cache
+from heavy_hitters import get_heavy_hitters
+from profiler import get_profile
+from query_cache import query_cache
+from query_metrics import query_metrics, query_section
+from records import PAGE_ROWS, count_records, read_page
+from sampling import APPROXIMATE_QUERIES, REFINE_POLL_SECONDS, approximate_queries, get_sample, refinement_pending
+from settings import getenv
+from trends import run_trend
+
 # Page configuration
 st.set_page_config(page_title="Healthcare Analysis Dashboard", layout="wide", initial_sidebar_state="expanded")
 
@@ -77,33 +89,75 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Database connection with environment variables
+# Database connection with environment variables, or the Parquet snapshot
+# when DATA_SOURCE=parquet
 @st.cache_resource
 def get_db_connection():
     try:
-        db_user = os.getenv('DB_USER')
-        db_password = os.getenv('DB_PASSWORD')
-        db_host = os.getenv('DB_HOST')
-        db_name = os.getenv('DB_NAME')
-        
-        if not all([db_user, db_password, db_host, db_name]):
+        engine = create_data_source()
+        if engine is None:
             st.error("Database credentials not found. Please set environment variables.")
-            return None
-        
-        engine = create_engine(f'mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}')
         return engine
     except Exception as e:
         st.error(f"Error connecting to database: {e}")
         return None
 
-def execute_query(engine, query):
+# section labels the queries in the Performance panel and metrics export
+# In approximate mode, charts first show sample estimates with ± confidence
+# interval columns and switch to exact answers once they are computed
+def execute_aggregates(engine, specs, section=None):
+    try:
+        with query_section(section or 'dashboard'):
+            if not st.session_state.get('approximate', APPROXIMATE_QUERIES):
+                return run_queries(engine, specs)
+            results, approximate, refining = approximate_queries(engine, specs)
+            sample_rows = get_sample(engine).size if approximate else 0
+    except Exception as e:
+        st.error(f"Error executing query: {e}")
+        return dict.fromkeys(specs)
+    if approximate:
+        note = " Exact answers are loading..." if refining else ""
+        st.caption(f"≈ Estimated from a {sample_rows:,}-row stratified sample; the _ci columns are 95% confidence intervals (±).{note}")
+    if refining:
+        refinement_watch(specs)
+    return results
+
+# Polls while exact answers are computed in the background, then reruns the
+# page so the estimates are replaced
+@st.fragment(run_every=REFINE_POLL_SECONDS)
+def refinement_watch(specs):
+    if not refinement_pending(engine, specs):
+        st.rerun()
+
+# One-pass profile of every column (counts, ranges, nulls, distinct values),
+# shared by all sessions and version-checked; None when it cannot be built
+def data_profile():
     try:
-        df = pd.read_sql(query, engine)
-        return df
+        return get_profile(engine)
     except Exception as e:
         st.error(f"Error executing query: {e}")
         return None
 
+# Distinct count of a text column, marked approximate once it is estimated
+def distinct_count(column):
+    return ('' if column['distinct_exact'] else '≈') + f"{column['distinct']:,}"
+
+# Distinct values and counts of a categorical column from the shared,
+# version-checked dictionaries; None when they cannot be loaded
+def value_counts(column):
+    try:
+        return get_dictionaries(engine).counts(column)
+    except Exception as e:
+        st.error(f"Error executing query: {e}")
+        return None
+
+# Filter options come from the data, falling back to the known values
+def filter_selectbox(column, key):
+    label, all_label, known_values = FILTER_OPTIONS[column]
+    counts = value_counts(column)
+    values = known_values if counts is None else counts[column].tolist()
+    return st.selectbox(label, [all_label] + values, key=key)
+
 # Title
 st.markdown("<h1 style='text-align: center;'>🏥 Healthcare Analysis Dashboard</h1>", unsafe_allow_html=True)
 st.markdown("<p style='text-align: center;'>Interactive analysis of patient records</p>", unsafe_allow_html=True)
@@ -115,6 +169,9 @@ if engine is None:
     st.error("Failed to connect to database. Please check your MySQL connection settings.")
     st.stop()
 
+st.sidebar.toggle("≈ Approximate answers", value=APPROXIMATE_QUERIES, key='approximate',
+                  help="Answer the analysis sections from a stratified sample with confidence intervals while the exact answers load in the background")
+
 # Dashboard Overview
 st.markdown("""
     <div style='background-color: black; padding: 20px; border-radius: 10px; margin: 20px 0; border: 1px solid #333333;'>
@@ -146,20 +203,21 @@ st.markdown("<h3 style='color: #ffffff; margin-bottom: 30px;'>🔎 Dataset Overv
 # Header stats - COMPLETE DATASET
 col1, col2, col3, col4 = st.columns(4)
 
-total_records = execute_query(engine, "SELECT COUNT(*) as count FROM patients")
-date_range = execute_query(engine, "SELECT MIN(date_of_admission) as min_date, MAX(date_of_admission) as max_date FROM patients")
+profile = data_profile()
 
-if total_records is not None:
-    col1.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>" + f"{total_records['count'][0]:,}" + "</div><div style='color: #888888; font-size: 0.9em;'>📈 Total Records</div></div>", unsafe_allow_html=True)
+if profile is not None:
+    col1.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>" + f"{profile.rows:,}" + "</div><div style='color: #888888; font-size: 0.9em;'>📈 Total Records</div></div>", unsafe_allow_html=True)
 
-if date_range is not None:
-    min_date = date_range['min_date'][0]
-    max_date = date_range['max_date'][0]
-    date_diff = (max_date - min_date).days / 365
-    col2.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>" + f"{int(date_diff)} Years" + "</div><div style='color: #888888; font-size: 0.9em;'>📅 Date Range</div></div>", unsafe_allow_html=True)
+    admissions = profile.column('date_of_admission')
+    if admissions['min'] is not None:
+        min_date = pd.to_datetime(admissions['min'])
+        max_date = pd.to_datetime(admissions['max'])
+        date_diff = (max_date - min_date).days / 365
+        col2.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>" + f"{int(date_diff)} Years" + "</div><div style='color: #888888; font-size: 0.9em;'>📅 Date Range</div></div>", unsafe_allow_html=True)
 
-col3.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>15</div><div style='color: #888888; font-size: 0.9em;'>📋 Total Columns</div></div>", unsafe_allow_html=True)
-col4.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>100%</div><div style='color: #888888; font-size: 0.9em;'>✅ Data Quality</div></div>", unsafe_allow_html=True)
+    col3.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>" + f"{len(profile.columns)}" + "</div><div style='color: #888888; font-size: 0.9em;'>📋 Total Columns</div></div>", unsafe_allow_html=True)
+    # Share of non-null cells across all columns
+    col4.markdown("<div style='text-align: center;'><div style='font-size: 2.0em; color: #00d4ff;'>" + f"{profile.completeness:.1%}" + "</div><div style='color: #888888; font-size: 0.9em;'>✅ Data Quality</div></div>", unsafe_allow_html=True)
 
 # Dataset columns section
 st.markdown("<h3 style='color: #ffffff; margin-top: 40px; margin-bottom: 20px;'>📋 Dataset Columns</h2>", unsafe_allow_html=True)
@@ -185,460 +243,670 @@ columns_info = [
     ("test_results", "🔬 Test Results"),
 ]
 
-# Initialize session state for selected column
-if 'selected_column' not in st.session_state:
-    st.session_state.selected_column = None
-
-# Create columns for buttons
-cols = st.columns(4)
-for idx, (col_key, col_label) in enumerate(columns_info):
-    with cols[idx % 4]:
-        if st.button(col_label, key=col_key, width='stretch'):
-            if st.session_state.selected_column == col_key:
-                st.session_state.selected_column = None
-            else:
-                st.session_state.selected_column = col_key
-
-st.divider()
-
-# Display details for selected column only if clicked
-selected = st.session_state.selected_column
-
-if selected == 'patient_id':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>👤 Patient ID</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Integer (Auto-increment)")
-    st.markdown("**Range:** 1 - 55,392")
-    st.markdown("**Description:** Unique identifier for each patient. Automatically assigned sequential number for each patient record.")
-
-elif selected == 'name':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>📝 Name</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (String)")
-    st.markdown("**Null Values:** 0")
-    st.markdown("**Description:** Full name of the patient. Synthetic names generated for privacy.")
-
-elif selected == 'age':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🎂 Age</div>", unsafe_allow_html=True)
-    age_stats = execute_query(engine, "SELECT MIN(age) as min_age, MAX(age) as max_age, AVG(age) as avg_age FROM patients")
-    if age_stats is not None:
+# Column grid and details rerun on their own when a column button is clicked
+@st.fragment
+def dataset_columns():
+    # Initialize session state for selected column
+    if 'selected_column' not in st.session_state:
+        st.session_state.selected_column = None
+
+    # Create columns for buttons
+    cols = st.columns(4)
+    for idx, (col_key, col_label) in enumerate(columns_info):
+        with cols[idx % 4]:
+            if st.button(col_label, key=col_key, width='stretch'):
+                if st.session_state.selected_column == col_key:
+                    st.session_state.selected_column = None
+                else:
+                    st.session_state.selected_column = col_key
+
+    st.divider()
+
+    # Display details for selected column only if clicked
+    selected = st.session_state.selected_column
+
+    if selected == 'patient_id':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>👤 Patient ID</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Integer (Auto-increment)")
+        if profile is not None:
+            ids = profile.column('patient_id')
+            st.markdown(f"**Range:** {ids['min']:,} - {ids['max']:,}")
+        st.markdown("**Description:** Unique identifier for each patient. Automatically assigned sequential number for each patient record.")
+
+    elif selected == 'name':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>📝 Name</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (String)")
+        if profile is not None:
+            names = profile.column('name')
+            st.markdown(f"**Null Values:** {names['nulls']:,}")
+            st.markdown(f"**Unique Names:** {distinct_count(names)}")
+        st.markdown("**Description:** Full name of the patient. Synthetic names generated for privacy.")
+
+    elif selected == 'age':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🎂 Age</div>", unsafe_allow_html=True)
+        if profile is not None:
+            age_stats = profile.column('age')
+            st.markdown("**Data Type:** Integer")
+            st.markdown(f"**Range:** {int(age_stats['min'])} - {int(age_stats['max'])} years")
+            st.markdown(f"**Average:** {age_stats['mean']:.1f} years")
+        st.markdown("**Description:** Patient's age at time of admission.")
+
+    elif selected == 'gender':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>👫 Gender</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (Categorical)")
+        gender_dist = value_counts('gender')
+        if gender_dist is not None:
+            st.markdown(f"**Values:** {', '.join(gender_dist['gender'].tolist())}")
+            for idx, row in gender_dist.iterrows():
+                total = profile.rows if profile is not None else gender_dist['count'].sum()
+                pct = (row['count'] / total * 100)
+                st.markdown(f"**{row['gender']}:** {row['count']:,} ({pct:.1f}%)")
+        st.markdown("**Description:** Patient's gender classification.")
+
+    elif selected == 'blood_type':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🩸 Blood Type</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (Categorical)")
+        blood_types = value_counts('blood_type')
+        if blood_types is not None:
+            st.markdown(f"**Unique Values:** {len(blood_types)}")
+            st.markdown(f"**Types:** {', '.join(blood_types['blood_type'].tolist())}")
+        st.markdown("**Description:** Patient's blood type classification. Fairly evenly distributed across all types.")
+
+    elif selected == 'medical_condition':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🏥 Medical Condition</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (Categorical)")
+        conditions_unique = value_counts('medical_condition')
+        if conditions_unique is not None:
+            st.markdown(f"**Unique Conditions:** {len(conditions_unique)}")
+            st.markdown(f"**Types:** {', '.join(conditions_unique['medical_condition'].tolist())}")
+        st.markdown("**Description:** Primary medical condition/diagnosis of patient.")
+
+    elif selected == 'date_admission':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>📅 Date of Admission</div>", unsafe_allow_html=True)
+        if profile is not None:
+            date_info = profile.column('date_of_admission')
+            st.markdown("**Data Type:** Date (YYYY-MM-DD)")
+            st.markdown(f"**Range:** {date_info['min']} to {date_info['max']}")
+        st.markdown("**Description:** Date patient was admitted to hospital.")
+
+    elif selected == 'doctor':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>👨‍⚕️ Doctor</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (String)")
+        if profile is not None:
+            st.markdown(f"**Unique Doctors:** {distinct_count(profile.column('doctor'))}")
+        st.markdown("**Description:** Name of doctor responsible for patient care.")
+
+    elif selected == 'hospital':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🏨 Hospital</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (String)")
+        if profile is not None:
+            st.markdown(f"**Unique Hospitals:** {distinct_count(profile.column('hospital'))}")
+        st.markdown("**Description:** Healthcare facility where patient was admitted.")
+
+    elif selected == 'insurance':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>💳 Insurance Provider</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (Categorical)")
+        insurances_unique = value_counts('insurance_provider')
+        if insurances_unique is not None:
+            st.markdown(f"**Providers:** {', '.join(insurances_unique['insurance_provider'].tolist())}")
+        st.markdown("**Description:** Patient's insurance provider.")
+
+    elif selected == 'billing':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>💰 Billing Amount</div>", unsafe_allow_html=True)
+        if profile is not None:
+            billing_stats = profile.column('billing_amount')
+            st.markdown("**Data Type:** Decimal (Currency)")
+            st.markdown(f"**Range:** ${billing_stats['min']:,.2f} - ${billing_stats['max']:,.2f}")
+            st.markdown(f"**Average:** ${billing_stats['mean']:,.2f}")
+        st.markdown("**Description:** Total billing amount for healthcare services.")
+
+    elif selected == 'room':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🚪 Room Number</div>", unsafe_allow_html=True)
         st.markdown("**Data Type:** Integer")
-        st.markdown(f"**Range:** {int(age_stats['min_age'][0])} - {int(age_stats['max_age'][0])} years")
-        st.markdown(f"**Average:** {age_stats['avg_age'][0]:.1f} years")
-    st.markdown("**Description:** Patient's age at time of admission.")
-
-elif selected == 'gender':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>👫 Gender</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (Categorical)")
-    st.markdown("**Values:** Male, Female")
-    gender_dist = execute_query(engine, "SELECT gender, COUNT(*) as count FROM patients GROUP BY gender")
-    if gender_dist is not None:
-        for idx, row in gender_dist.iterrows():
-            total = total_records['count'][0] if total_records is not None else 1
-            pct = (row['count'] / total * 100)
-            st.markdown(f"**{row['gender']}:** {row['count']:,} ({pct:.1f}%)")
-    st.markdown("**Description:** Patient's gender classification.")
-
-elif selected == 'blood_type':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🩸 Blood Type</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (Categorical)")
-    blood_types = execute_query(engine, "SELECT DISTINCT blood_type FROM patients ORDER BY blood_type")
-    if blood_types is not None:
-        st.markdown(f"**Unique Values:** {len(blood_types)}")
-        st.markdown(f"**Types:** {', '.join(blood_types['blood_type'].tolist())}")
-    st.markdown("**Description:** Patient's blood type classification. Fairly evenly distributed across all types.")
-
-elif selected == 'medical_condition':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🏥 Medical Condition</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (Categorical)")
-    conditions_unique = execute_query(engine, "SELECT DISTINCT medical_condition FROM patients ORDER BY medical_condition")
-    if conditions_unique is not None:
-        st.markdown(f"**Unique Conditions:** {len(conditions_unique)}")
-        st.markdown(f"**Types:** {', '.join(conditions_unique['medical_condition'].tolist())}")
-    st.markdown("**Description:** Primary medical condition/diagnosis of patient.")
-
-elif selected == 'date_admission':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>📅 Date of Admission</div>", unsafe_allow_html=True)
-    date_info = execute_query(engine, "SELECT MIN(date_of_admission) as min_date, MAX(date_of_admission) as max_date FROM patients")
-    if date_info is not None:
+        if profile is not None:
+            room_info = profile.column('room_number')
+            st.markdown(f"**Range:** {int(room_info['min'])} - {int(room_info['max'])}")
+        st.markdown("**Description:** Hospital room number where patient was accommodated.")
+
+    elif selected == 'admission_type':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>📋 Admission Type</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (Categorical)")
+        adm_types_unique = value_counts('admission_type')
+        if adm_types_unique is not None:
+            st.markdown(f"**Types:** {', '.join(adm_types_unique['admission_type'].tolist())}")
+        st.markdown("**Description:** Circumstances of hospital admission (Emergency, Elective, Urgent).")
+
+    elif selected == 'discharge_date':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🚪 Discharge Date</div>", unsafe_allow_html=True)
         st.markdown("**Data Type:** Date (YYYY-MM-DD)")
-        st.markdown(f"**Range:** {date_info['min_date'][0]} to {date_info['max_date'][0]}")
-    st.markdown("**Description:** Date patient was admitted to hospital.")
-
-elif selected == 'doctor':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>👨‍⚕️ Doctor</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (String)")
-    doctor_count = execute_query(engine, "SELECT COUNT(DISTINCT doctor) as count FROM patients")
-    if doctor_count is not None:
-        st.markdown(f"**Unique Doctors:** {doctor_count['count'][0]:,}")
-    st.markdown("**Description:** Name of doctor responsible for patient care.")
-
-elif selected == 'hospital':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🏨 Hospital</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (String)")
-    hospital_count = execute_query(engine, "SELECT COUNT(DISTINCT hospital) as count FROM patients")
-    if hospital_count is not None:
-        st.markdown(f"**Unique Hospitals:** {hospital_count['count'][0]:,}")
-    st.markdown("**Description:** Healthcare facility where patient was admitted.")
-
-elif selected == 'insurance':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>💳 Insurance Provider</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (Categorical)")
-    insurances_unique = execute_query(engine, "SELECT DISTINCT insurance_provider FROM patients ORDER BY insurance_provider")
-    if insurances_unique is not None:
-        st.markdown(f"**Providers:** {', '.join(insurances_unique['insurance_provider'].tolist())}")
-    st.markdown("**Description:** Patient's insurance provider.")
-
-elif selected == 'billing':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>💰 Billing Amount</div>", unsafe_allow_html=True)
-    billing_stats = execute_query(engine, "SELECT MIN(billing_amount) as min_bill, MAX(billing_amount) as max_bill, AVG(billing_amount) as avg_bill FROM patients")
-    if billing_stats is not None:
-        st.markdown("**Data Type:** Decimal (Currency)")
-        st.markdown(f"**Range:** ${billing_stats['min_bill'][0]:,.2f} - ${billing_stats['max_bill'][0]:,.2f}")
-        st.markdown(f"**Average:** ${billing_stats['avg_bill'][0]:,.2f}")
-    st.markdown("**Description:** Total billing amount for healthcare services.")
-
-elif selected == 'room':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🚪 Room Number</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Integer")
-    room_info = execute_query(engine, "SELECT MIN(room_number) as min_room, MAX(room_number) as max_room FROM patients")
-    if room_info is not None:
-        st.markdown(f"**Range:** {int(room_info['min_room'][0])} - {int(room_info['max_room'][0])}")
-    st.markdown("**Description:** Hospital room number where patient was accommodated.")
-
-elif selected == 'admission_type':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>📋 Admission Type</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (Categorical)")
-    adm_types_unique = execute_query(engine, "SELECT DISTINCT admission_type FROM patients ORDER BY admission_type")
-    if adm_types_unique is not None:
-        st.markdown(f"**Types:** {', '.join(adm_types_unique['admission_type'].tolist())}")
-    st.markdown("**Description:** Circumstances of hospital admission (Emergency, Elective, Urgent).")
-
-elif selected == 'discharge_date':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🚪 Discharge Date</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Date (YYYY-MM-DD)")
-    discharge_info = execute_query(engine, "SELECT MIN(discharge_date) as min_date, MAX(discharge_date) as max_date FROM patients")
-    if discharge_info is not None:
-        st.markdown(f"**Range:** {discharge_info['min_date'][0]} to {discharge_info['max_date'][0]}")
-    st.markdown("**Description:** Date patient was discharged from hospital. Used to calculate length of stay.")
-
-elif selected == 'medication':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>💊 Medication</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (Categorical)")
-    meds_unique = execute_query(engine, "SELECT DISTINCT medication FROM patients ORDER BY medication")
-    if meds_unique is not None:
-        st.markdown(f"**Medications:** {', '.join(meds_unique['medication'].tolist())}")
-    st.markdown("**Description:** Medication prescribed/administered to patient.")
-
-elif selected == 'test_results':
-    st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🔬 Test Results</div>", unsafe_allow_html=True)
-    st.markdown("**Data Type:** Text (Categorical)")
-    st.markdown("**Values:** Normal, Abnormal, Inconclusive")
-    st.markdown("**Description:** Results of medical tests conducted during admission.")
+        if profile is not None:
+            discharge_info = profile.column('discharge_date')
+            st.markdown(f"**Range:** {discharge_info['min']} to {discharge_info['max']}")
+        st.markdown("**Description:** Date patient was discharged from hospital. Used to calculate length of stay.")
+
+    elif selected == 'medication':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>💊 Medication</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (Categorical)")
+        meds_unique = value_counts('medication')
+        if meds_unique is not None:
+            st.markdown(f"**Medications:** {', '.join(meds_unique['medication'].tolist())}")
+        st.markdown("**Description:** Medication prescribed/administered to patient.")
+
+    elif selected == 'test_results':
+        st.markdown("<div style='color: #00d4ff; font-size: 1.4em; margin-bottom: 20px;'>🔬 Test Results</div>", unsafe_allow_html=True)
+        st.markdown("**Data Type:** Text (Categorical)")
+        test_results = value_counts('test_results')
+        if test_results is not None:
+            st.markdown(f"**Values:** {', '.join(test_results['test_results'].tolist())}")
+        st.markdown("**Description:** Results of medical tests conducted during admission.")
+
+dataset_columns()
 
 # ===== TABS FOR ANALYSIS SECTIONS =====
 st.markdown("<h3 style='color: #ffffff; margin-top: 50px; margin-bottom: 20px;'>📊 Analysis Sections</h2>", unsafe_allow_html=True)
 st.markdown("<p style='color: #888888; margin-bottom: 20px;'>Click on any analysis section below to explore detailed insights</p>", unsafe_allow_html=True)
 
 # Analysis tabs as radio buttons
-analysis_tabs = ["👥 Demographics", "🏥 Medical Conditions", "💳 Insurance", "📋 Admission Type", "💊 Medication"]
-
-if 'selected_analysis' not in st.session_state:
-    st.session_state.selected_analysis = None
-
-# Create radio button with horizontal layout
-selected_tab = st.radio(
-    "Select Analysis",
-    options=range(len(analysis_tabs)),
-    format_func=lambda x: analysis_tabs[x],
-    horizontal=True,
-    label_visibility="collapsed"
-)
-
-# Update session state
-st.session_state.selected_analysis = selected_tab
-
-st.divider()
-
-# Get selected analysis
-selected_analysis = st.session_state.selected_analysis
+analysis_tabs = ["👥 Demographics", "🏥 Medical Conditions", "💳 Insurance", "📋 Admission Type", "💊 Medication", "📈 Trends", "🩺 Doctors & Hospitals", "🗂️ Patient Records"]
 
 # ===== DEMOGRAPHICS ANALYSIS =====
-if selected_analysis == 0:
+# Each tab is its own fragment, so a filter change reruns only that tab's queries
+@st.fragment
+def demographics_tab():
         # Create two columns: left for content, right for filters
         content_col, filter_col = st.columns([3, 1])
         
         with filter_col:
             st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Filters</h3>", unsafe_allow_html=True)
-            demo_condition = st.selectbox("Medical Condition", ['All Conditions', 'Cancer', 'Diabetes', 'Obesity', 'Asthma', 'Hypertension', 'Arthritis'], key="demo_condition")
-            demo_insurance = st.selectbox("Insurance Provider", ['All Providers', 'Medicare', 'Blue Cross', 'Cigna', 'Aetna', 'UnitedHealthcare'], key="demo_insurance")
-            demo_admission = st.selectbox("Admission Type", ['All Types', 'Emergency', 'Elective', 'Urgent'], key="demo_admission")
+            demo_condition = filter_selectbox('medical_condition', key="demo_condition")
+            demo_insurance = filter_selectbox('insurance_provider', key="demo_insurance")
+            demo_admission = filter_selectbox('admission_type', key="demo_admission")
         
         with content_col:
-            # Build where clause for Demographics filters
-            demo_where = "WHERE 1=1"
-            if demo_condition != 'All Conditions':
-                demo_where += f" AND medical_condition = '{demo_condition}'"
-            if demo_insurance != 'All Providers':
-                demo_where += f" AND insurance_provider = '{demo_insurance}'"
-            if demo_admission != 'All Types':
-                demo_where += f" AND admission_type = '{demo_admission}'"
+            # Queries for Demographics filters
+            demo_queries = tab_queries('demographics', active_filters({
+                'medical_condition': demo_condition,
+                'insurance_provider': demo_insurance,
+                'admission_type': demo_admission,
+            }))
+            demo_results = execute_aggregates(engine, demo_queries, 'demographics')
             
             # Age Statistics
             st.markdown("<h3 style='color: #00d4ff;'>Age Statistics</h3>", unsafe_allow_html=True)
-            demo_age_stats = execute_query(engine, f"SELECT MIN(age) as min_age, MAX(age) as max_age, AVG(age) as avg_age FROM patients {demo_where if demo_where else ''}")
+            demo_age_stats = demo_results['age_stats']
             if demo_age_stats is not None:
                 age_table_data = {
                     'Metric': ['Min Age', 'Max Age', 'Avg Age'],
                     'Value': [str(int(demo_age_stats['min_age'][0])), str(int(demo_age_stats['max_age'][0])), str(round(demo_age_stats['avg_age'][0], 1))]
                 }
+                if 'avg_age_ci' in demo_age_stats:
+                    age_table_data['Value'][2] += f" ± {demo_age_stats['avg_age_ci'][0]:.1f}"
                 st.dataframe(pd.DataFrame(age_table_data), width='stretch')
             
             # Gender Distribution
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Gender Distribution</h3>", unsafe_allow_html=True)
-            demo_gender = execute_query(engine, f"SELECT gender, COUNT(*) as count FROM patients {demo_where if demo_where else ''} GROUP BY gender")
+            demo_gender = demo_results['gender']
             if demo_gender is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(demo_gender, width='stretch')
                 with col2:
-                    fig = px.pie(demo_gender, names='gender', values='count', title="Gender Distribution")
+                    fig = figure_cache.tab_figure('demographics', 'gender', demo_gender)
                     st.plotly_chart(fig, width='stretch')
             
             # Blood Type Distribution
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Blood Type Distribution</h3>", unsafe_allow_html=True)
-            demo_blood = execute_query(engine, f"SELECT blood_type, COUNT(*) as count FROM patients {demo_where if demo_where else ''} GROUP BY blood_type ORDER BY count DESC")
+            demo_blood = demo_results['blood_type']
             if demo_blood is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(demo_blood, width='stretch')
                 with col2:
-                    fig = px.bar(demo_blood, x='blood_type', y='count', title="Blood Type Distribution")
+                    fig = figure_cache.tab_figure('demographics', 'blood_type', demo_blood)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Billing by Gender
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Billing by Gender</h3>", unsafe_allow_html=True)
-            demo_billing = execute_query(engine, f"SELECT gender, ROUND(AVG(billing_amount), 2) as avg_billing FROM patients {demo_where if demo_where else ''} GROUP BY gender")
+            demo_billing = demo_results['billing']
             if demo_billing is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(demo_billing, width='stretch')
                 with col2:
-                    fig = px.bar(demo_billing, x='gender', y='avg_billing', title="Avg Billing by Gender", labels={'avg_billing': 'Avg Billing ($)'})
+                    fig = figure_cache.tab_figure('demographics', 'billing', demo_billing)
                     st.plotly_chart(fig, width='stretch')
 
 # ===== MEDICAL CONDITIONS ANALYSIS =====
-if selected_analysis == 1:
+@st.fragment
+def medical_conditions_tab():
         # Create two columns: left for content, right for filters
         content_col, filter_col = st.columns([3, 1])
         
         with filter_col:
             st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Filters</h3>", unsafe_allow_html=True)
-            med_insurance = st.selectbox("Insurance Provider", ['All Providers', 'Medicare', 'Blue Cross', 'Cigna', 'Aetna', 'UnitedHealthcare'], key="med_insurance")
-            med_gender = st.selectbox("Gender", ['All', 'Male', 'Female'], key="med_gender")
-            med_age_range = st.slider("Age Range", min_value=13, max_value=89, value=(13, 89), key="med_age")
-            med_admission = st.selectbox("Admission Type", ['All Types', 'Emergency', 'Elective', 'Urgent'], key="med_admission")
+            med_insurance = filter_selectbox('insurance_provider', key="med_insurance")
+            med_gender = filter_selectbox('gender', key="med_gender")
+            med_age_range = st.slider("Age Range", min_value=AGE_RANGE[0], max_value=AGE_RANGE[1], value=AGE_RANGE, key="med_age")
+            med_admission = filter_selectbox('admission_type', key="med_admission")
         
         with content_col:
-            # Build where clause for Medical Conditions filters
-            med_where = "WHERE 1=1"
-            if med_insurance != 'All Providers':
-                med_where += f" AND insurance_provider = '{med_insurance}'"
-            if med_gender != 'All':
-                med_where += f" AND gender = '{med_gender}'"
-            if med_admission != 'All Types':
-                med_where += f" AND admission_type = '{med_admission}'"
-            med_where += f" AND age >= {med_age_range[0]} AND age <= {med_age_range[1]}"
+            # Queries for Medical Conditions filters
+            med_queries = tab_queries('medical_conditions', active_filters({
+                'insurance_provider': med_insurance,
+                'gender': med_gender,
+                'admission_type': med_admission,
+            }), age_range=med_age_range)
+            med_results = execute_aggregates(engine, med_queries, 'medical_conditions')
 
             # Average Billing by Medical Condition
             st.markdown("<h3 style='color: #00d4ff;'>Average Billing by Medical Condition</h3>", unsafe_allow_html=True)
-            med_billing = execute_query(engine, f"SELECT medical_condition, ROUND(AVG(billing_amount), 2) as avg_billing, COUNT(*) as patient_count FROM patients {med_where} GROUP BY medical_condition ORDER BY avg_billing DESC")
+            med_billing = med_results['billing']
             if med_billing is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(med_billing, width='stretch')
                 with col2:
-                    fig = px.bar(med_billing, x='medical_condition', y='avg_billing', title="Avg Billing by Condition")
+                    fig = figure_cache.tab_figure('medical_conditions', 'billing', med_billing)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Length of Stay by Medical Condition
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Length of Stay by Medical Condition</h3>", unsafe_allow_html=True)
-            med_los = execute_query(engine, f"SELECT medical_condition, ROUND(AVG(DATEDIFF(discharge_date, date_of_admission))) as avg_stay, COUNT(*) as patient_count FROM patients {med_where} GROUP BY medical_condition ORDER BY avg_stay DESC")
+            med_los = med_results['stay']
             if med_los is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(med_los, width='stretch')
                 with col2:
-                    fig = px.bar(med_los, x='medical_condition', y='avg_stay', title="Avg Length of Stay by Condition")
+                    fig = figure_cache.tab_figure('medical_conditions', 'stay', med_los)
                     st.plotly_chart(fig, width='stretch')
             
             # Test Results Distribution by Medical Condition
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Test Results Distribution by Medical Condition</h3>", unsafe_allow_html=True)
-            med_test = execute_query(engine, f"SELECT medical_condition, test_results, COUNT(*) as count FROM patients {med_where} GROUP BY medical_condition, test_results ORDER BY medical_condition, test_results")
+            med_test = med_results['test_results']
             if med_test is not None:
                 st.dataframe(med_test, width='stretch')
                 
-                # Pivot for chart
-                med_test_pivot = med_test.pivot(index='medical_condition', columns='test_results', values='count').fillna(0)
-                fig = px.bar(med_test_pivot, barmode='group', title="Test Results by Medical Condition")
+                # Grouped bars per condition
+                fig = figure_cache.tab_figure('medical_conditions', 'test_results', med_test)
                 st.plotly_chart(fig, width='stretch')
 
 # ===== INSURANCE PROVIDER ANALYSIS =====
-if selected_analysis == 2:
+@st.fragment
+def insurance_tab():
         # Create two columns: left for content, right for filters
         content_col, filter_col = st.columns([3, 1])
         
         with filter_col:
             st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Filters</h3>", unsafe_allow_html=True)
-            ins_condition = st.selectbox("Medical Condition", ['All Conditions', 'Cancer', 'Diabetes', 'Obesity', 'Asthma', 'Hypertension', 'Arthritis'], key="ins_condition")
-            ins_gender = st.selectbox("Gender", ['All', 'Male', 'Female'], key="ins_gender")
-            ins_admission = st.selectbox("Admission Type", ['All Types', 'Emergency', 'Elective', 'Urgent'], key="ins_admission")
+            ins_condition = filter_selectbox('medical_condition', key="ins_condition")
+            ins_gender = filter_selectbox('gender', key="ins_gender")
+            ins_admission = filter_selectbox('admission_type', key="ins_admission")
         
         with content_col:
-            # Build where clause for Insurance filters
-            ins_where = "WHERE 1=1"
-            if ins_condition != 'All Conditions':
-                ins_where += f" AND medical_condition = '{ins_condition}'"
-            if ins_gender != 'All':
-                ins_where += f" AND gender = '{ins_gender}'"
-            if ins_admission != 'All Types':
-                ins_where += f" AND admission_type = '{ins_admission}'"
+            # Queries for Insurance filters
+            ins_queries = tab_queries('insurance', active_filters({
+                'medical_condition': ins_condition,
+                'gender': ins_gender,
+                'admission_type': ins_admission,
+            }))
+            ins_results = execute_aggregates(engine, ins_queries, 'insurance')
             
             # Patient Distribution by Insurance Provider
             st.markdown("<h3 style='color: #00d4ff;'>Patient Distribution by Insurance Provider</h3>", unsafe_allow_html=True)
-            ins_count = execute_query(engine, f"SELECT insurance_provider, COUNT(*) as patient_count FROM patients {ins_where} GROUP BY insurance_provider ORDER BY patient_count DESC")
+            ins_count = ins_results['count']
             if ins_count is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(ins_count, width='stretch')
                 with col2:
-                    fig = px.pie(ins_count, names='insurance_provider', values='patient_count', title="Patient Distribution by Insurance")
+                    fig = figure_cache.tab_figure('insurance', 'count', ins_count)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Billing by Insurance Provider
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Billing by Insurance Provider</h3>", unsafe_allow_html=True)
-            ins_billing = execute_query(engine, f"SELECT insurance_provider, ROUND(AVG(billing_amount), 2) as avg_billing FROM patients {ins_where} GROUP BY insurance_provider ORDER BY avg_billing DESC")
+            ins_billing = ins_results['billing']
             if ins_billing is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(ins_billing, width='stretch')
                 with col2:
-                    fig = px.bar(ins_billing, x='insurance_provider', y='avg_billing', title="Avg Billing by Insurance")
+                    fig = figure_cache.tab_figure('insurance', 'billing', ins_billing)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Length of Stay by Insurance Provider
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Length of Stay by Insurance Provider</h3>", unsafe_allow_html=True)
-            ins_los = execute_query(engine, f"SELECT insurance_provider, ROUND(AVG(DATEDIFF(discharge_date, date_of_admission))) as avg_stay FROM patients {ins_where} GROUP BY insurance_provider ORDER BY avg_stay DESC")
+            ins_los = ins_results['stay']
             if ins_los is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(ins_los, width='stretch')
                 with col2:
-                    fig = px.bar(ins_los, x='insurance_provider', y='avg_stay', title="Avg Length of Stay by Insurance")
+                    fig = figure_cache.tab_figure('insurance', 'stay', ins_los)
                     st.plotly_chart(fig, width='stretch')
 
 # ===== ADMISSION TYPE ANALYSIS =====
-if selected_analysis == 3:
+@st.fragment
+def admission_type_tab():
         # Create two columns: left for content, right for filters
         content_col, filter_col = st.columns([3, 1])
         
         with filter_col:
             st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Filters</h3>", unsafe_allow_html=True)
-            adm_condition = st.selectbox("Medical Condition", ['All Conditions', 'Cancer', 'Diabetes', 'Obesity', 'Asthma', 'Hypertension', 'Arthritis'], key="adm_condition")
-            adm_insurance = st.selectbox("Insurance Provider", ['All Providers', 'Medicare', 'Blue Cross', 'Cigna', 'Aetna', 'UnitedHealthcare'], key="adm_insurance")
-            adm_gender = st.selectbox("Gender", ['All', 'Male', 'Female'], key="adm_gender")
+            adm_condition = filter_selectbox('medical_condition', key="adm_condition")
+            adm_insurance = filter_selectbox('insurance_provider', key="adm_insurance")
+            adm_gender = filter_selectbox('gender', key="adm_gender")
         
         with content_col:
-            # Build where clause for Admission Type filters
-            adm_where = "WHERE 1=1"
-            if adm_condition != 'All Conditions':
-                adm_where += f" AND medical_condition = '{adm_condition}'"
-            if adm_insurance != 'All Providers':
-                adm_where += f" AND insurance_provider = '{adm_insurance}'"
-            if adm_gender != 'All':
-                adm_where += f" AND gender = '{adm_gender}'"
+            # Queries for Admission Type filters
+            adm_queries = tab_queries('admission_type', active_filters({
+                'medical_condition': adm_condition,
+                'insurance_provider': adm_insurance,
+                'gender': adm_gender,
+            }))
+            adm_results = execute_aggregates(engine, adm_queries, 'admission_type')
             
             # Admission Type Distribution
             st.markdown("<h3 style='color: #00d4ff;'>Admission Type Distribution</h3>", unsafe_allow_html=True)
-            adm_dist = execute_query(engine, f"SELECT admission_type, COUNT(*) as count FROM patients {adm_where} GROUP BY admission_type ORDER BY count DESC")
+            adm_dist = adm_results['count']
             if adm_dist is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(adm_dist, width='stretch')
                 with col2:
-                    fig = px.bar(adm_dist, x='admission_type', y='count', title="Patient Count by Admission Type")
+                    fig = figure_cache.tab_figure('admission_type', 'count', adm_dist)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Billing by Admission Type
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Billing by Admission Type</h3>", unsafe_allow_html=True)
-            adm_billing = execute_query(engine, f"SELECT admission_type, ROUND(AVG(billing_amount), 2) as avg_billing FROM patients {adm_where} GROUP BY admission_type ORDER BY avg_billing DESC")
+            adm_billing = adm_results['billing']
             if adm_billing is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(adm_billing, width='stretch')
                 with col2:
-                    fig = px.bar(adm_billing, x='admission_type', y='avg_billing', title="Avg Billing by Admission Type")
+                    fig = figure_cache.tab_figure('admission_type', 'billing', adm_billing)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Length of Stay by Admission Type
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Length of Stay by Admission Type</h3>", unsafe_allow_html=True)
-            adm_los = execute_query(engine, f"SELECT admission_type, ROUND(AVG(DATEDIFF(discharge_date, date_of_admission))) as avg_stay FROM patients {adm_where} GROUP BY admission_type ORDER BY avg_stay DESC")
+            adm_los = adm_results['stay']
             if adm_los is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(adm_los, width='stretch')
                 with col2:
-                    fig = px.bar(adm_los, x='admission_type', y='avg_stay', title="Avg Length of Stay by Admission Type")
+                    fig = figure_cache.tab_figure('admission_type', 'stay', adm_los)
                     st.plotly_chart(fig, width='stretch')
 
 # ===== MEDICATION ANALYSIS =====
-if selected_analysis == 4:
+@st.fragment
+def medication_tab():
         # Create two columns: left for content, right for filters
         content_col, filter_col = st.columns([3, 1])
         
         with filter_col:
             st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Filters</h3>", unsafe_allow_html=True)
-            med_tab_condition = st.selectbox("Medical Condition", ['All Conditions', 'Cancer', 'Diabetes', 'Obesity', 'Asthma', 'Hypertension', 'Arthritis'], key="med_tab_condition")
-            med_tab_insurance = st.selectbox("Insurance Provider", ['All Providers', 'Medicare', 'Blue Cross', 'Cigna', 'Aetna', 'UnitedHealthcare'], key="med_tab_insurance")
-            med_tab_gender = st.selectbox("Gender", ['All', 'Male', 'Female'], key="med_tab_gender")
+            med_tab_condition = filter_selectbox('medical_condition', key="med_tab_condition")
+            med_tab_insurance = filter_selectbox('insurance_provider', key="med_tab_insurance")
+            med_tab_gender = filter_selectbox('gender', key="med_tab_gender")
         
         with content_col:
-            # Build where clause for Medication filters
-            med_tab_where = "WHERE 1=1"
-            if med_tab_condition != 'All Conditions':
-                med_tab_where += f" AND medical_condition = '{med_tab_condition}'"
-            if med_tab_insurance != 'All Providers':
-                med_tab_where += f" AND insurance_provider = '{med_tab_insurance}'"
-            if med_tab_gender != 'All':
-                med_tab_where += f" AND gender = '{med_tab_gender}'"
+            # Queries for Medication filters
+            med_tab_queries = tab_queries('medication', active_filters({
+                'medical_condition': med_tab_condition,
+                'insurance_provider': med_tab_insurance,
+                'gender': med_tab_gender,
+            }))
+            med_tab_results = execute_aggregates(engine, med_tab_queries, 'medication')
             
             # Medication Distribution
             st.markdown("<h3 style='color: #00d4ff;'>Medication Distribution</h3>", unsafe_allow_html=True)
-            med_tab_dist = execute_query(engine, f"SELECT medication, COUNT(*) as count FROM patients {med_tab_where} GROUP BY medication ORDER BY count DESC")
+            med_tab_dist = med_tab_results['count']
             if med_tab_dist is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(med_tab_dist, width='stretch')
                 with col2:
-                    fig = px.bar(med_tab_dist, x='medication', y='count', title="Patient Count by Medication")
+                    fig = figure_cache.tab_figure('medication', 'count', med_tab_dist)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Billing by Medication
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Billing by Medication</h3>", unsafe_allow_html=True)
-            med_tab_billing = execute_query(engine, f"SELECT medication, ROUND(AVG(billing_amount), 2) as avg_billing FROM patients {med_tab_where} GROUP BY medication ORDER BY avg_billing DESC")
+            med_tab_billing = med_tab_results['billing']
             if med_tab_billing is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(med_tab_billing, width='stretch')
                 with col2:
-                    fig = px.bar(med_tab_billing, x='medication', y='avg_billing', title="Avg Billing by Medication")
+                    fig = figure_cache.tab_figure('medication', 'billing', med_tab_billing)
                     st.plotly_chart(fig, width='stretch')
             
             # Average Length of Stay by Medication
             st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Length of Stay by Medication</h3>", unsafe_allow_html=True)
-            med_tab_los = execute_query(engine, f"SELECT medication, ROUND(AVG(DATEDIFF(discharge_date, date_of_admission))) as avg_stay FROM patients {med_tab_where} GROUP BY medication ORDER BY avg_stay DESC")
+            med_tab_los = med_tab_results['stay']
             if med_tab_los is not None:
                 col1, col2 = st.columns(2)
                 with col1:
                     st.dataframe(med_tab_los, width='stretch')
                 with col2:
-                    fig = px.bar(med_tab_los, x='medication', y='avg_stay', title="Avg Length of Stay by Medication")
-                    st.plotly_chart(fig, width='stretch')
\ No newline at end of file
+                    fig = figure_cache.tab_figure('medication', 'stay', med_tab_los)
+                    st.plotly_chart(fig, width='stretch')
+
+# ===== ADMISSION TRENDS =====
+# Served from the shared calendar rollup; changing the granularity only
+# re-aggregates its cells
+@st.fragment
+def trends_tab():
+        # Create two columns: left for content, right for filters
+        content_col, filter_col = st.columns([3, 1])
+        
+        with filter_col:
+            st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Filters</h3>", unsafe_allow_html=True)
+            trend_grain = st.radio("Granularity", list(TREND_GRAINS), index=2, format_func=str.title, horizontal=True, key="trend_grain")
+            trend_condition = filter_selectbox('medical_condition', key="trend_condition")
+            trend_insurance = filter_selectbox('insurance_provider', key="trend_insurance")
+            trend_admission = filter_selectbox('admission_type', key="trend_admission")
+            trend_gender = filter_selectbox('gender', key="trend_gender")
+        
+        with content_col:
+            trend_spec = trend_query(trend_grain, active_filters({
+                'medical_condition': trend_condition,
+                'insurance_provider': trend_insurance,
+                'admission_type': trend_admission,
+                'gender': trend_gender,
+            }))
+            try:
+                with query_section('trends'):
+                    trend = run_trend(engine, trend_spec)
+            except Exception as e:
+                st.error(f"Error executing query: {e}")
+                return
+            trend_x = TREND_GRAINS[trend_grain]
+            trend_labels = {trend_x: trend_grain.title()}
+            
+            # Admissions over time
+            st.markdown("<h3 style='color: #00d4ff;'>Admissions Over Time</h3>", unsafe_allow_html=True)
+            fig = figure_cache.figure('line', trend, x=trend_x, y='admissions', title=f"Admissions per {trend_grain.title()}", labels=trend_labels)
+            st.plotly_chart(fig, width='stretch')
+            
+            # Average billing over time
+            st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Billing Over Time</h3>", unsafe_allow_html=True)
+            fig = figure_cache.figure('line', trend, x=trend_x, y='avg_billing', title=f"Avg Billing per {trend_grain.title()}", labels=trend_labels)
+            st.plotly_chart(fig, width='stretch')
+            
+            # Average length of stay over time
+            st.markdown("<h3 style='color: #00d4ff; margin-top: 30px;'>Average Length of Stay Over Time</h3>", unsafe_allow_html=True)
+            fig = figure_cache.figure('line', trend, x=trend_x, y='avg_stay', title=f"Avg Length of Stay per {trend_grain.title()}", labels=trend_labels)
+            st.plotly_chart(fig, width='stretch')
+
+# ===== DOCTORS & HOSPITALS =====
+# Rankings and distinct counts come from the shared sketches, whose memory
+# does not grow with the number of doctors or hospitals
+@st.fragment
+def heavy_hitters_tab():
+        # Create two columns: left for content, right for filters
+        content_col, filter_col = st.columns([3, 1])
+        
+        with filter_col:
+            st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Options</h3>", unsafe_allow_html=True)
+            hh_column = st.radio("Show", ['doctor', 'hospital'], format_func=lambda column: column.title() + 's', horizontal=True, key="hh_column")
+            hh_by = st.radio("Rank By", ['admissions', 'billing'], format_func=lambda by: 'Admissions' if by == 'admissions' else 'Total Billing', key="hh_by")
+            hh_k = st.slider("Top", min_value=5, max_value=50, value=10, step=5, key="hh_k")
+            hh_name = st.text_input(f"Look up a {hh_column}", key="hh_name")
+        
+        with content_col:
+            try:
+                with query_section('heavy hitters'):
+                    hh_sketch = get_heavy_hitters(engine).column(hh_column)
+            except Exception as e:
+                st.error(f"Error executing query: {e}")
+                return
+            hh_label = hh_column.title() + 's'
+            
+            st.markdown(f"<h3 style='color: #00d4ff;'>Top {hh_k} {hh_label} by {'Admissions' if hh_by == 'admissions' else 'Total Billing'}</h3>", unsafe_allow_html=True)
+            st.markdown(f"**Unique {hh_label}:** {'' if hh_sketch.exact else '≈'}{hh_sketch.distinct():,}")
+            if not hh_sketch.exact:
+                st.caption("≈ More names than the sketches track exactly: totals are upper-bound estimates and the _min columns are guaranteed lower bounds.")
+            hh_top = hh_sketch.top(hh_column, hh_k, hh_by)
+            col1, col2 = st.columns(2)
+            with col1:
+                st.dataframe(hh_top, width='stretch', hide_index=True)
+            with col2:
+                hh_y = 'admissions' if hh_by == 'admissions' else 'total_billing'
+                fig = figure_cache.figure('bar', hh_top, x=hh_column, y=hh_y, title=f"Top {hh_label} by {hh_y.replace('_', ' ').title()}")
+                st.plotly_chart(fig, width='stretch')
+            
+            if hh_name.strip():
+                admissions, billing, admissions_min, billing_min = hh_sketch.lookup(hh_name.strip())
+                if hh_sketch.exact:
+                    st.markdown(f"**{hh_name.strip()}:** {admissions:,} admissions, ${billing:,.2f} billed")
+                else:
+                    st.markdown(f"**{hh_name.strip()}:** ≈ {admissions_min:,}–{admissions:,} admissions, ${billing_min:,.2f}–${billing:,.2f} billed")
+
+# ===== PATIENT RECORDS =====
+# Pages are read with keyset cursors: rec_cursors holds the cursor each
+# visited page started from, so Previous pops back without re-reading the
+# pages before it. Changing a filter or the sort starts again at page one.
+def show_next_records():
+    st.session_state.rec_cursors.append(st.session_state.rec_next)
+
+def show_previous_records():
+    st.session_state.rec_cursors.pop()
+
+def show_first_records():
+    del st.session_state.rec_cursors[1:]
+
+@st.fragment
+def records_tab():
+        # Create two columns: left for content, right for filters
+        content_col, filter_col = st.columns([3, 1])
+        
+        with filter_col:
+            st.markdown("<h3 style='color: #00d4ff; font-size: 1.1em;'>🔍 Filters</h3>", unsafe_allow_html=True)
+            rec_condition = filter_selectbox('medical_condition', key="rec_condition")
+            rec_insurance = filter_selectbox('insurance_provider', key="rec_insurance")
+            rec_admission = filter_selectbox('admission_type', key="rec_admission")
+            rec_gender = filter_selectbox('gender', key="rec_gender")
+            rec_age_range = st.slider("Age Range", min_value=AGE_RANGE[0], max_value=AGE_RANGE[1], value=AGE_RANGE, key="rec_age")
+            rec_sort = st.selectbox("Sort By", list(RECORD_SORT_COLUMNS), format_func=RECORD_SORT_COLUMNS.get, key="rec_sort")
+            rec_descending = st.toggle("Descending", key="rec_descending")
+        
+        with content_col:
+            # The full age range is no filter, so the total can come from the aggregates
+            rec_filters = active_filters({
+                'medical_condition': rec_condition,
+                'insurance_provider': rec_insurance,
+                'admission_type': rec_admission,
+                'gender': rec_gender,
+            })
+            rec_spec = FilterSpec(tuple(rec_filters.items()), None if tuple(rec_age_range) == AGE_RANGE else tuple(rec_age_range))
+            rec_view = (rec_spec, rec_sort, rec_descending)
+            if st.session_state.get('rec_view') != rec_view:
+                st.session_state.rec_view = rec_view
+                st.session_state.rec_cursors = [None]
+            
+            st.markdown("<h3 style='color: #00d4ff;'>Patient Records</h3>", unsafe_allow_html=True)
+            try:
+                with query_section('records'):
+                    rec_total = count_records(engine, rec_spec)
+                    rec_page, st.session_state.rec_next = read_page(engine, rec_spec, rec_sort, rec_descending, st.session_state.rec_cursors[-1])
+            except Exception as e:
+                st.error(f"Error executing query: {e}")
+                return
+            
+            rec_first = (len(st.session_state.rec_cursors) - 1) * PAGE_ROWS
+            if len(rec_page):
+                st.caption(f"Rows {rec_first + 1:,}–{rec_first + len(rec_page):,} of {rec_total:,}")
+            else:
+                st.caption("No patients match these filters")
+            st.dataframe(rec_page, width='stretch', hide_index=True)
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.button("⏮ First", on_click=show_first_records, disabled=len(st.session_state.rec_cursors) == 1, key="rec_first")
+            with col2:
+                st.button("◀ Previous", on_click=show_previous_records, disabled=len(st.session_state.rec_cursors) == 1, key="rec_previous")
+            with col3:
+                st.button("Next ▶", on_click=show_next_records, disabled=st.session_state.rec_next is None, key="rec_next_page")
+
+# ===== ANALYSIS SECTION SELECTOR =====
+analysis_renderers = [demographics_tab, medical_conditions_tab, insurance_tab, admission_type_tab, medication_tab, trends_tab, heavy_hitters_tab, records_tab]
+
+# Switching tabs reruns only this fragment; the overview and column details are left alone
+@st.fragment
+def analysis_sections():
+    if 'selected_analysis' not in st.session_state:
+        st.session_state.selected_analysis = None
+
+    # Create radio button with horizontal layout
+    selected_tab = st.radio(
+        "Select Analysis",
+        options=range(len(analysis_tabs)),
+        format_func=lambda x: analysis_tabs[x],
+        horizontal=True,
+        label_visibility="collapsed"
+    )
+
+    # Update session state
+    st.session_state.selected_analysis = selected_tab
+
+    st.divider()
+
+    # Render only the selected analysis
+    analysis_renderers[st.session_state.selected_analysis]()
+
+analysis_sections()
+
+# ===== PERFORMANCE PANEL =====
+# A fragment of its own: Refresh updates it without rerunning the page
+@st.fragment
+def performance_panel():
+    with st.expander("⚡ Performance", expanded=False):
+        st.button("Refresh", key='performance_refresh')
+        cache_stats = query_cache.stats()
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        st.markdown(f"**Result cache:** {cache_stats['entries']} entries, {cache_stats['bytes'] / 1024 / 1024:.1f} MB, "
+                    f"{cache_stats['hits'] / lookups if lookups else 0:.0%} hit rate")
+        figure_stats = figure_cache.stats()
+        lookups = figure_stats['hits'] + figure_stats['misses']
+        st.markdown(f"**Figure cache:** {figure_stats['entries']} figures, {figure_stats['bytes'] / 1024 / 1024:.1f} MB, "
+                    f"{figure_stats['hits'] / lookups if lookups else 0:.0%} hit rate")
+
+        st.markdown("**By section** (all sessions, slowest first)")
+        sections = pd.DataFrame(query_metrics.sections())
+        if not sections.empty:
+            st.dataframe(sections[['section', 'queries', 'avg_ms', 'db_ms', 'frame_ms', 'cache_hits', 'cache_misses', 'errors']].round(1), width='stretch', hide_index=True)
+
+        st.markdown("**Recent queries**")
+        recent = pd.DataFrame([vars(record) for record in reversed(query_metrics.recent(50))])
+        if not recent.empty:
+            st.dataframe(recent[['section', 'source', 'wall_ms', 'db_ms', 'frame_ms', 'rows', 'error', 'sql']].round(2), width='stretch', hide_index=True)
+
+        st.download_button("Download Prometheus metrics", query_metrics.prometheus_text(), file_name='dashboard_metrics.prom', mime='text/plain')
+        if st.button("Reset metrics"):
+            query_metrics.reset()
+            st.rerun(scope='fragment')
+
+if getenv('PERFORMANCE_PANEL', 'true').lower() in ('1', 'true', 'yes'):
+    with st.sidebar:
+        performance_panel()
\ No newline at end of file
@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from data_sources import read_chunks, scan_sql, source_label
+from db import create_db_engine
+from query_cache import INCREMENTAL_REFRESH, appended_range, query_cache
+from query_metrics import query_metrics, query_section
+from settings import getenv
+from sketches import CountMinSketch, FrequentItems, HyperLogLog, hash_values
+
+# Top doctors and hospitals by admissions and billing, from streaming sketches.
+# Per column, a Misra-Gries frequent-items summary ranks names by admissions
+# and another by amount billed, Count-Min sketches estimate both totals for
+# any name and a HyperLogLog counts distinct names. Neither summary accepts
+# negative amounts, so refunds go into a third summary of their own and are
+# netted out of the billing totals shown. Memory is fixed by the capacity
+# however many doctors and hospitals there are. Every sketch merges, so the
+# summaries are built chunk by chunk, extended with only appended rows, and
+# kept current by ingest.py as it loads each chunk. The result is saved to
+# HEAVY_HITTER_SNAPSHOT_PATH for the table version it covers. The version only
+# notices inserts and deletes, so a snapshot is reused until
+# HEAVY_HITTER_SNAPSHOT_MAX_AGE seconds after the full scan it started from.
+#
+#   python heavy_hitters.py           build the sketches and write the snapshot
+#   python heavy_hitters.py --show    also print the top doctors and hospitals
+
+HEAVY_HITTER_COLUMNS = ('doctor', 'hospital')
+# Names tracked per ranking; rankings are exact up to this many distinct names
+CAPACITY = int(getenv('HEAVY_HITTER_CAPACITY', '50000'))
+SNAPSHOT_PATH = getenv('HEAVY_HITTER_SNAPSHOT_PATH', '.heavy_hitters.npz')
+SNAPSHOT_MAX_AGE = float(getenv('HEAVY_HITTER_SNAPSHOT_MAX_AGE', '86400'))
+CHUNK_ROWS = 200_000
+
+
+# Sketches for one name column
+# billing sums the positive amounts and refunds the negative ones as
+# positive totals, since the summaries' bounds need non-negative weights
+class EntitySketch:
+    def __init__(self, capacity=CAPACITY, hll=None, admissions=None, billing=None, admissions_cms=None, billing_cms=None, refunds=None):
+        self.capacity = capacity
+        self.hll = HyperLogLog() if hll is None else hll
+        self.admissions = FrequentItems(capacity) if admissions is None else admissions
+        self.billing = FrequentItems(capacity, counts=np.empty(0, dtype=np.float64)) if billing is None else billing
+        self.admissions_cms = CountMinSketch() if admissions_cms is None else admissions_cms
+        self.billing_cms = CountMinSketch() if billing_cms is None else billing_cms
+        self.refunds = FrequentItems(capacity, counts=np.empty(0, dtype=np.float64)) if refunds is None else refunds
+
+    # names is a Series of one chunk, billing the amounts of the same rows
+    def add(self, names, billing):
+        present = names.notna().to_numpy()
+        names = names[present].astype(object)
+        hashes = hash_values(names)
+        values = names.to_numpy()
+        amounts = np.nan_to_num(pd.to_numeric(pd.Series(billing)[present]).to_numpy(dtype=float))
+        charged = np.maximum(amounts, 0)
+        refunded = amounts < 0
+        self.hll.add_hashes(hashes)
+        self.admissions.add_hashes(hashes, values)
+        self.billing.add_hashes(hashes, values, charged)
+        self.admissions_cms.add_hashes(hashes)
+        self.billing_cms.add_hashes(hashes, charged)
+        if refunded.any():
+            self.refunds.add_hashes(hashes[refunded], values[refunded], -amounts[refunded])
+
+    def merge(self, other):
+        return EntitySketch(
+            self.capacity, self.hll.merge(other.hll), self.admissions.merge(other.admissions), self.billing.merge(other.billing),
+            self.admissions_cms.merge(other.admissions_cms), self.billing_cms.merge(other.billing_cms), self.refunds.merge(other.refunds),
+        )
+
+    @property
+    def exact(self):
+        return self.admissions.exact and self.billing.exact and self.refunds.exact
+
+    def distinct(self):
+        return len(self.admissions) if self.admissions.exact else self.hll.estimate()
+
+    # Totals of names given by hash: exact while the summary is, otherwise the
+    # summary's bound, capped by the Count-Min estimate when there is one, with
+    # the summary's count as a guaranteed lower bound
+    def _totals(self, summary, cms, hashes):
+        index = np.searchsorted(summary.keys, hashes)
+        index = np.minimum(index, max(len(summary.keys) - 1, 0))
+        tracked = summary.keys[index] == hashes if len(summary.keys) else np.zeros(len(hashes), dtype=bool)
+        low = np.where(tracked, summary.counts[index] if len(summary.keys) else 0, 0).astype(float)
+        if summary.exact:
+            return low, low
+        if cms is None:
+            return low + summary.error, low
+        return np.minimum(cms.estimate_hashes(hashes), low + summary.error), low
+
+    # Billing totals net of refunds, with their lower bounds
+    def _billing(self, hashes):
+        charged, charged_min = self._totals(self.billing, self.billing_cms, hashes)
+        refunds, refunds_min = self._totals(self.refunds, None, hashes)
+        return charged - refunds_min, charged_min - refunds
+
+    # The k names with the most admissions (by='admissions') or the largest
+    # amount billed before refunds (by='billing'), with both totals. When the sketches are
+    # no longer exact, the totals are upper-bound estimates and the _min
+    # columns hold guaranteed lower bounds.
+    def top(self, column, k=10, by='admissions'):
+        ranking = self.admissions if by == 'admissions' else self.billing
+        order = np.argsort(-ranking.counts, kind='stable')[:k]
+        hashes = ranking.keys[order]
+        admissions, admissions_min = self._totals(self.admissions, self.admissions_cms, hashes)
+        billing, billing_min = self._billing(hashes)
+        top = {column: ranking.values[order] if len(order) else np.empty(0, dtype=object), 'admissions': admissions.astype(np.int64), 'total_billing': billing.round(2)}
+        if not self.exact:
+            top['admissions_min'] = admissions_min.astype(np.int64)
+            top['total_billing_min'] = billing_min.round(2)
+        return pd.DataFrame(top)
+
+    # Totals for one name, tracked or not, as (admissions, billing, low
+    # admissions, low billing)
+    def lookup(self, name):
+        hashes = hash_values(pd.Series([name], dtype=object))
+        admissions, admissions_min = self._totals(self.admissions, self.admissions_cms, hashes)
+        billing, billing_min = self._billing(hashes)
+        return int(admissions[0]), round(float(billing[0]), 2), int(admissions_min[0]), round(float(billing_min[0]), 2)
+
+    def arrays(self, prefix):
+        arrays = {f"{prefix}_hll": self.hll.registers}
+        for name, summary in (('admissions', self.admissions), ('billing', self.billing), ('refunds', self.refunds)):
+            arrays[f"{prefix}_{name}_keys"] = summary.keys
+            arrays[f"{prefix}_{name}_counts"] = summary.counts
+            arrays[f"{prefix}_{name}_values"] = np.asarray(summary.values if summary.values is not None else [], dtype=str)
+            arrays[f"{prefix}_{name}_error"] = np.asarray(summary.error)
+        arrays[f"{prefix}_admissions_cms"] = self.admissions_cms.table
+        arrays[f"{prefix}_billing_cms"] = self.billing_cms.table
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix, capacity=CAPACITY):
+        summaries = {}
+        cms = {}
+        for name in ('admissions', 'billing', 'refunds'):
+            values = arrays[f"{prefix}_{name}_values"].astype(object)
+            summaries[name] = FrequentItems(
+                capacity, arrays[f"{prefix}_{name}_keys"], arrays[f"{prefix}_{name}_counts"],
+                values if len(values) else None, arrays[f"{prefix}_{name}_error"].item(),
+            )
+        for name in ('admissions', 'billing'):
+            table = arrays[f"{prefix}_{name}_cms"]
+            cms[name] = CountMinSketch(table.shape[1], table.shape[0], table)
+        registers = arrays[f"{prefix}_hll"]
+        hll = HyperLogLog(int(np.log2(len(registers))), registers)
+        return cls(capacity, hll, summaries['admissions'], summaries['billing'], cms['admissions'], cms['billing'], summaries['refunds'])
+
+
+def _scan(engine, params):
+    sketches = {column: EntitySketch() for column in HEAVY_HITTER_COLUMNS}
+    rows = 0
+    for chunk in read_chunks(engine, list(HEAVY_HITTER_COLUMNS) + ['billing_amount'], params, CHUNK_ROWS):
+        rows += len(chunk)
+        for column in HEAVY_HITTER_COLUMNS:
+            sketches[column].add(chunk[column], chunk['billing_amount'])
+    return sketches, rows
+
+
+# built_at is when the table was last scanned in full (epoch seconds);
+# extending the sketches with appended rows keeps it
+class HeavyHitters:
+    def __init__(self, sketches, version=None, rows=0, built_at=None):
+        self.sketches = sketches
+        self.version = version
+        self.rows = rows
+        self.built_at = time.time() if built_at is None else built_at
+
+    @classmethod
+    def empty(cls, version=None):
+        return cls({column: EntitySketch() for column in HEAVY_HITTER_COLUMNS}, version)
+
+    @classmethod
+    def build(cls, engine, version=None):
+        started = time.perf_counter()
+        sketches, rows = _scan(engine, None)
+        with query_section('heavy hitters build'):
+            query_metrics.record(scan_sql(engine, list(HEAVY_HITTER_COLUMNS) + ['billing_amount']), source_label(engine), (time.perf_counter() - started) * 1000, rows=rows)
+        return cls(sketches, version, rows)
+
+    # Sketches with the rows appended since this version merged in; None
+    # when the table changed in any other way
+    def extend(self, engine, version):
+        params = appended_range(self.version, version)
+        if params is None:
+            return None
+        started = time.perf_counter()
+        delta, rows = _scan(engine, params)
+        with query_section('heavy hitters refresh'):
+            query_metrics.record(scan_sql(engine, list(HEAVY_HITTER_COLUMNS) + ['billing_amount'], appended=True), source_label(engine), (time.perf_counter() - started) * 1000, rows=rows)
+        if rows != version[0] - self.version[0]:
+            return None
+        return HeavyHitters({column: self.sketches[column].merge(delta[column]) for column in self.sketches}, version, self.rows + rows, self.built_at)
+
+    # Fold in rows as they are loaded (ingest.py); version is the table
+    # version once they are committed
+    def add_rows(self, frame, version):
+        for column in HEAVY_HITTER_COLUMNS:
+            self.sketches[column].add(frame[column], frame['billing_amount'])
+        self.rows += len(frame)
+        self.version = version
+
+    def column(self, name):
+        return self.sketches[name]
+
+    def save(self, path=SNAPSHOT_PATH):
+        arrays = {'version': np.asarray(json.dumps(list(self.version) if self.version is not None else None)), 'rows': np.asarray(self.rows), 'built_at': np.asarray(self.built_at)}
+        for column, sketch in self.sketches.items():
+            arrays.update(sketch.arrays(column))
+        temp_path = f"{path}.tmp.npz"
+        np.savez_compressed(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    # Snapshot from disk, or None when there is none for this table version
+    # or its full scan was more than max_age seconds ago
+    @classmethod
+    def load(cls, version, path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+        if not path or not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as arrays:
+            if json.loads(arrays['version'].item()) != (list(version) if version is not None else None):
+                return None
+            if 'built_at' not in arrays or time.time() - float(arrays['built_at']) > max_age:
+                return None
+            sketches = {column: EntitySketch.from_arrays(arrays, column) for column in HEAVY_HITTER_COLUMNS}
+            return cls(sketches, version, int(arrays['rows']), float(arrays['built_at']))
+
+
+# Shared sketches for every session in the process. A snapshot written by
+# ingest.py for the current version is used as is; otherwise only the
+# appended rows are scanned, or the table when that is not possible.
+_heavy_hitters = None
+_heavy_hitters_lock = threading.Lock()
+
+
+def get_heavy_hitters(engine):
+    global _heavy_hitters
+    version = query_cache.check_version(engine)
+    with _heavy_hitters_lock:
+        if _heavy_hitters is not None and _heavy_hitters.version == version:
+            return _heavy_hitters
+        current = HeavyHitters.load(version)
+        if current is None and _heavy_hitters is not None and INCREMENTAL_REFRESH:
+            current = _heavy_hitters.extend(engine, version)
+        if current is None:
+            current = HeavyHitters.build(engine, version)
+        if SNAPSHOT_PATH and current is not _heavy_hitters:
+            current.save()
+        _heavy_hitters = current
+        return _heavy_hitters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the doctor and hospital sketches and write the snapshot.")
+    parser.add_argument('--show', action='store_true', help="print the top doctors and hospitals")
+    parser.add_argument('--top', type=int, default=10, help="names to show per ranking (default 10)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    started = time.perf_counter()
+    hitters = HeavyHitters.build(engine, query_cache.check_version(engine, force=True))
+    print(f"Sketched {hitters.rows:,} rows in {time.perf_counter() - started:.1f}s")
+    if SNAPSHOT_PATH:
+        hitters.save()
+        print(f"Wrote {SNAPSHOT_PATH}")
+    for column in HEAVY_HITTER_COLUMNS:
+        sketch = hitters.column(column)
+        print(f"{column}: {'' if sketch.exact else '≈'}{sketch.distinct():,} distinct")
+        if args.show:
+            for by in ('admissions', 'billing'):
+                print(f"Top {args.top} by {by}:")
+                print(sketch.top(column, args.top, by).to_string(index=False))
@@ -0,0 +1,275 @@
+import argparse
+import hashlib
+import os
+import sys
+import time
+from collections import deque
+from datetime import datetime, timezone
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import inspect, text
+
+from db import create_db_engine
+from db_schema import COLUMNS, TABLE, create_table_sql
+from heavy_hitters import SNAPSHOT_PATH as HEAVY_HITTER_SNAPSHOT_PATH, HeavyHitters
+from query_cache import get_table_version
+
+# Bulk load of the raw Kaggle healthcare CSV into patients.
+# The CSV is streamed in chunks, so memory stays at one chunk whatever the
+# file size. Each chunk is cleaned (trimmed text, names in title case,
+# billing rounded to cents) and validated (no missing values, whole ages in
+# range, no negative billing, discharge not before admission); accepted rows
+# get consecutive patient_ids after the table's highest one, allocated in the
+# chunk's own transaction, and are written with multi-row INSERTs together
+# with the file's progress in ingest_log. A re-run of a
+# finished file is a no-op and an interrupted one resumes after its last
+# committed chunk, so no row is ever loaded twice. The doctor and hospital
+# sketches (heavy_hitters.py) are updated with each committed chunk, so the
+# dashboard never rescans the table for them after a load.
+#
+#   python ingest.py healthcare_dataset.csv
+#   python ingest.py big.csv --chunk-rows 200000 --rejects rejects.csv
+
+INGEST_LOG = 'ingest_log'
+CHUNK_ROWS = 100_000
+AGE_LIMITS = (0, 120)
+
+# Table columns the CSV provides; patient_id is assigned on load
+CSV_COLUMNS = [column for column in COLUMNS if column != 'patient_id']
+TEXT_COLUMNS = [column for column in CSV_COLUMNS if COLUMNS[column].startswith('VARCHAR')]
+DATE_COLUMNS = [column for column in CSV_COLUMNS if COLUMNS[column] == 'DATE']
+
+INGEST_LOG_SQL = f"""CREATE TABLE {INGEST_LOG} (
+    file_hash VARCHAR(64) PRIMARY KEY,
+    file_name VARCHAR(255) NOT NULL,
+    first_patient_id INTEGER NOT NULL,
+    rows_read INTEGER NOT NULL,
+    rows_loaded INTEGER NOT NULL,
+    rows_rejected INTEGER NOT NULL,
+    completed INTEGER NOT NULL,
+    updated_at VARCHAR(32) NOT NULL
+)"""
+
+
+# "Date of Admission" -> date_of_admission
+def column_name(header):
+    return header.strip().lower().replace(' ', '_')
+
+
+# SHA-256 of the file contents; a renamed copy is the same file, an edited one is not
+def file_fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Trimmed text with empty strings as missing. Each distinct value is
+# cleaned once, which is far cheaper than per row for the categorical columns.
+def _text(values, title=False):
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques, dtype=object).str.strip()
+    if title:
+        uniques = uniques.str.title()
+    return uniques.where(uniques != '', None).to_numpy()[codes]
+
+
+# Cleaned rows ready to insert, and the rejected raw rows with a reason.
+# Columns are built as plain arrays and put in a DataFrame once at the end.
+def clean_chunk(raw):
+    values = {column: _text(raw[column], title=column == 'name') for column in TEXT_COLUMNS}
+    for column in ('age', 'room_number', 'billing_amount'):
+        values[column] = pd.to_numeric(raw[column], errors='coerce').to_numpy(dtype=float)
+    values['billing_amount'] = values['billing_amount'].round(2)
+    for column in DATE_COLUMNS:
+        values[column] = pd.to_datetime(raw[column], errors='coerce', format='ISO8601').to_numpy()
+
+    # First failing check per row; later checks only matter for complete rows
+    missing = np.zeros(len(raw), dtype=bool)
+    for column in CSV_COLUMNS:
+        missing |= pd.isna(values[column])
+    age = values['age']
+    with np.errstate(invalid='ignore'):
+        checks = [
+            ('missing or unparseable value', missing),
+            ('age not a whole number in range', (age % 1 != 0) | (age < AGE_LIMITS[0]) | (age > AGE_LIMITS[1])),
+            ('room_number not a whole number', values['room_number'] % 1 != 0),
+            ('negative billing_amount', values['billing_amount'] < 0),
+            ('discharge_date before date_of_admission', values['discharge_date'] < values['date_of_admission']),
+        ]
+    reason = np.select([mask for _, mask in checks], [name for name, _ in checks], default='')
+    keep = reason == ''
+
+    clean = {column: values[column][keep] for column in CSV_COLUMNS}
+    for column in ('age', 'room_number'):
+        clean[column] = clean[column].astype(np.int64)
+    for column in DATE_COLUMNS:
+        clean[column] = np.datetime_as_string(clean[column], unit='D')
+    return pd.DataFrame(clean), raw[~keep].assign(reason=reason[~keep])
+
+
+def ensure_tables(engine):
+    tables = set(inspect(engine).get_table_names())
+    with engine.begin() as conn:
+        if TABLE not in tables:
+            conn.execute(text(create_table_sql(engine.dialect.name)))
+        if INGEST_LOG not in tables:
+            conn.execute(text(INGEST_LOG_SQL))
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+# The file's ingest_log row, created on first sight. first_patient_id is the
+# first id the file was given, 0 until a chunk has loaded rows.
+def _start(engine, file_hash, path):
+    with engine.begin() as conn:
+        row = conn.execute(text(f"SELECT * FROM {INGEST_LOG} WHERE file_hash = :file_hash"), {'file_hash': file_hash}).mappings().first()
+        if row is not None:
+            return dict(row)
+        row = {
+            'file_hash': file_hash, 'file_name': os.path.basename(path)[:255], 'first_patient_id': 0,
+            'rows_read': 0, 'rows_loaded': 0, 'rows_rejected': 0, 'completed': 0, 'updated_at': _now(),
+        }
+        conn.execute(text(f"INSERT INTO {INGEST_LOG} ({', '.join(row)}) VALUES ({', '.join(f':{key}' for key in row)})"), row)
+        return row
+
+
+# Chunks of raw CSV rows as strings, starting after the first `skip` data
+# rows. Skipping counts lines, so quoted fields must not contain newlines
+# (the Kaggle file has none).
+def read_csv_chunks(path, chunk_rows=CHUNK_ROWS, skip=0):
+    with open(path, newline='', encoding='utf-8') as f:
+        header = [column_name(column) for column in pd.read_csv(f, nrows=0).columns]
+        missing = [column for column in CSV_COLUMNS if column not in header]
+        if missing:
+            raise ValueError(f"{path} is missing columns: {', '.join(missing)}")
+        f.seek(0)
+        f.readline()
+        deque(islice(f, skip), maxlen=0)
+        yield from pd.read_csv(f, header=None, names=header, usecols=CSV_COLUMNS, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+
+
+# Sketches to keep current during the load: the snapshot for the table as it
+# is now, or empty ones for an empty table; None when neither applies and the
+# dashboard will bring them up to date itself
+def _heavy_hitters(engine):
+    if not HEAVY_HITTER_SNAPSHOT_PATH:
+        return None
+    version = get_table_version(engine)
+    if version[0] == 0:
+        return HeavyHitters.empty(version)
+    return HeavyHitters.load(version)
+
+
+# Next free patient_id, read inside the transaction that inserts the chunk.
+# On MySQL FOR UPDATE locks the end of the primary key, so another writer
+# waits until this chunk commits; SQLite runs one write transaction at a time.
+def _next_patient_id(conn):
+    lock = ' FOR UPDATE' if conn.dialect.name == 'mysql' else ''
+    return conn.execute(text(f"SELECT COALESCE(MAX(patient_id), 0) + 1 FROM {TABLE}{lock}")).scalar()
+
+
+# Multi-row INSERT through the driver: PyMySQL's executemany folds the rows
+# into INSERT ... VALUES (...), (...) statements, SQLite runs one prepared statement
+def _insert_rows(conn, frame):
+    placeholder = '?' if conn.dialect.paramstyle == 'qmark' else '%s'
+    columns = list(frame.columns)
+    sql = f"INSERT INTO {TABLE} ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))})"
+    conn.exec_driver_sql(sql, list(frame.itertuples(index=False, name=None)))
+
+
+def ingest_csv(engine, path, chunk_rows=CHUNK_ROWS, rejects_path=None, progress=None):
+    ensure_tables(engine)
+    file_hash = file_fingerprint(path)
+    log = _start(engine, file_hash, path)
+    report = {
+        'file': path, 'file_hash': file_hash, 'skipped': bool(log['completed']), 'resumed_at': log['rows_read'],
+        'rows_read': 0, 'rows_loaded': 0, 'rows_rejected': 0, 'clean_seconds': 0.0, 'insert_seconds': 0.0,
+    }
+    if log['completed']:
+        return report
+
+    started = time.perf_counter()
+    hitters = _heavy_hitters(engine)
+    rows_read, rows_loaded, rows_rejected = log['rows_read'], log['rows_loaded'], log['rows_rejected']
+    first_patient_id = log['first_patient_id']
+    chunk_started = time.perf_counter()
+    for raw in read_csv_chunks(path, chunk_rows, skip=rows_read):
+        clean, rejects = clean_chunk(raw)
+        inserting = time.perf_counter()
+        report['clean_seconds'] += inserting - chunk_started
+
+        rows_read += len(raw)
+        rows_loaded += len(clean)
+        rows_rejected += len(rejects)
+        with engine.begin() as conn:
+            if len(clean):
+                clean.insert(0, 'patient_id', np.arange(len(clean)) + _next_patient_id(conn))
+                first_patient_id = first_patient_id or int(clean['patient_id'].iloc[0])
+                _insert_rows(conn, clean)
+            conn.execute(
+                text(f"UPDATE {INGEST_LOG} SET first_patient_id = :first_patient_id, rows_read = :rows_read, rows_loaded = :rows_loaded, "
+                     f"rows_rejected = :rows_rejected, updated_at = :updated_at WHERE file_hash = :file_hash"),
+                {'first_patient_id': first_patient_id, 'rows_read': rows_read, 'rows_loaded': rows_loaded, 'rows_rejected': rows_rejected,
+                 'updated_at': _now(), 'file_hash': file_hash},
+            )
+        if hitters is not None and len(clean):
+            row_count, max_id = hitters.version
+            hitters.add_rows(clean, (row_count + len(clean), max(max_id or 0, int(clean['patient_id'].iloc[-1]))))
+            hitters.save()
+        chunk_started = time.perf_counter()
+        report['insert_seconds'] += chunk_started - inserting
+
+        if rejects_path and len(rejects):
+            rejects.to_csv(rejects_path, mode='a', index=False, header=not os.path.exists(rejects_path))
+        if progress:
+            progress(rows_read, rows_loaded, rows_rejected, chunk_started - started)
+
+    with engine.begin() as conn:
+        conn.execute(text(f"UPDATE {INGEST_LOG} SET completed = 1, updated_at = :updated_at WHERE file_hash = :file_hash"),
+                     {'updated_at': _now(), 'file_hash': file_hash})
+    report.update(
+        rows_read=rows_read - log['rows_read'], rows_loaded=rows_loaded - log['rows_loaded'], rows_rejected=rows_rejected - log['rows_rejected'],
+        total_loaded=rows_loaded, total_rejected=rows_rejected, seconds=time.perf_counter() - started,
+    )
+    return report
+
+
+def _print_progress(rows_read, rows_loaded, rows_rejected, seconds):
+    print(f"  read {rows_read:,} rows, loaded {rows_loaded:,}, rejected {rows_rejected:,} ({rows_read / max(seconds, 1e-9):,.0f} rows/s)", end='\r')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Clean, validate and bulk-load the healthcare CSV into the patients table.")
+    parser.add_argument('csv', help="raw CSV with the Kaggle healthcare dataset header")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help=f"rows per chunk and per transaction (default {CHUNK_ROWS:,})")
+    parser.add_argument('--rejects', help="append rejected rows with the reason to this CSV")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    try:
+        report = ingest_csv(engine, args.csv, args.chunk_rows, args.rejects, _print_progress)
+    except ValueError as e:
+        sys.exit(str(e))
+    if report['skipped']:
+        print(f"{args.csv} was already loaded (ingest_log {report['file_hash'][:12]}); nothing to do")
+        sys.exit(0)
+
+    print()
+    if report['resumed_at']:
+        print(f"Resumed after {report['resumed_at']:,} rows committed by an earlier run")
+    seconds = report['seconds']
+    print(f"Read {report['rows_read']:,} rows: loaded {report['rows_loaded']:,}, rejected {report['rows_rejected']:,} in {seconds:.1f}s")
+    print(f"Throughput {report['rows_read'] / max(seconds, 1e-9):,.0f} rows/s "
+          f"(parsing and cleaning {report['clean_seconds']:.1f}s, inserting {report['insert_seconds']:.1f}s)")
+    print(f"{TABLE} now holds {report['total_loaded']:,} rows from this file")
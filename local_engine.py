@@ -0,0 +1,188 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_sources import read_chunks, scan_sql, source_label
+from queries import DIMENSIONS
+from query_cache import INCREMENTAL_REFRESH, appended_range, query_cache
+from query_metrics import query_metrics, query_section
+from rollup import ROLLUP_METRICS, filter_mask, rollup
+from settings import getenv
+
+# In-process columnar copy of the patients table.
+# Dimension columns are dictionary-encoded to small integer codes and the
+# numeric columns are packed into fixed-width arrays, so the tab queries run
+# as vectorized NumPy masks and bincounts instead of MySQL round trips.
+
+LOAD_CHUNK_ROWS = int(getenv('LOCAL_ENGINE_CHUNK_ROWS', '200000'))
+
+NUMERIC_COLUMNS = {
+    'age': np.int32,
+    'room_number': np.int32,
+    'billing_amount': np.float64,
+    'length_of_stay': np.int16,
+}
+
+LOAD_COLUMNS = DIMENSIONS + list(NUMERIC_COLUMNS)
+
+
+# Grows a value -> code dictionary across chunks; existing codes never change
+class _Dictionary:
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.lookup = {value: code for code, value in enumerate(self.values)}
+
+    @property
+    def dtype(self):
+        return np.int8 if len(self.values) < 127 else np.int32
+
+    def encode(self, series):
+        for value in series.dropna().unique():
+            if value not in self.lookup:
+                self.lookup[value] = len(self.values)
+                self.values.append(value)
+        return pd.Categorical(series, categories=self.values).codes
+
+
+# Stream rows in chunks, dictionary-encoding the dimensions as they arrive.
+# Returns per-column lists of chunk arrays and the number of rows read.
+def _read_encoded(engine, params, dictionaries):
+    code_chunks = {dim: [] for dim in DIMENSIONS}
+    column_chunks = {column: [] for column in NUMERIC_COLUMNS}
+    rows = 0
+    for chunk in read_chunks(engine, LOAD_COLUMNS, params, LOAD_CHUNK_ROWS):
+        for dim in DIMENSIONS:
+            code_chunks[dim].append(dictionaries[dim].encode(chunk[dim]))
+        for column, dtype in NUMERIC_COLUMNS.items():
+            values = pd.to_numeric(chunk[column])
+            if values.isna().any():
+                raise ValueError(f"patients.{column} contains NULLs; the local engine needs complete numeric columns")
+            column_chunks[column].append(values.to_numpy().astype(dtype))
+        rows += len(chunk)
+    return code_chunks, column_chunks, rows
+
+
+class ColumnarTable:
+    # codes and columns may be longer than size; the spare capacity lets
+    # appended rows be written in place instead of copying every array
+    def __init__(self, codes, categories, columns, version=None, size=None):
+        self.version = version
+        self.size = len(columns['age']) if size is None else size
+        self._code_buffers = codes
+        self._column_buffers = columns
+        self.codes = {dim: values[:self.size] for dim, values in codes.items()}
+        self.categories = categories
+        self.lookup = {dim: {value: code for code, value in enumerate(values)} for dim, values in categories.items()}
+        self.columns = {column: values[:self.size] for column, values in columns.items()}
+        self.nullable = {dim for dim, values in self.codes.items() if (values < 0).any()}
+        # Per-row measures in the names rollup() expects
+        self.measures = {
+            'billing_sum': self.columns['billing_amount'],
+            'stay_sum': self.columns['length_of_stay'],
+            'age_sum': self.columns['age'],
+            'age_min': self.columns['age'],
+            'age_max': self.columns['age'],
+        }
+
+    # Stream the table in chunks so only the compact arrays stay resident
+    @classmethod
+    def load(cls, engine, version=None):
+        dictionaries = {dim: _Dictionary() for dim in DIMENSIONS}
+        started = time.perf_counter()
+        code_chunks, column_chunks, _ = _read_encoded(engine, None, dictionaries)
+        codes = {dim: _concat(code_chunks[dim], dictionaries[dim].dtype) for dim in DIMENSIONS}
+        columns = {column: _concat(column_chunks[column], dtype) for column, dtype in NUMERIC_COLUMNS.items()}
+        categories = {dim: dictionaries[dim].values for dim in DIMENSIONS}
+        table = cls(codes, categories, columns, version)
+        with query_section('local load'):
+            query_metrics.record(scan_sql(engine, LOAD_COLUMNS), source_label(engine), (time.perf_counter() - started) * 1000, rows=table.size)
+        return table
+
+    # New table with the rows appended since this one's version added, reading
+    # only those rows. None when the table changed in any other way and has to
+    # be reloaded. Both tables share the array buffers; this one only ever
+    # sees its first `size` rows, so it stays valid for readers still using it.
+    def extend(self, engine, version):
+        params = appended_range(self.version, version)
+        if params is None:
+            return None
+        dictionaries = {dim: _Dictionary(self.categories[dim]) for dim in DIMENSIONS}
+        started = time.perf_counter()
+        code_chunks, column_chunks, rows = _read_encoded(engine, params, dictionaries)
+        with query_section('local refresh'):
+            query_metrics.record(scan_sql(engine, LOAD_COLUMNS, appended=True), source_label(engine), (time.perf_counter() - started) * 1000, rows=rows)
+        if rows != version[0] - self.version[0]:
+            return None
+
+        size = self.size + rows
+        codes = {
+            dim: _append(self._code_buffers[dim], self.size, code_chunks[dim], dictionaries[dim].dtype)
+            for dim in DIMENSIONS
+        }
+        columns = {
+            column: _append(self._column_buffers[column], self.size, column_chunks[column], dtype)
+            for column, dtype in NUMERIC_COLUMNS.items()
+        }
+        categories = {dim: dictionaries[dim].values for dim in DIMENSIONS}
+        return ColumnarTable(codes, categories, columns, version, size)
+
+    def memory_bytes(self):
+        return sum(values.nbytes for values in self._code_buffers.values()) + sum(values.nbytes for values in self._column_buffers.values())
+
+    # Answer an AggregateQuery from the arrays; None when it needs other columns
+    def answer(self, spec):
+        columns = set(spec.group_by) | {column for column, _ in spec.filters}
+        if not columns <= set(DIMENSIONS) or columns & self.nullable:
+            return None
+        if any(metric not in ROLLUP_METRICS for _, metric in spec.metrics):
+            return None
+
+        mask = filter_mask(spec, self.codes, self.lookup, self.size)
+        if spec.age_range is not None:
+            age = self.columns['age']
+            mask &= (age >= spec.age_range[0]) & (age <= spec.age_range[1])
+        return rollup(spec, self.codes, self.categories, self.measures, mask)
+
+
+def _concat(chunks, dtype):
+    if not chunks:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(chunks).astype(dtype, copy=False)
+
+
+# Write chunks after the first `size` entries of a buffer, growing it
+# geometrically (or widening its dtype) only when it has to be copied anyway
+def _append(buffer, size, chunks, dtype):
+    values = _concat(chunks, dtype)
+    needed = size + len(values)
+    if needed > len(buffer) or buffer.dtype != dtype:
+        grown = np.empty(max(needed, 2 * len(buffer)) if needed > len(buffer) else len(buffer), dtype=dtype)
+        grown[:size] = buffer[:size]
+        buffer = grown
+    buffer[size:needed] = values
+    return buffer
+
+
+# Shared table for every session in the process, reloaded when the table version moves
+_table = None
+_table_lock = threading.Lock()
+
+
+def get_table(engine):
+    global _table
+    version = query_cache.check_version(engine)
+    with _table_lock:
+        if _table is not None and _table.version != version and INCREMENTAL_REFRESH:
+            _table = _table.extend(engine, version)
+        if _table is None or _table.version != version:
+            _table = ColumnarTable.load(engine, version)
+        return _table
+
+
+def refresh_table(engine):
+    global _table
+    with _table_lock:
+        _table = ColumnarTable.load(engine, query_cache.check_version(engine, force=True))
+        return _table
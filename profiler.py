@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from data_sources import column_kinds, read_chunks, scan_sql, source_label
+from db import create_db_engine
+from query_cache import INCREMENTAL_REFRESH, appended_range, query_cache
+from query_metrics import query_metrics, query_section
+from settings import getenv
+from sketches import FrequentItems, HyperLogLog, hash_values
+
+# One-pass column profile of the patients table.
+# A single streamed SELECT * feeds per-column accumulators (nulls, min/max,
+# sum for the mean, a HyperLogLog for cardinality and a frequent-items
+# summary for top values). The finished profile is a versioned snapshot:
+# kept in memory for every session, written to PROFILE_SNAPSHOT_PATH so a
+# restart does not rescan, and extended by scanning only appended rows.
+# The version only notices inserts and deletes, so a saved snapshot is reused
+# for at most PROFILE_SNAPSHOT_MAX_AGE seconds to bound how long in-place
+# updates can go unseen.
+#
+#   python profiler.py            build the profile and write the snapshot
+#   python profiler.py --show     print the profile
+
+PROFILE_CHUNK_ROWS = int(getenv('PROFILE_CHUNK_ROWS', '200000'))
+SNAPSHOT_PATH = getenv('PROFILE_SNAPSHOT_PATH', '.profile_snapshot.json')
+SNAPSHOT_MAX_AGE = float(getenv('PROFILE_SNAPSHOT_MAX_AGE', '86400'))
+# Distinct values are counted exactly up to this many per column, then estimated
+EXACT_DISTINCT_LIMIT = int(getenv('PROFILE_EXACT_DISTINCT', '100000'))
+TOP_VALUES = 10
+
+
+# Running statistics for one column; merge() combines two disjoint row ranges
+class ColumnStats:
+    def __init__(self, kind):
+        self.kind = kind
+        self.rows = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.hll = HyperLogLog()
+        self.frequent = FrequentItems(EXACT_DISTINCT_LIMIT)
+
+    # Values are normalized per kind so hashes and counts agree across chunks
+    def _normalize(self, series):
+        if self.kind == 'numeric':
+            return pd.to_numeric(series, errors='coerce').astype('float64')
+        if self.kind == 'date':
+            return pd.to_datetime(series, errors='coerce')
+        return series.astype('object').where(series.notna(), None)
+
+    def add(self, series):
+        values = self._normalize(series)
+        present = values.dropna()
+        self.rows += len(values)
+        self.nulls += len(values) - len(present)
+        if len(present) == 0:
+            return
+        if self.kind in ('numeric', 'date'):
+            low, high = present.min(), present.max()
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+        if self.kind == 'numeric':
+            self.sum += float(present.sum())
+        hashes = hash_values(present)
+        self.hll.add_hashes(hashes)
+        self.frequent.add_hashes(hashes, present.to_numpy())
+
+    def merge(self, other):
+        merged = ColumnStats(self.kind)
+        merged.rows = self.rows + other.rows
+        merged.nulls = self.nulls + other.nulls
+        bounds = [value for value in (self.min, other.min) if value is not None]
+        merged.min = min(bounds) if bounds else None
+        bounds = [value for value in (self.max, other.max) if value is not None]
+        merged.max = max(bounds) if bounds else None
+        merged.sum = self.sum + other.sum
+        merged.hll = self.hll.merge(other.hll)
+        merged.frequent = self.frequent.merge(other.frequent)
+        return merged
+
+    def summary(self):
+        exact = self.frequent.exact
+        summary = {
+            'kind': self.kind,
+            'nulls': self.nulls,
+            'distinct': len(self.frequent) if exact else self.hll.estimate(),
+            'distinct_exact': exact,
+            'top': [[_json_value(value), count] for value, count in self.frequent.top(TOP_VALUES) if count > 1],
+            'top_exact': exact,
+        }
+        if self.kind in ('numeric', 'date'):
+            summary['min'] = _json_value(self.min)
+            summary['max'] = _json_value(self.max)
+        if self.kind == 'numeric':
+            present = self.rows - self.nulls
+            summary['mean'] = self.sum / present if present else None
+        return summary
+
+
+def _json_value(value):
+    if value is None:
+        return None
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    if isinstance(value, pd.Timestamp):
+        return value.date().isoformat() if value == value.normalize() else value.isoformat()
+    if isinstance(value, (np.integer, np.floating)):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _scan(engine, params, kinds):
+    stats = {column: ColumnStats(kind) for column, kind in kinds.items()}
+    for chunk in read_chunks(engine, list(kinds), params, PROFILE_CHUNK_ROWS):
+        for column in stats:
+            stats[column].add(chunk[column])
+    return stats
+
+
+class DataProfile:
+    # stats holds the live accumulators; a profile loaded from a snapshot has
+    # only the summaries and cannot be extended
+    def __init__(self, summary, version=None, stats=None):
+        self.summary = summary
+        self.version = version
+        self.stats = stats
+
+    @classmethod
+    def from_stats(cls, stats, version, build_seconds):
+        rows = next(iter(stats.values())).rows if stats else 0
+        summary = {
+            'version': list(version) if version is not None else None,
+            'rows': rows,
+            'built_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'build_seconds': round(build_seconds, 3),
+            'columns': {column: column_stats.summary() for column, column_stats in stats.items()},
+        }
+        return cls(summary, version, stats)
+
+    @classmethod
+    def build(cls, engine, version=None):
+        kinds = column_kinds(engine)
+        started = time.perf_counter()
+        stats = _scan(engine, None, kinds)
+        elapsed = time.perf_counter() - started
+        with query_section('profile build'):
+            query_metrics.record(scan_sql(engine, list(kinds)), source_label(engine), elapsed * 1000, rows=next(iter(stats.values())).rows)
+        return cls.from_stats(stats, version, elapsed)
+
+    # New profile with the rows appended since this version merged in; None
+    # when this profile has no accumulators or the table changed otherwise
+    def extend(self, engine, version):
+        params = appended_range(self.version, version)
+        if params is None or self.stats is None:
+            return None
+        kinds = {column: column_stats.kind for column, column_stats in self.stats.items()}
+        started = time.perf_counter()
+        delta = _scan(engine, params, kinds)
+        elapsed = time.perf_counter() - started
+        rows = next(iter(delta.values())).rows
+        with query_section('profile refresh'):
+            query_metrics.record(scan_sql(engine, list(kinds), appended=True), source_label(engine), elapsed * 1000, rows=rows)
+        if rows != version[0] - self.version[0]:
+            return None
+        stats = {column: self.stats[column].merge(delta[column]) for column in self.stats}
+        return DataProfile.from_stats(stats, version, elapsed)
+
+    @property
+    def rows(self):
+        return self.summary['rows']
+
+    @property
+    def columns(self):
+        return self.summary['columns']
+
+    def column(self, name):
+        return self.summary['columns'].get(name)
+
+    # Share of non-null cells across the whole table
+    @property
+    def completeness(self):
+        cells = self.rows * len(self.columns)
+        if cells == 0:
+            return 1.0
+        return 1 - sum(column['nulls'] for column in self.columns.values()) / cells
+
+    def save(self, path=SNAPSHOT_PATH):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.summary, f, indent=2, default=str)
+        os.replace(temp_path, path)
+
+    # Snapshot from disk, or None when there is none for this table version
+    # or it was built more than max_age seconds ago
+    @classmethod
+    def load(cls, version, path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            summary = json.load(f)
+        if summary.get('version') != (list(version) if version is not None else None):
+            return None
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(summary['built_at'])
+        if age.total_seconds() > max_age:
+            return None
+        return cls(summary, version)
+
+
+# Shared profile for every session in the process, refreshed when the table version moves
+_profile = None
+_profile_lock = threading.Lock()
+
+
+def get_profile(engine):
+    global _profile
+    version = query_cache.check_version(engine)
+    with _profile_lock:
+        if _profile is not None and _profile.version != version and INCREMENTAL_REFRESH:
+            _profile = _profile.extend(engine, version)
+        if _profile is None or _profile.version != version:
+            _profile = DataProfile.load(version)
+        if _profile is None:
+            _profile = DataProfile.build(engine, version)
+            if SNAPSHOT_PATH:
+                _profile.save()
+        return _profile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Profile every column of the patients table in one pass.")
+    parser.add_argument('--show', action='store_true', help="print the profile as JSON")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    profile = DataProfile.build(engine, query_cache.check_version(engine, force=True))
+    if SNAPSHOT_PATH:
+        profile.save()
+        print(f"Wrote {SNAPSHOT_PATH}")
+    print(f"Profiled {profile.rows:,} rows x {len(profile.columns)} columns in {profile.summary['build_seconds']:.1f}s")
+    if args.show:
+        print(json.dumps(profile.summary, indent=2, default=str))
@@ -0,0 +1,239 @@
+from dataclasses import dataclass
+from itertools import product
+
+# Low-cardinality columns the analysis tabs group and filter by
+DIMENSIONS = ['gender', 'blood_type', 'medical_condition', 'insurance_provider', 'admission_type', 'medication', 'test_results']
+
+# Filter widgets: column -> (label, "all" option, values). The dashboard
+# lists the values found in the data; these are the Kaggle dataset's values,
+# used when that lookup fails and for offline checks such as cube.py --verify.
+FILTER_OPTIONS = {
+    'medical_condition': ('Medical Condition', 'All Conditions', ['Cancer', 'Diabetes', 'Obesity', 'Asthma', 'Hypertension', 'Arthritis']),
+    'insurance_provider': ('Insurance Provider', 'All Providers', ['Medicare', 'Blue Cross', 'Cigna', 'Aetna', 'UnitedHealthcare']),
+    'admission_type': ('Admission Type', 'All Types', ['Emergency', 'Elective', 'Urgent']),
+    'gender': ('Gender', 'All', ['Male', 'Female']),
+}
+
+# Bounds of the Medical Conditions age slider
+AGE_RANGE = (13, 89)
+
+# Columns the record explorer can sort by, with their labels; each is
+# indexed together with patient_id so keyset pages are index seeks
+RECORD_SORT_COLUMNS = {
+    'patient_id': 'Patient ID',
+    'date_of_admission': 'Date of Admission',
+    'discharge_date': 'Discharge Date',
+    'billing_amount': 'Billing Amount',
+    'age': 'Age',
+}
+
+# Length of stay: per-row date arithmetic, or the stored generated column
+# added by `db_schema.py length-of-stay` when the table has it
+STAY_SQL = 'DATEDIFF(discharge_date, date_of_admission)'
+STAY_COLUMN = 'length_of_stay'
+
+# Aggregate expressions by metric name; {stay} is the length of stay expression
+METRICS = {
+    'count': 'COUNT(*)',
+    'avg_billing': 'ROUND(AVG(billing_amount), 2)',
+    'avg_stay': 'ROUND(AVG({stay}))',
+    'min_age': 'MIN(age)',
+    'max_age': 'MAX(age)',
+    'avg_age': 'AVG(age)',
+}
+
+# Table columns each metric reads
+METRIC_COLUMNS = {
+    'count': (),
+    'avg_billing': ('billing_amount',),
+    'avg_stay': ('date_of_admission', 'discharge_date'),
+    'min_age': ('age',),
+    'max_age': ('age',),
+    'avg_age': ('age',),
+}
+
+
+# Result dtype per metric: counts fit in int32 and ages in int16, the rounded
+# average stay in float32; money and AVG(age) keep float64
+METRIC_DTYPES = {
+    'count': 'int32',
+    'avg_billing': 'float64',
+    'avg_stay': 'float32',
+    'min_age': 'int16',
+    'max_age': 'int16',
+    'avg_age': 'float64',
+}
+
+
+# Equality filters plus an optional inclusive age range, rendered as a SQL
+# template with bound parameters. The statement text only depends on which
+# columns are filtered, never on the selected values.
+@dataclass(frozen=True)
+class FilterSpec:
+    filters: tuple = ()
+    age_range: tuple = None
+
+    def where_sql(self):
+        clauses = ['1=1']
+        for column, _ in self.filters:
+            clauses.append(f"{column} = :{column}")
+        if self.age_range is not None:
+            clauses.append("age >= :age_min AND age <= :age_max")
+        return 'WHERE ' + ' AND '.join(clauses)
+
+    def params(self):
+        params = dict(self.filters)
+        if self.age_range is not None:
+            params['age_min'] = int(self.age_range[0])
+            params['age_max'] = int(self.age_range[1])
+        return params
+
+
+# One aggregate query behind a chart or table.
+# metrics are (output column, metric name) pairs, filters are (column, value)
+# equality pairs, age_range is inclusive and order_by holds (column, descending) pairs.
+@dataclass(frozen=True)
+class AggregateQuery:
+    group_by: tuple = ()
+    metrics: tuple = ()
+    filters: tuple = ()
+    age_range: tuple = None
+    order_by: tuple = ()
+
+    @property
+    def filter_spec(self):
+        return FilterSpec(self.filters, self.age_range)
+
+    def params(self):
+        return self.filter_spec.params()
+
+    # Result dtypes for db.apply_schema: grouped columns become categoricals
+    def schema(self):
+        return {column: 'category' for column in self.group_by} | {alias: METRIC_DTYPES[metric] for alias, metric in self.metrics}
+
+    def to_sql(self, stay=STAY_SQL):
+        select = list(self.group_by) + [f"{METRICS[metric].format(stay=stay)} as {alias}" for alias, metric in self.metrics]
+        sql = f"SELECT {', '.join(select)} FROM patients {self.filter_spec.where_sql()}"
+        if self.group_by:
+            sql += f" GROUP BY {', '.join(self.group_by)}"
+        if self.order_by:
+            sql += " ORDER BY " + ', '.join(f"{column} DESC" if desc else column for column, desc in self.order_by)
+        return sql
+
+
+# Pack queries that share grouping and filters into one statement each.
+# Returns (query, member names) pairs; a lone member keeps its own query.
+def merge_queries(specs):
+    batches = []
+    for name, spec in specs.items():
+        key = (spec.group_by, spec.filters, spec.age_range)
+        for batch in batches:
+            if batch['key'] == key and all(batch['metrics'].get(alias, metric) == metric for alias, metric in spec.metrics):
+                batch['metrics'].update(spec.metrics)
+                batch['names'].append(name)
+                break
+        else:
+            batches.append({'key': key, 'metrics': dict(spec.metrics), 'names': [name]})
+
+    merged = []
+    for batch in batches:
+        names = batch['names']
+        if len(names) == 1:
+            merged.append((specs[names[0]], names))
+        else:
+            group_by, filters, age_range = batch['key']
+            merged.append((AggregateQuery(group_by, tuple(batch['metrics'].items()), filters, age_range), names))
+    return merged
+
+
+# Cut one query's columns and ordering out of a merged result
+def split_result(spec, df):
+    df = df[list(spec.group_by) + [alias for alias, _ in spec.metrics]]
+    if spec.order_by:
+        df = df.sort_values(
+            [column for column, _ in spec.order_by],
+            ascending=[not desc for _, desc in spec.order_by],
+            kind='stable',
+        )
+    return df.reset_index(drop=True)
+
+
+# Filters offered by each analysis tab, in the order they are applied
+TAB_FILTERS = {
+    'demographics': ('medical_condition', 'insurance_provider', 'admission_type'),
+    'medical_conditions': ('insurance_provider', 'gender', 'admission_type'),
+    'insurance': ('medical_condition', 'gender', 'admission_type'),
+    'admission_type': ('medical_condition', 'insurance_provider', 'gender'),
+    'medication': ('medical_condition', 'insurance_provider', 'gender'),
+    'trends': ('medical_condition', 'insurance_provider', 'admission_type', 'gender'),
+}
+
+# Queries behind each tab: name -> (group_by, metrics, order_by)
+TAB_QUERIES = {
+    'demographics': {
+        'age_stats': ((), (('min_age', 'min_age'), ('max_age', 'max_age'), ('avg_age', 'avg_age')), ()),
+        'gender': (('gender',), (('count', 'count'),), ()),
+        'blood_type': (('blood_type',), (('count', 'count'),), (('count', True),)),
+        'billing': (('gender',), (('avg_billing', 'avg_billing'),), ()),
+    },
+    'medical_conditions': {
+        'billing': (('medical_condition',), (('avg_billing', 'avg_billing'), ('patient_count', 'count')), (('avg_billing', True),)),
+        'stay': (('medical_condition',), (('avg_stay', 'avg_stay'), ('patient_count', 'count')), (('avg_stay', True),)),
+        'test_results': (('medical_condition', 'test_results'), (('count', 'count'),), (('medical_condition', False), ('test_results', False))),
+    },
+    'insurance': {
+        'count': (('insurance_provider',), (('patient_count', 'count'),), (('patient_count', True),)),
+        'billing': (('insurance_provider',), (('avg_billing', 'avg_billing'),), (('avg_billing', True),)),
+        'stay': (('insurance_provider',), (('avg_stay', 'avg_stay'),), (('avg_stay', True),)),
+    },
+    'admission_type': {
+        'count': (('admission_type',), (('count', 'count'),), (('count', True),)),
+        'billing': (('admission_type',), (('avg_billing', 'avg_billing'),), (('avg_billing', True),)),
+        'stay': (('admission_type',), (('avg_stay', 'avg_stay'),), (('avg_stay', True),)),
+    },
+    'medication': {
+        'count': (('medication',), (('count', 'count'),), (('count', True),)),
+        'billing': (('medication',), (('avg_billing', 'avg_billing'),), (('avg_billing', True),)),
+        'stay': (('medication',), (('avg_stay', 'avg_stay'),), (('avg_stay', True),)),
+    },
+}
+
+
+# Admission trend granularities: grain -> column holding each admission's
+# bucket (the date itself, or the Monday / first of the month it falls in)
+TREND_GRAINS = {'day': 'date_of_admission', 'week': 'admission_week', 'month': 'admission_month'}
+TREND_METRICS = (('admissions', 'count'), ('avg_billing', 'avg_billing'), ('avg_stay', 'avg_stay'))
+
+
+# Drop filters left on their "all" option
+def active_filters(selection):
+    return {column: value for column, value in selection.items() if value != FILTER_OPTIONS[column][1]}
+
+
+def tab_queries(tab, filters=None, age_range=None):
+    filters = filters or {}
+    applied = tuple((column, filters[column]) for column in TAB_FILTERS[tab] if column in filters)
+    return {
+        name: AggregateQuery(group_by, metrics, applied, age_range, order_by)
+        for name, (group_by, metrics, order_by) in TAB_QUERIES[tab].items()
+    }
+
+
+# Admissions, average billing and average stay per date bucket, oldest first.
+# Only the daily query is plain SQL; trends.py answers every grain.
+def trend_query(grain, filters=None):
+    filters = filters or {}
+    applied = tuple((column, filters[column]) for column in TAB_FILTERS['trends'] if column in filters)
+    column = TREND_GRAINS[grain]
+    return AggregateQuery((column,), TREND_METRICS, applied, None, ((column, False),))
+
+
+# Every filter selection a tab can produce, including the "all" options.
+# values maps a column to the values to offer, such as those found in the
+# data; columns not in it use the known values.
+def filter_combinations(tab, values=None):
+    values = values or {}
+    columns = TAB_FILTERS[tab]
+    choices = [[None] + list(values.get(column, FILTER_OPTIONS[column][2])) for column in columns]
+    for selection in product(*choices):
+        yield {column: value for column, value in zip(columns, selection) if value is not None}
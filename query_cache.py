@@ -0,0 +1,165 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from settings import getenv
+
+# Shared, process-wide result cache for dashboard queries.
+# Entries are keyed by normalized SQL plus bound parameters, expire after a TTL,
+# are evicted least-recently-used once the memory cap is reached, and are all
+# dropped as soon as the patients table version changes.
+
+# Cheap probe used to detect inserts/deletes on the patients table
+VERSION_QUERY = "SELECT COUNT(*) AS row_count, MAX(patient_id) AS max_id FROM patients"
+
+_LITERAL = re.compile(r"('(?:[^'\\]|\\.|'')*')")
+
+
+def normalize_sql(query):
+    # Collapse whitespace outside string literals and drop a trailing semicolon
+    parts = _LITERAL.split(query.strip().rstrip(';'))
+    for idx in range(0, len(parts), 2):
+        parts[idx] = re.sub(r'\s+', ' ', parts[idx])
+    return ''.join(parts).strip()
+
+
+def frame_size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def get_table_version(engine):
+    # Snapshot sources (data_sources.ParquetSource) know their version without a query
+    if hasattr(engine, 'table_version'):
+        return engine.table_version()
+    with engine.connect() as conn:
+        row = conn.exec_driver_sql(VERSION_QUERY).fetchone()
+    return tuple(row)
+
+
+# Fold rows appended since the last version into the in-memory aggregates
+# instead of rebuilding them from the whole table
+INCREMENTAL_REFRESH = getenv('INCREMENTAL_REFRESH', 'true').lower() in ('1', 'true', 'yes')
+
+# Rows between two patient_id watermarks, bound as :low and :high
+APPENDED_ROWS = "patient_id > :low AND patient_id <= :high"
+
+
+# Watermark parameters for the rows added between two table versions, or None
+# when the change cannot be a pure append (rows deleted, or no new ids). The
+# caller still checks that the rows it reads account for the new row count,
+# since updates and deletes hidden behind inserts are not visible here.
+def appended_range(old, new):
+    if old is None or new is None:
+        return None
+    (old_count, old_max), (new_count, new_max) = old, new
+    if new_count <= old_count or new_max is None or (old_max is not None and new_max <= old_max):
+        return None
+    return {'low': old_max or 0, 'high': new_max}
+
+
+class QueryCache:
+    def __init__(self, ttl_seconds=300, max_bytes=64 * 1024 * 1024, version_check_seconds=30):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.version_check_seconds = version_check_seconds
+        self.disabled = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._version_checked_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl_seconds=float(getenv('QUERY_CACHE_TTL', '300')),
+            max_bytes=int(float(getenv('QUERY_CACHE_MAX_MB', '64')) * 1024 * 1024),
+            version_check_seconds=float(getenv('QUERY_CACHE_VERSION_CHECK', '30')),
+        )
+
+    @property
+    def enabled(self):
+        return not self.disabled and self.ttl_seconds > 0 and self.max_bytes > 0
+
+    # Stop caching results, for tools that never ask the same query twice
+    def disable(self):
+        self.disabled = True
+        self.invalidate()
+
+    def make_key(self, query, params=None, schema=None):
+        return normalize_sql(query), tuple(sorted((params or {}).items())), tuple(sorted((schema or {}).items()))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, df = entry
+            if expires_at <= time.monotonic():
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return df
+
+    def put(self, key, df):
+        if not self.enabled:
+            return
+        size = frame_size(df)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size, df)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # Re-probe the table version at most once per interval (or right away when
+    # forced) and drop every entry when it has moved
+    def check_version(self, engine, force=False):
+        now = time.monotonic()
+        with self._lock:
+            checked_at = self._version_checked_at
+            if not force and checked_at is not None and now - checked_at < self.version_check_seconds:
+                return self._version
+            self._version_checked_at = now
+        version = get_table_version(engine)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._bytes = 0
+                self._version = version
+        return version
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'version': self._version,
+            }
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+# Module-level instance so every Streamlit session in the process shares it
+query_cache = QueryCache.from_env()
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+
+from settings import getenv
+
+# Per-query instrumentation for the dashboard.
+# Every query records wall time split into database time (execute + fetch)
+# and DataFrame construction time, its row count, where the result came from
+# and the dashboard section that asked for it. Recent records feed the
+# in-app Performance panel; totals per section are exported in the
+# Prometheus text format, and each record can be appended to a JSON lines log.
+
+# Dashboard section/chart the current queries belong to; worker threads
+# inherit it because db.run_parallel runs each task in a copy of the context
+_section = ContextVar('query_section', default=None)
+
+
+@contextmanager
+def query_section(name):
+    # Nested sections build a path such as "demographics/age_stats"
+    parent = _section.get()
+    token = _section.set(name if parent is None else f"{parent}/{name}")
+    try:
+        yield
+    finally:
+        _section.reset(token)
+
+
+def current_section():
+    return _section.get() or 'unlabelled'
+
+
+# source is 'database', 'cache' or the in-memory backend that answered
+@dataclass(frozen=True)
+class QueryRecord:
+    section: str
+    sql: str
+    source: str
+    wall_ms: float
+    db_ms: float = 0.0
+    frame_ms: float = 0.0
+    rows: int = 0
+    error: str = None
+    at: float = 0.0
+
+
+# Upper bounds (ms) of the Prometheus latency histogram buckets
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class _SectionTotals:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wall_ms = 0.0
+        self.db_ms = 0.0
+        self.frame_ms = 0.0
+        self.rows = 0
+        self.sources = {}
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, record):
+        self.count += 1
+        self.errors += record.error is not None
+        self.wall_ms += record.wall_ms
+        self.db_ms += record.db_ms
+        self.frame_ms += record.frame_ms
+        self.rows += record.rows
+        self.sources[record.source] = self.sources.get(record.source, 0) + 1
+        for idx, bound in enumerate(LATENCY_BUCKETS):
+            if record.wall_ms <= bound:
+                self.buckets[idx] += 1
+
+
+class QueryMetrics:
+    def __init__(self, history=1000, log_path=None, prometheus_path=None, prometheus_interval=15):
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.prometheus_interval = prometheus_interval
+        self._recent = deque(maxlen=history)
+        self._totals = {}
+        self._written_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            history=int(getenv('QUERY_METRICS_HISTORY', '1000')),
+            log_path=getenv('QUERY_METRICS_LOG') or None,
+            prometheus_path=getenv('QUERY_METRICS_PROMETHEUS_FILE') or None,
+            prometheus_interval=float(getenv('QUERY_METRICS_PROMETHEUS_INTERVAL', '15')),
+        )
+
+    def record(self, sql, source, wall_ms, db_ms=0.0, frame_ms=0.0, rows=0, error=None, section=None):
+        record = QueryRecord(section or current_section(), sql, source, wall_ms, db_ms, frame_ms, rows, error, time.time())
+        with self._lock:
+            self._recent.append(record)
+            self._totals.setdefault(record.section, _SectionTotals()).add(record)
+            write_prometheus = self.prometheus_path is not None and (
+                self._written_at is None or time.monotonic() - self._written_at >= self.prometheus_interval
+            )
+            if write_prometheus:
+                self._written_at = time.monotonic()
+        if self.log_path:
+            self._append_log(record)
+        if write_prometheus:
+            self.write_prometheus()
+        return record
+
+    def _append_log(self, record):
+        line = json.dumps(asdict(record)) + '\n'
+        with self._lock:
+            with open(self.log_path, 'a') as f:
+                f.write(line)
+
+    def recent(self, limit=None):
+        with self._lock:
+            records = list(self._recent)
+        return records if limit is None else records[-limit:]
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                section: {**vars(t), 'sources': dict(t.sources), 'buckets': list(t.buckets)}
+                for section, t in self._totals.items()
+            }
+
+    # Totals per section as plain dicts, slowest total wall time first
+    def sections(self):
+        summary = []
+        for section, t in self._snapshot().items():
+            summary.append({
+                'section': section,
+                'queries': t['count'],
+                'errors': t['errors'],
+                'cache_hits': t['sources'].get('cache', 0),
+                'cache_misses': t['sources'].get('database', 0),
+                'wall_ms': t['wall_ms'],
+                'db_ms': t['db_ms'],
+                'frame_ms': t['frame_ms'],
+                'avg_ms': t['wall_ms'] / t['count'],
+                'rows': t['rows'],
+            })
+        return sorted(summary, key=lambda row: row['wall_ms'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+            self._totals.clear()
+
+    def prometheus_text(self):
+        totals = self._snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                rendered = ','.join(f'{key}="{_label(str(val))}"' for key, val in labels.items())
+                lines.append(f'{name}{{{rendered}}} {value}')
+
+        metric('dashboard_queries_total', 'counter', 'Queries issued by the dashboard by result source.', [
+            ({'section': section, 'source': source}, count)
+            for section, t in totals.items() for source, count in t['sources'].items()
+        ])
+        metric('dashboard_query_errors_total', 'counter', 'Queries that raised.', [
+            ({'section': section}, t['errors']) for section, t in totals.items()
+        ])
+        metric('dashboard_query_db_seconds_total', 'counter', 'Time spent executing and fetching in the database.', [
+            ({'section': section}, f"{t['db_ms'] / 1000:.6f}") for section, t in totals.items()
+        ])
+        metric('dashboard_query_frame_seconds_total', 'counter', 'Time spent building DataFrames from fetched rows.', [
+            ({'section': section}, f"{t['frame_ms'] / 1000:.6f}") for section, t in totals.items()
+        ])
+        metric('dashboard_query_rows_total', 'counter', 'Rows returned.', [
+            ({'section': section}, t['rows']) for section, t in totals.items()
+        ])
+
+        lines.append('# HELP dashboard_query_seconds Wall time per query.')
+        lines.append('# TYPE dashboard_query_seconds histogram')
+        for section, t in totals.items():
+            label = _label(section)
+            for bound, bucket in zip(LATENCY_BUCKETS, t['buckets']):
+                lines.append(f'dashboard_query_seconds_bucket{{section="{label}",le="{bound / 1000:g}"}} {bucket}')
+            lines.append(f'dashboard_query_seconds_bucket{{section="{label}",le="+Inf"}} {t["count"]}')
+            lines.append(f'dashboard_query_seconds_sum{{section="{label}"}} {t["wall_ms"] / 1000:.6f}')
+            lines.append(f'dashboard_query_seconds_count{{section="{label}"}} {t["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    # Replace the file atomically so a scraper never reads a partial write
+    def write_prometheus(self, path=None):
+        path = path or self.prometheus_path
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Shared metrics for every session in the process
+query_metrics = QueryMetrics.from_env()
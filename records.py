@@ -0,0 +1,118 @@
+import time
+
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from analytics import run_query
+from data_sources import all_of, is_snapshot, spec_filter
+from db import apply_schema, read_sql
+from db_schema import COLUMNS, TABLE
+from queries import RECORD_SORT_COLUMNS, AggregateQuery
+from query_metrics import query_metrics
+from settings import getenv
+
+# Page-at-a-time reads of individual patient rows for the record explorer.
+# Pages use keyset pagination: instead of OFFSET, which makes the database
+# walk and discard every row before the page, each page starts after the
+# (sort value, patient_id) of the previous page's last row. With an index on
+# (sort column, patient_id) that is a seek plus page_rows index steps, so the
+# last page costs the same as the first. patient_id breaks ties, which keeps
+# the order total and no row is skipped or repeated between pages.
+
+PAGE_ROWS = int(getenv('RECORD_PAGE_ROWS', '50'))
+
+RECORD_COLUMNS = tuple(COLUMNS)
+
+# Repeated labels as categories, small integers narrowed; names, dates and
+# billing keep their natural types
+RECORD_SCHEMA = {
+    'age': 'int16',
+    'gender': 'category',
+    'blood_type': 'category',
+    'medical_condition': 'category',
+    'insurance_provider': 'category',
+    'billing_amount': 'float64',
+    'room_number': 'int16',
+    'admission_type': 'category',
+    'medication': 'category',
+    'test_results': 'category',
+}
+
+
+def _check_sort(sort):
+    if sort not in RECORD_SORT_COLUMNS:
+        raise ValueError(f"Cannot sort records by {sort!r}; choose one of {', '.join(RECORD_SORT_COLUMNS)}")
+
+
+# SELECT for one page. after is the (sort value, patient_id) cursor of the
+# previous page's last row, or None for the first page. The row comparison is
+# spelled out because MySQL only uses a range scan for the expanded form.
+def page_sql(filter_spec, sort='patient_id', descending=False, after=None):
+    _check_sort(sort)
+    op, direction = ('<', ' DESC') if descending else ('>', '')
+    where = filter_spec.where_sql()
+    if after is not None:
+        if sort == 'patient_id':
+            where += f" AND patient_id {op} :after_id"
+        else:
+            where += f" AND ({sort} {op} :after_value OR ({sort} = :after_value AND patient_id {op} :after_id))"
+    order = f"patient_id{direction}" if sort == 'patient_id' else f"{sort}{direction}, patient_id{direction}"
+    return f"SELECT {', '.join(RECORD_COLUMNS)} FROM {TABLE} {where} ORDER BY {order} LIMIT :limit"
+
+
+def _scalar(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+# Keyset condition as an Arrow expression for the snapshot
+def _keyset_filter(sort, descending, after):
+    if after is None:
+        return None
+    value, patient_id = after
+    after_id = (ds.field('patient_id') < patient_id) if descending else (ds.field('patient_id') > patient_id)
+    if sort == 'patient_id':
+        return after_id
+    field = ds.field(sort)
+    return ((field < value) if descending else (field > value)) | ((field == value) & after_id)
+
+
+# One page from the snapshot: a filtered scan, then the top page_rows by the
+# sort key without sorting everything that matched
+def _read_snapshot_page(source, filter_spec, sort, descending, after, limit):
+    started = time.perf_counter()
+    table = source.to_table(list(RECORD_COLUMNS), all_of(spec_filter(filter_spec), _keyset_filter(sort, descending, after)))
+    order = 'descending' if descending else 'ascending'
+    keys = [(sort, order)] if sort == 'patient_id' else [(sort, order), ('patient_id', order)]
+    indices = pc.select_k_unstable(table, k=min(limit, table.num_rows), sort_keys=keys) if table.num_rows else []
+    page = table.take(indices).sort_by(keys)
+    df = apply_schema(page.to_pandas(), RECORD_SCHEMA)
+    query_metrics.record(page_sql(filter_spec, sort, descending, after), 'parquet', (time.perf_counter() - started) * 1000, rows=len(df))
+    return df
+
+
+# The page after the cursor and the cursor for the page that follows it,
+# None when this is the last page. One extra row is fetched to tell.
+def read_page(source, filter_spec, sort='patient_id', descending=False, after=None, page_rows=PAGE_ROWS):
+    _check_sort(sort)
+    limit = page_rows + 1
+    if is_snapshot(source):
+        df = _read_snapshot_page(source, filter_spec, sort, descending, after, limit)
+    else:
+        params = filter_spec.params()
+        params['limit'] = limit
+        if after is not None:
+            params['after_value'], params['after_id'] = after
+        df = read_sql(source, page_sql(filter_spec, sort, descending, after), params, schema=RECORD_SCHEMA)
+
+    if len(df) <= page_rows:
+        return df.reset_index(drop=True), None
+    page = df.iloc[:page_rows].reset_index(drop=True)
+    last = page.iloc[-1]
+    return page, (_scalar(last[sort]), int(last['patient_id']))
+
+
+# Rows matching the filters, answered like any other aggregate
+def count_records(source, filter_spec):
+    spec = AggregateQuery((), (('count', 'count'),), filter_spec.filters, filter_spec.age_range)
+    df = run_query(source, spec)
+    return int(df['count'].iloc[0]) if len(df) else 0
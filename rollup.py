@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+# Vectorized filter/group-by/aggregate over dictionary-encoded columns.
+# Shared by the aggregate cube (one row per cell, weighted by its count) and
+# the local columnar engine (one row per patient).
+
+# Metrics rollup() can compute
+ROLLUP_METRICS = {'count', 'avg_billing', 'avg_stay', 'avg_age', 'min_age', 'max_age'}
+
+
+# ROUND() half away from zero, for estimates that are floating point to begin
+# with; exact averages go through sql_average()
+def sql_round(values, decimals=0):
+    factor = 10.0 ** decimals
+    return np.sign(values) * np.floor(np.abs(values) * factor + 0.5) / factor
+
+
+# (summed measure, decimal places of the averaged column, ROUND() decimals)
+# per average; avg_age is not rounded in SQL
+AVERAGES = {
+    'avg_billing': ('billing_sum', 2, 2),
+    'avg_stay': ('stay_sum', 0, 0),
+    'avg_age': ('age_sum', 0, None),
+}
+
+
+# Values of a column with `places` decimals as whole units of its last place
+# (cents for billing), so that sums of them are exact
+def scaled(values, places):
+    return np.rint(np.asarray(values, dtype=float) * 10 ** places)
+
+
+# numerator / denominator rounded half away from zero, on object arrays of
+# Python ints so that large totals stay exact
+def _round_div(numerator, denominator):
+    magnitude = np.abs(numerator)
+    rounded = magnitude // denominator + (2 * (magnitude % denominator) >= denominator).astype(np.int64)
+    return np.where(numerator < 0, -rounded, rounded)
+
+
+# An average as MySQL returns it, from exact totals in units of the column's
+# last decimal place (see scaled()) and row counts; NaN for empty groups.
+# AVG() keeps 4 more decimals than the column, and ROUND() takes that half
+# away from zero.
+def sql_average(metric, total, count):
+    _, places, decimals = AVERAGES[metric]
+    count = np.asarray(count, dtype=float)
+    empty = count <= 0
+    count = np.where(empty, 1, np.rint(count)).astype(np.int64).astype(object)
+    total = np.rint(np.asarray(total, dtype=float)).astype(np.int64).astype(object)
+    rounded = _round_div(total * 10 ** 4, count)
+    if decimals is None:
+        decimals = places + 4
+    else:
+        rounded = _round_div(rounded * 10 ** decimals, 10 ** (places + 4))
+    return np.where(empty, np.nan, (rounded / 10 ** decimals).astype(float))
+
+
+def _group_extreme(values, groups, size, ufunc, start):
+    if size == 1:
+        out = np.array([ufunc.reduce(values) if len(values) else start], dtype=float)
+    else:
+        out = np.full(size, start, dtype=float)
+        ufunc.at(out, groups, values)
+    return np.where(np.isinf(out), np.nan, out)
+
+
+def _metric_values(metric, measure, groups, size, count):
+    if metric == 'count':
+        return count.astype(np.int64)
+    if metric in AVERAGES:
+        column, places, _ = AVERAGES[metric]
+        return sql_average(metric, np.bincount(groups, scaled(measure(column), places), size), count)
+    if metric == 'min_age':
+        return _group_extreme(measure('age_min'), groups, size, np.minimum, np.inf)
+    if metric == 'max_age':
+        return _group_extreme(measure('age_max'), groups, size, np.maximum, -np.inf)
+    raise ValueError(f"Unsupported metric: {metric}")
+
+
+# Boolean row mask for the equality filters of a spec
+def filter_mask(spec, codes, lookup, size):
+    mask = np.ones(size, dtype=bool)
+    for column, value in spec.filters:
+        code = lookup[column].get(value)
+        if code is None:
+            mask[:] = False
+        else:
+            mask &= codes[column] == code
+    return mask
+
+
+# Dense group id for each selected row over the category codes, so no sort
+# is needed, and the number of possible ids
+def group_keys(spec, codes, categories, rows, selected_rows):
+    if not spec.group_by:
+        return np.zeros(selected_rows, dtype=np.intp), 1
+    key = None
+    size = 1
+    for column in spec.group_by:
+        radix = len(categories[column])
+        part = codes[column][rows].astype(np.intp)
+        key = part if key is None else key * radix + part
+        size *= radix
+    return key, size
+
+
+# Group-by column values for an array of group ids
+def group_labels(spec, categories, keys):
+    labels = {}
+    for column in reversed(spec.group_by):
+        radix = len(categories[column])
+        labels[column] = np.asarray(categories[column], dtype=object)[keys % radix]
+        keys = keys // radix
+    return labels
+
+
+def sort_result(spec, df):
+    if spec.order_by:
+        df = df.sort_values(
+            [column for column, _ in spec.order_by],
+            ascending=[not desc for _, desc in spec.order_by],
+            kind='stable',
+        ).reset_index(drop=True)
+    return df
+
+
+# Aggregate the masked rows of a table for an AggregateQuery.
+# measures maps measure names to per-row arrays; 'n' holds row weights and
+# defaults to one per row.
+def rollup(spec, codes, categories, measures, mask):
+    # Skip the gather entirely when nothing is filtered out
+    rows = slice(None) if mask.all() else np.flatnonzero(mask)
+    selected_rows = len(mask) if isinstance(rows, slice) else len(rows)
+    key, size = group_keys(spec, codes, categories, rows, selected_rows)
+
+    weights = measures.get('n')
+    count = np.bincount(key, weights=None if weights is None else weights[rows], minlength=size)
+
+    selected = {}
+
+    def measure(name):
+        if name not in selected:
+            selected[name] = measures[name][rows]
+        return selected[name]
+
+    out = {}
+    for alias, metric in spec.metrics:
+        out[alias] = _metric_values(metric, measure, key, size, count)
+
+    if spec.group_by:
+        present = np.flatnonzero(count > 0)
+        for alias in out:
+            out[alias] = out[alias][present]
+        out.update(group_labels(spec, categories, present))
+
+    df = pd.DataFrame({column: out[column] for column in list(spec.group_by) + [alias for alias, _ in spec.metrics]})
+    return sort_result(spec, df)
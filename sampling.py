@@ -0,0 +1,400 @@
+import argparse
+import contextvars
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from analytics import run_queries
+from data_sources import appended_filter, group_rows, is_snapshot, scan_sql
+from db import create_db_engine, read_sql, stay_sql
+from dictionaries import get_dictionaries
+from queries import AGE_RANGE, DIMENSIONS, STAY_COLUMN, TAB_FILTERS, TAB_QUERIES, filter_combinations, tab_queries
+from query_cache import APPENDED_ROWS, INCREMENTAL_REFRESH, appended_range, query_cache
+from query_metrics import query_metrics, query_section
+from rollup import ROLLUP_METRICS, filter_mask, group_keys, group_labels, sort_result, sql_round
+from settings import getenv
+
+# Approximate answers for the analysis tabs from a stratified sample.
+# Rows are sampled by a hash of patient_id, so the same rows are picked on
+# every build and appended rows can be sampled without rereading the table.
+# Strata are the columns the tabs filter on; each stratum's exact size comes
+# from a GROUP BY over them, and small strata are sampled at a higher rate
+# so every filter combination keeps enough rows. Estimates are post-stratified
+# and carry 95% confidence intervals; exact answers are computed in the
+# background and replace them as soon as they are ready.
+
+APPROXIMATE_QUERIES = getenv('APPROXIMATE_QUERIES', 'false').lower() in ('1', 'true', 'yes')
+SAMPLE_ROWS = int(getenv('SAMPLE_ROWS', '100000'))
+SAMPLE_MIN_STRATUM_ROWS = int(getenv('SAMPLE_MIN_STRATUM_ROWS', '50'))
+REFINE_WORKERS = int(getenv('REFINE_WORKERS', '2'))
+# How often the dashboard checks whether background exact answers are ready
+REFINE_POLL_SECONDS = float(getenv('REFINE_POLL_SECONDS', '1'))
+
+# Every column a tab filter can select, so a filter keeps or drops whole strata
+STRATA = tuple(column for column in DIMENSIONS if any(column in filters for filters in TAB_FILTERS.values()))
+
+# Multiplicative hash of patient_id into [0, 2**32); a row is sampled when its
+# hash is below its stratum's threshold
+HASH_RANGE = 2 ** 32
+HASH_MULTIPLIER = 2654435761
+SAMPLE_HASH = f"(patient_id * {HASH_MULTIPLIER}) % {HASH_RANGE}"
+
+# Two-sided 95% normal quantile
+Z_95 = 1.96
+
+# Metrics estimated with a confidence interval; min/max are the sample's own
+ESTIMATED_METRICS = {'count', 'avg_billing', 'avg_stay', 'avg_age'}
+METRIC_VALUES = {'avg_billing': 'billing_amount', 'avg_stay': 'length_of_stay', 'avg_age': 'age'}
+
+
+# Sample rows below a hash threshold, optionally limited to the appended
+# patient_id range. With boosted strata the threshold is the largest boosted
+# one, and rows above the base threshold are only read from the listed strata.
+def sample_sql(stay, boosted=0, appended=False):
+    where = [f"{SAMPLE_HASH} < :threshold"]
+    if boosted:
+        strata = ', '.join(f"({', '.join(f':{column}_{i}' for column in STRATA)})" for i in range(boosted))
+        where.append(f"({SAMPLE_HASH} < :base OR ({', '.join(STRATA)}) IN ({strata}))")
+    if appended:
+        where.append(APPENDED_ROWS)
+    return (
+        f"SELECT {', '.join(DIMENSIONS)}, age, billing_amount, {stay} AS length_of_stay, {SAMPLE_HASH} AS sample_hash "
+        f"FROM patients WHERE {' AND '.join(where)}"
+    )
+
+
+# Sampled rows, with their sample_hash, in one scan: each row is kept when its
+# hash is below its stratum's threshold, base unless the stratum is boosted.
+# A snapshot has no SQL to evaluate SAMPLE_HASH, so patient_id is hashed the
+# same way in NumPy after the appended filter is pushed down to the scan.
+def _read_sample(engine, base, boosted=None, appended=None):
+    boosted = boosted or {}
+    threshold = max([base, *boosted.values()])
+    if not is_snapshot(engine):
+        sql = sample_sql(stay_sql(engine), len(boosted), appended is not None)
+        params = {'threshold': threshold, 'base': base, **(appended or {})}
+        for i, stratum in enumerate(boosted):
+            params.update({f"{column}_{i}": value for column, value in zip(STRATA, stratum)})
+        frame = read_sql(engine, sql, params, cache=None)
+    else:
+        columns = [*DIMENSIONS, 'age', 'billing_amount', STAY_COLUMN, 'patient_id']
+        started = time.perf_counter()
+        table = engine.to_table(columns, appended_filter(appended))
+        sample_hash = table['patient_id'].to_numpy().astype(np.int64) * HASH_MULTIPLIER % HASH_RANGE
+        sampled = sample_hash < threshold
+        frame = table.filter(sampled).drop_columns(['patient_id']).to_pandas().assign(sample_hash=sample_hash[sampled])
+        query_metrics.record(scan_sql(engine, columns, appended is not None), 'parquet', (time.perf_counter() - started) * 1000, rows=len(frame))
+    if not boosted:
+        return frame
+    keep = pd.to_numeric(frame['sample_hash']).to_numpy() < _thresholds(frame, base, boosted)
+    return frame[keep].reset_index(drop=True)
+
+
+# Row counts per stratum, keyed by stratum value tuples; appended restricts
+# the count to the rows added since the sample's version
+def _population(engine, appended=None):
+    cells = group_rows(engine, STRATA, {'n': ('COUNT', '*')}, appended)
+    return cells.assign(n=pd.to_numeric(cells['n']).astype('int64')).groupby(list(STRATA), dropna=False)['n'].sum()
+
+
+def _thresholds(frame, base, boosted):
+    thresholds = np.full(len(frame), base, dtype=np.int64)
+    for stratum, threshold in boosted.items():
+        thresholds[(frame[list(STRATA)] == stratum).all(axis=1).to_numpy()] = threshold
+    return thresholds
+
+
+class StratifiedSample:
+    # frame holds the sampled rows and strata the row count of every stratum;
+    # base is the hash threshold of every stratum not in boosted, which maps
+    # stratum value tuples to their own threshold
+    def __init__(self, frame, dictionaries, strata, base, boosted, version=None):
+        self.version = version
+        self.frame = frame
+        self.dictionaries = dictionaries
+        self.strata = strata
+        self.base = base
+        self.boosted = boosted
+        self.size = len(frame)
+
+        self.categories = {dim: dictionaries.values(dim) for dim in DIMENSIONS}
+        self.lookup = {dim: {value: code for code, value in enumerate(values)} for dim, values in self.categories.items()}
+        self.codes = {dim: pd.Categorical(frame[dim], categories=self.categories[dim]).codes.astype(np.int64) for dim in DIMENSIONS}
+        self.nullable = {dim for dim, codes in self.codes.items() if (codes < 0).any()}
+        self.values = {column: pd.to_numeric(frame[column]).astype(float).to_numpy() for column in ('age', 'billing_amount', 'length_of_stay')}
+
+        # Stratum id per sampled row and per population cell; NULL gets its own slot
+        self.strata_size = int(np.prod([len(self.categories[column]) + 1 for column in STRATA]))
+        self.stratum = self._stratum_ids(self.codes)
+        population = strata.reset_index()
+        cell_codes = {
+            column: pd.Categorical(population[column], categories=self.categories[column]).codes.astype(np.int64)
+            for column in STRATA
+        }
+        self.population = np.bincount(self._stratum_ids(cell_codes), weights=population['n'].to_numpy(dtype=float), minlength=self.strata_size)
+        self.sampled = np.bincount(self.stratum, minlength=self.strata_size).astype(float)
+
+    def _stratum_ids(self, codes):
+        ids = np.zeros(len(codes[STRATA[0]]), dtype=np.intp)
+        for column in STRATA:
+            radix = len(self.categories[column]) + 1
+            ids = ids * radix + np.where(codes[column] < 0, radix - 1, codes[column])
+        return ids
+
+    @classmethod
+    def build(cls, engine, version=None):
+        dictionaries = get_dictionaries(engine)
+        with query_section('sample build'):
+            population = _population(engine)
+        rows = int(population.sum())
+        rate = min(1.0, SAMPLE_ROWS / rows) if rows else 1.0
+        base = int(rate * HASH_RANGE)
+        # Strata the base rate would leave with too few rows get a rate of their own
+        boosted = {}
+        for stratum, size in population.items():
+            threshold = int(min(1.0, SAMPLE_MIN_STRATUM_ROWS / size) * HASH_RANGE)
+            if threshold > base and not any(pd.isna(value) for value in stratum):
+                boosted[stratum] = threshold
+
+        with query_section('sample build'):
+            frame = _read_sample(engine, base, boosted)
+        return cls(frame, dictionaries, population, base, boosted, dictionaries.version if version is None else version)
+
+    # New sample with the appended rows that fall under their stratum's
+    # threshold added; None when the table changed in any other way, or once
+    # the sample has grown to twice SAMPLE_ROWS and its rates are rebalanced
+    def extend(self, engine, version):
+        dictionaries = get_dictionaries(engine)
+        params = appended_range(self.version, dictionaries.version)
+        if params is None or dictionaries.version != version:
+            return None
+        with query_section('sample refresh'):
+            added = _population(engine, params)
+            delta = _read_sample(engine, self.base, self.boosted, appended=params)
+        frame = pd.concat([self.frame, delta], ignore_index=True)
+        if len(frame) > 2 * SAMPLE_ROWS or int(added.sum()) != version[0] - self.version[0]:
+            return None
+        strata = pd.concat([self.strata, added]).groupby(level=list(range(len(STRATA))), dropna=False).sum()
+        return StratifiedSample(frame, dictionaries, strata, self.base, self.boosted, version)
+
+    # Estimate an AggregateQuery with a {alias}_ci column (95% half-width)
+    # after each estimated metric; None when the sample cannot answer it
+    def answer(self, spec):
+        columns = set(spec.group_by) | {column for column, _ in spec.filters}
+        if not columns <= set(DIMENSIONS) or columns & self.nullable:
+            return None
+        if any(metric not in ROLLUP_METRICS for _, metric in spec.metrics):
+            return None
+
+        mask = filter_mask(spec, self.codes, self.lookup, self.size)
+        if spec.age_range is not None:
+            age = self.values['age']
+            mask &= (age >= spec.age_range[0]) & (age <= spec.age_range[1])
+        rows = np.flatnonzero(mask)
+        key, size = group_keys(spec, self.codes, self.categories, rows, len(rows))
+
+        # Per (stratum, group) sums over the selected rows; rows outside the
+        # selection still count towards their stratum's sample size
+        cell = self.stratum[rows] * size + key
+        cells = self.strata_size * size
+
+        def sums(values=None):
+            return np.bincount(cell, weights=values, minlength=cells).reshape(self.strata_size, size)
+
+        sampled = self.sampled[:, None]
+        population = self.population[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(sampled > 0, population / np.where(sampled > 0, sampled, 1), 0.0)
+            # Stratified variance factor N_h^2 (1 - n_h/N_h) / n_h, over n_h - 1 for the sample variance
+            factor = np.where(sampled > 1, population ** 2 * (1 - sampled / np.where(population > 0, population, 1)) / sampled / np.maximum(sampled - 1, 1), 0.0)
+
+        counts = sums()
+        count = (weight * counts).sum(axis=0)
+        present = np.flatnonzero(counts.sum(axis=0) > 0)
+
+        out = {}
+        for alias, metric in spec.metrics:
+            if metric == 'count':
+                variance = (factor * (counts - counts ** 2 / np.maximum(sampled, 1))).sum(axis=0)
+                out[alias] = np.rint(count).astype(np.int64)
+                out[f"{alias}_ci"] = Z_95 * np.sqrt(np.maximum(variance, 0))
+            elif metric in METRIC_VALUES:
+                values = self.values[METRIC_VALUES[metric]][rows]
+                total, squares = sums(values), sums(values ** 2)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = (weight * total).sum(axis=0) / count
+                    # Linearized ratio estimator: residuals y - mean within the group
+                    residual = total - mean * counts
+                    residual_squares = squares - 2 * mean * total + mean ** 2 * counts
+                    variance = (factor * (residual_squares - residual ** 2 / np.maximum(sampled, 1))).sum(axis=0) / count ** 2
+                out[alias] = sql_round(mean, 2 if metric == 'avg_billing' else 4 if metric == 'avg_age' else 0)
+                out[f"{alias}_ci"] = Z_95 * np.sqrt(np.maximum(variance, 0))
+            else:
+                ufunc, start = (np.minimum, np.inf) if metric == 'min_age' else (np.maximum, -np.inf)
+                extreme = np.full(size, start)
+                ufunc.at(extreme, key, self.values['age'][rows])
+                out[alias] = extreme
+
+        for alias in out:
+            out[alias] = out[alias][present]
+        if spec.group_by:
+            out.update(group_labels(spec, self.categories, present))
+        ordered = list(spec.group_by)
+        for alias, metric in spec.metrics:
+            ordered.append(alias)
+            if metric in ESTIMATED_METRICS:
+                ordered.append(f"{alias}_ci")
+        return sort_result(spec, pd.DataFrame({column: out[column] for column in ordered}))
+
+
+# Shared sample for every session in the process, refreshed when the table version moves
+_sample = None
+_sample_lock = threading.Lock()
+
+
+def get_sample(engine):
+    global _sample
+    version = query_cache.check_version(engine)
+    with _sample_lock:
+        if _sample is not None and _sample.version != version and INCREMENTAL_REFRESH:
+            _sample = _sample.extend(engine, version)
+        if _sample is None or _sample.version != version:
+            _sample = StratifiedSample.build(engine, version)
+        return _sample
+
+
+# Answer from the sample, recorded as 'sample'; queries it cannot estimate
+# run exactly. Returns the results and the names that were estimated.
+def sample_queries(engine, specs):
+    sample = get_sample(engine)
+    results = {}
+    for name, spec in specs.items():
+        with query_section(name):
+            started = time.perf_counter()
+            df = sample.answer(spec)
+            if df is not None:
+                query_metrics.record(spec.to_sql(), 'sample', (time.perf_counter() - started) * 1000, rows=len(df))
+                results[name] = df
+    exact = {name: spec for name, spec in specs.items() if name not in results}
+    results.update(run_queries(engine, exact) if exact else {})
+    return {name: results[name] for name in specs}, set(specs) - set(exact)
+
+
+# Exact answers computed in the background, keyed by (table version, query).
+# A failed refinement keeps its exception so it is not retried for that version.
+REFINED_RESULTS = 256
+_refine_executor = ThreadPoolExecutor(max_workers=REFINE_WORKERS, thread_name_prefix='refine')
+_refined = OrderedDict()
+_refining = {}
+_refine_lock = threading.Lock()
+
+
+def _refine(engine, version, specs):
+    try:
+        results = run_queries(engine, specs)
+    except Exception as e:
+        results = dict.fromkeys(specs, e)
+    with _refine_lock:
+        for name, spec in specs.items():
+            _refined[(version, spec)] = results[name]
+            _refined.move_to_end((version, spec))
+            _refining.pop((version, spec), None)
+        while len(_refined) > REFINED_RESULTS:
+            _refined.popitem(last=False)
+
+
+# Exact results where a refinement has finished, sample estimates (with _ci
+# columns) for the rest, and background refinement started for those.
+# Returns the results, the names still approximate and whether any of
+# them is still being refined.
+def approximate_queries(engine, specs):
+    version = query_cache.check_version(engine)
+    results = {}
+    with _refine_lock:
+        for name, spec in specs.items():
+            refined = _refined.get((version, spec))
+            if isinstance(refined, pd.DataFrame):
+                _refined.move_to_end((version, spec))
+                results[name] = refined
+    pending = {name: spec for name, spec in specs.items() if name not in results}
+    if not pending:
+        return results, set(), False
+
+    estimates, approximate = sample_queries(engine, pending)
+    results.update(estimates)
+    refine = {}
+    with _refine_lock:
+        for name in approximate:
+            key = (version, specs[name])
+            if key not in _refined and key not in _refining:
+                _refining[key] = True
+                refine[name] = specs[name]
+        refining = any((version, specs[name]) in _refining for name in approximate)
+    if refine:
+        _refine_executor.submit(contextvars.copy_context().run, _refine, engine, version, refine)
+    return {name: results[name] for name in specs}, approximate, refining
+
+
+# Whether any of these queries is still being refined
+def refinement_pending(engine, specs):
+    version = query_cache.check_version(engine)
+    with _refine_lock:
+        return any((version, spec) in _refining for spec in specs.values())
+
+
+# Compare every tab query's estimates with SQL: how often the 95% interval
+# covers the exact value, and the largest relative error of each metric
+def verify(engine, sample=None):
+    sample = sample or StratifiedSample.build(engine)
+    covered = checked = 0
+    errors = {}
+    for tab in TAB_QUERIES:
+        age_range = AGE_RANGE if tab == 'medical_conditions' else None
+        for filters in filter_combinations(tab):
+            for spec in tab_queries(tab, filters, age_range).values():
+                estimate = sample.answer(spec)
+                if estimate is None:
+                    continue
+                expected = read_sql(engine, spec.to_sql(stay_sql(engine)), spec.params(), cache=None, metrics=None)
+                if spec.group_by:
+                    estimate = estimate.set_index(list(spec.group_by))
+                    expected = expected.set_index(list(spec.group_by))
+                for alias, metric in spec.metrics:
+                    if metric not in ESTIMATED_METRICS:
+                        continue
+                    exact = pd.to_numeric(expected[alias]).astype(float)
+                    approx = estimate[alias].reindex(exact.index).astype(float)
+                    ci = estimate[f"{alias}_ci"].reindex(exact.index).astype(float)
+                    # Values are rounded like SQL's, so allow the rounding step
+                    step = 0.005 if metric == 'avg_billing' else 0.5 if metric == 'avg_stay' else 0.5e-4
+                    covered += int(((approx - exact).abs() <= ci + step).sum())
+                    checked += len(exact)
+                    relative = ((approx - exact).abs() / exact.abs()).max()
+                    errors[metric] = max(errors.get(metric, 0.0), float(relative))
+    return checked, covered, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the stratified sample and optionally check its estimates against SQL.")
+    parser.add_argument('--verify', action='store_true', help="compare every tab query and filter combination with SQL")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    started = time.perf_counter()
+    sample = StratifiedSample.build(engine)
+    print(f"Sampled {sample.size:,} of {int(sample.population.sum()):,} rows over {int((sample.population > 0).sum())} strata in {time.perf_counter() - started:.1f}s")
+    if args.verify:
+        checked, covered, errors = verify(engine, sample)
+        print(f"95% intervals covered {covered:,} of {checked:,} exact values ({covered / max(checked, 1):.1%})")
+        for metric, error in errors.items():
+            print(f"  {metric}: largest relative error {error:.2%}")
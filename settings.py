@@ -0,0 +1,18 @@
+import os
+
+from dotenv import load_dotenv
+
+# Every documented setting is read through getenv, which loads .env the
+# first time any setting is read. Modules that read their settings on import
+# therefore see .env whichever module or entry point is imported first.
+# Variables already set in the process environment take precedence over .env.
+
+_loaded = False
+
+
+def getenv(name, default=None):
+    global _loaded
+    if not _loaded:
+        load_dotenv()
+        _loaded = True
+    return os.getenv(name, default)
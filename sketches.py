@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+
+# Mergeable streaming summaries, fed one chunk (a pandas Series) at a time.
+# Every kind can be combined across chunks or across separately scanned
+# row ranges, so a summary is extended by scanning only the new rows.
+
+
+# 64-bit hashes of a Series' values; equal values hash equally across chunks
+# as long as every chunk has the same dtype
+def hash_values(series):
+    return pd.util.hash_pandas_object(series, index=False).to_numpy()
+
+
+# Number of leading zero bits in left-aligned 64-bit values, capped at width.
+# The top 53 bits convert to float64 exactly, and frexp gives their bit length.
+def _leading_zeros(values, width):
+    _, bit_length = np.frexp((values >> np.uint64(11)).astype(np.float64))
+    return np.minimum(53 - bit_length, width)
+
+
+# HyperLogLog distinct-count estimator: 2**precision one-byte registers,
+# about 1.04 / sqrt(2**precision) relative error (0.8% at the default 14)
+class HyperLogLog:
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    def add(self, series):
+        self.add_hashes(hash_values(series.dropna()))
+
+    def add_hashes(self, hashes):
+        if len(hashes) == 0:
+            return
+        width = 64 - self.precision
+        index = (hashes >> np.uint64(width)).astype(np.intp)
+        rank = (_leading_zeros(hashes << np.uint64(self.precision), width) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # Linear counting is more accurate while many registers are still empty
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+
+# Misra-Gries frequent items over value counts, holding at most `capacity`
+# counters. Counts stay exact until more than `capacity` distinct values have
+# been seen; after that each count is an underestimate by at most `error`,
+# and every value occurring more than error times is still tracked. With
+# weights (e.g. billing amounts) the counters hold weight totals instead; the
+# bounds only hold for non-negative weights, so negative ones are refused.
+# Misra-Gries is used rather than Space-Saving, which has the same bounds,
+# because two summaries merge into one with the same guarantees.
+# Counters are keyed by value hash, so combining chunks is a sort of uint64s
+# rather than an index alignment over the values themselves.
+class FrequentItems:
+    def __init__(self, capacity=1000, keys=None, counts=None, values=None, error=0):
+        self.capacity = capacity
+        self.keys = np.empty(0, dtype=np.uint64) if keys is None else keys
+        self.counts = np.empty(0, dtype=np.int64) if counts is None else counts
+        self.values = values
+        self.error = error
+
+    @property
+    def exact(self):
+        return self.error == 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, series, weights=None):
+        present = series.notna().to_numpy()
+        series = series[present]
+        self.add_hashes(hash_values(series), series.to_numpy(), None if weights is None else np.asarray(weights, dtype=float)[present])
+
+    # hashes must come from hash_values() over the same rows as values, an
+    # array that keeps one dtype from chunk to chunk
+    def add_hashes(self, hashes, values, weights=None):
+        if weights is not None and (weights < 0).any():
+            raise ValueError("FrequentItems weights must not be negative")
+        if weights is None:
+            keys, first, counts = np.unique(hashes, return_index=True, return_counts=True)
+        else:
+            keys, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+            counts = np.bincount(inverse, weights=weights, minlength=len(keys))
+        self._combine(keys, counts, values[first])
+
+    def _combine(self, keys, counts, values):
+        keys = np.concatenate([self.keys, keys])
+        counts = np.concatenate([self.counts, counts])
+        values = values if self.values is None else np.concatenate([self.values, values])
+        keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(counts.dtype)
+        values = values[first]
+        error = self.error
+        if len(keys) > self.capacity:
+            threshold = np.partition(counts, -(self.capacity + 1))[-(self.capacity + 1)].item()
+            keep = counts > threshold
+            keys, counts, values = keys[keep], counts[keep] - threshold, values[keep]
+            error += threshold
+        self.keys, self.counts, self.values, self.error = keys, counts, values, error
+
+    def merge(self, other):
+        merged = FrequentItems(self.capacity, self.keys, self.counts, self.values, self.error + other.error)
+        merged._combine(other.keys, other.counts, other.values)
+        return merged
+
+    # The k most frequent values as (value, count) pairs, most frequent first
+    def top(self, k=10):
+        order = np.argsort(-self.counts, kind='stable')[:k]
+        return [(self.values[idx], self.counts[idx].item()) for idx in order]
+
+
+# Count-Min sketch: `depth` rows of `width` counters, each row indexed by a
+# different slice of the value hash. A point estimate is the smallest of a
+# value's counters, never below the true total and above it by at most
+# e / width of the grand total with probability 1 - exp(-depth). Merging is
+# adding the tables, so it answers for any value, tracked or not, in fixed
+# memory. With weights the counters hold weight totals.
+class CountMinSketch:
+    def __init__(self, width=2048, depth=4, table=None):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.float64) if table is None else table
+
+    # One column index per row: the low and high 32 bits of the hash combined
+    # as h1 + i * h2, the usual way to derive several hash functions from one
+    def _columns(self, hashes):
+        low = hashes & np.uint64(0xFFFFFFFF)
+        high = hashes >> np.uint64(32)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((low[None, :] + rows * high[None, :]) % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, series, weights=None):
+        present = series.notna().to_numpy()
+        self.add_hashes(hash_values(series[present]), None if weights is None else np.asarray(weights, dtype=float)[present])
+
+    def add_hashes(self, hashes, weights=None):
+        if len(hashes) == 0:
+            return
+        weights = np.ones(len(hashes)) if weights is None else weights
+        for row, columns in enumerate(self._columns(hashes)):
+            self.table[row] += np.bincount(columns, weights=weights, minlength=self.width)
+
+    def merge(self, other):
+        return CountMinSketch(self.width, self.depth, self.table + other.table)
+
+    # Estimated totals for an array of hashes
+    def estimate_hashes(self, hashes):
+        columns = self._columns(np.asarray(hashes, dtype=np.uint64))
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def estimate(self, series):
+        return self.estimate_hashes(hash_values(series))
@@ -0,0 +1,48 @@
+import os
+import sys
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import generate_chunk, load_patients  # noqa: E402
+from db import create_db_engine  # noqa: E402
+from db_schema import TABLE  # noqa: E402
+
+ROWS = 2000
+
+# Pairs of patients whose billing averages exactly half a cent, each alone in
+# its medication group and on its admission day: (gender, day, amounts).
+# Built-in SQLite adds the doubles and rounds both toward zero; MySQL rounds
+# them away from zero.
+HALF_CENT_PAIRS = [
+    ('Male', date(2024, 6, 3), (640.66, -581.01)),
+    ('Female', date(2024, 6, 4), (-1902.06, 1733.99)),
+]
+
+
+# Mean of a pair rounded to the cent half away from zero, as MySQL returns it
+def mysql_average(amounts):
+    cents = round(sum(amounts) * 100)
+    return (abs(cents) + 1) // 2 * (1 if cents > 0 else -1) / 100
+
+
+def half_cent_rows():
+    rows = generate_chunk(np.random.default_rng(1), ROWS + 1, 2 * len(HALF_CENT_PAIRS), ROWS)
+    rows['gender'] = [gender for gender, _, amounts in HALF_CENT_PAIRS for _ in amounts]
+    rows['date_of_admission'] = [day for _, day, amounts in HALF_CENT_PAIRS for _ in amounts]
+    rows['discharge_date'] = rows['date_of_admission'] + timedelta(days=3)
+    rows['billing_amount'] = [amount for _, _, amounts in HALF_CENT_PAIRS for amount in amounts]
+    rows['medication'] = 'Insulin'
+    return rows
+
+
+# Generated patients plus the half-cent pairs in a throwaway SQLite database
+@pytest.fixture(scope='session')
+def engine(tmp_path_factory):
+    engine = create_db_engine(f"sqlite:///{tmp_path_factory.mktemp('db') / 'patients.db'}")
+    load_patients(engine, ROWS)
+    half_cent_rows().to_sql(TABLE, engine, if_exists='append', index=False)
+    return engine
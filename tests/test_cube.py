@@ -0,0 +1,20 @@
+from conftest import HALF_CENT_PAIRS, mysql_average
+from cube import AggregateCube, verify
+from db import read_sql, stay_sql
+from queries import tab_queries
+
+
+def test_every_tab_query_matches_sql(engine):
+    checked, mismatches = verify(engine)
+    assert checked > 0
+    assert mismatches == []
+
+
+def test_half_cent_average_rounds_like_mysql(engine):
+    cube = AggregateCube.build(engine)
+    for gender, _, amounts in HALF_CENT_PAIRS:
+        spec = tab_queries('medication', {'gender': gender})['billing']
+        expected = read_sql(engine, spec.to_sql(stay_sql(engine)), spec.params(), cache=None, metrics=None)
+        actual = cube.answer(spec)
+        for df in (expected, actual):
+            assert df.loc[df['medication'] == 'Insulin', 'avg_billing'].tolist() == [mysql_average(amounts)]
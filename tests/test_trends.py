@@ -0,0 +1,24 @@
+import pandas as pd
+
+from conftest import HALF_CENT_PAIRS, mysql_average
+from db import read_sql, stay_sql
+from queries import trend_query
+from trends import CalendarRollup, verify
+
+
+def test_daily_trend_matches_sql(engine):
+    checked, mismatches = verify(engine)
+    assert checked > 0
+    assert mismatches == []
+
+
+def test_negative_half_cent_average_rounds_like_mysql(engine):
+    trends = CalendarRollup.build(engine)
+    spec = trend_query('day')
+    expected = read_sql(engine, spec.to_sql(stay_sql(engine)), spec.params(), cache=None, metrics=None)
+    expected['date_of_admission'] = pd.to_datetime(expected['date_of_admission'])
+    actual = trends.answer(spec)
+    for _, day, amounts in HALF_CENT_PAIRS:
+        for df in (expected, actual):
+            assert df.loc[df['date_of_admission'] == pd.Timestamp(day), 'avg_billing'].tolist() == [mysql_average(amounts)]
+    assert (actual['avg_billing'] < 0).any()
@@ -0,0 +1,179 @@
+import argparse
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from cube import frames_match
+from data_sources import group_rows
+from db import create_db_engine, read_sql, stay_sql
+from queries import TAB_FILTERS, TREND_GRAINS, filter_combinations, trend_query
+from query_cache import INCREMENTAL_REFRESH, appended_range, query_cache
+from query_metrics import query_metrics, query_section
+from rollup import filter_mask, rollup
+
+# Calendar rollup behind the admission trends.
+# One GROUP BY scan of patients keeps counts and sums per admission day and
+# combination of the trend filters. Each cell also carries its week and
+# month bucket, so a trend at any grain is the same vectorized roll-up of
+# the cells, with no per-row date arithmetic; switching from days to months
+# costs a bincount over the cells. Appended admissions are folded in by
+# scanning only the new rows, as for the aggregate cube.
+
+TREND_DIMENSIONS = list(TAB_FILTERS['trends'])
+
+# (aggregate, column) per measure, as data_sources.group_rows takes them
+MEASURES = {
+    'n': ('COUNT', '*'),
+    'billing_sum': ('SUM', 'billing_amount'),
+    'stay_sum': ('SUM', '{stay}'),
+}
+
+CELL_KEYS = ['date_of_admission'] + TREND_DIMENSIONS
+
+
+# First day of each date's bucket; weeks start on Monday (1970-01-01 was a Thursday)
+def bucket_starts(days, grain):
+    if grain == 'week':
+        return days - (days.astype(np.int64) + 3) % 7
+    if grain == 'month':
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    return days
+
+
+# Cells with admission dates as datetime64[D] and float measures; cells
+# without a date are dropped, as they belong to no bucket
+def _cells(frame):
+    columns = {column: frame[column] for column in TREND_DIMENSIONS}
+    columns['date_of_admission'] = pd.to_datetime(frame['date_of_admission']).to_numpy(dtype='datetime64[D]')
+    for name in MEASURES:
+        columns[name] = pd.to_numeric(frame[name]).astype(float)
+    cells = pd.DataFrame(columns)
+    return cells[~np.isnat(cells['date_of_admission'].to_numpy(dtype='datetime64[D]'))].reset_index(drop=True)
+
+
+# Combine two sets of cells; the work is proportional to the number of cells
+def merge_cells(cells, delta):
+    combined = pd.concat([cells, _cells(delta)], ignore_index=True)
+    return combined.groupby(CELL_KEYS, dropna=False, sort=False).sum().reset_index()
+
+
+class CalendarRollup:
+    def __init__(self, cells, version=None):
+        self.version = version
+        self.cells = cells
+        self.size = len(cells)
+        self.categories = {}
+        self.codes = {}
+        self.lookup = {}
+        self.nullable = set()
+        for dim in TREND_DIMENSIONS:
+            values = pd.Categorical(cells[dim])
+            self.categories[dim] = values.categories
+            self.codes[dim] = values.codes.astype(np.int64)
+            self.lookup[dim] = {value: code for code, value in enumerate(values.categories)}
+            if (values.codes < 0).any():
+                self.nullable.add(dim)
+        days = cells['date_of_admission'].to_numpy(dtype='datetime64[D]')
+        for grain, column in TREND_GRAINS.items():
+            starts, codes = np.unique(bucket_starts(days, grain), return_inverse=True)
+            self.categories[column] = starts
+            self.codes[column] = codes.astype(np.int64)
+        self.measures = {name: cells[name].to_numpy() for name in MEASURES}
+
+    @classmethod
+    def build(cls, engine, version=None):
+        with query_section('trends build'):
+            return cls(_cells(group_rows(engine, CELL_KEYS, MEASURES)), version)
+
+    # New rollup with the rows appended since this one's version folded in;
+    # None when the table changed in any other way
+    def extend(self, engine, version):
+        params = appended_range(self.version, version)
+        if params is None:
+            return None
+        with query_section('trends refresh'):
+            delta = group_rows(engine, CELL_KEYS, MEASURES, params)
+        if int(pd.to_numeric(delta['n']).sum()) != version[0] - self.version[0]:
+            return None
+        return CalendarRollup(merge_cells(self.cells, delta), version)
+
+    # Roll the cells up for a trends.trend_query spec; None when it asks for
+    # something the rollup does not hold
+    def answer(self, spec):
+        columns = set(spec.group_by) | {column for column, _ in spec.filters}
+        if not columns <= set(self.codes) or columns & self.nullable or spec.age_range is not None:
+            return None
+        df = rollup(spec, self.codes, self.categories, self.measures, filter_mask(spec, self.codes, self.lookup, self.size))
+        for column in spec.group_by:
+            if column in TREND_GRAINS.values():
+                df[column] = pd.to_datetime(df[column])
+        return df
+
+
+# Shared rollup for every session in the process, rebuilt when the table version moves
+_trends = None
+_trends_lock = threading.Lock()
+
+
+def get_trends(engine):
+    global _trends
+    version = query_cache.check_version(engine)
+    with _trends_lock:
+        if _trends is not None and _trends.version != version and INCREMENTAL_REFRESH:
+            _trends = _trends.extend(engine, version)
+        if _trends is None or _trends.version != version:
+            _trends = CalendarRollup.build(engine, version)
+        return _trends
+
+
+# A trend from the shared rollup, recorded in query_metrics as a 'trends' answer
+def run_trend(engine, spec):
+    started = time.perf_counter()
+    df = get_trends(engine).answer(spec)
+    if df is None:
+        raise ValueError(f"The trends rollup cannot answer {spec}")
+    query_metrics.record(spec.to_sql(), 'trends', (time.perf_counter() - started) * 1000, rows=len(df))
+    return df
+
+
+# Check the daily trend against SQL for every filter combination
+def verify(engine, trends=None):
+    trends = trends or CalendarRollup.build(engine)
+    checked = 0
+    mismatches = []
+    for filters in filter_combinations('trends'):
+        spec = trend_query('day', filters)
+        expected = read_sql(engine, spec.to_sql(stay_sql(engine)), spec.params(), cache=None, metrics=None)
+        expected['date_of_admission'] = pd.to_datetime(expected['date_of_admission'])
+        actual = trends.answer(spec)
+        if actual is None or not frames_match(spec, expected, actual):
+            mismatches.append(filters)
+        checked += 1
+    return checked, mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the admission trends rollup and optionally verify it against SQL.")
+    parser.add_argument('--verify', action='store_true', help="compare the daily trend for every filter combination with SQL")
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_db_engine()
+    if engine is None:
+        sys.exit("Database credentials not found. Please set environment variables.")
+
+    started = time.perf_counter()
+    trends = CalendarRollup.build(engine)
+    days = trends.categories['date_of_admission']
+    print(f"Trends rollup built in {time.perf_counter() - started:.1f}s: {trends.size:,} cells, "
+          f"{len(days):,} days from {days[0]} to {days[-1]}" if len(days) else "Trends rollup is empty")
+    if args.verify:
+        checked, mismatches = verify(engine, trends)
+        for filters in mismatches:
+            print(f"MISMATCH {filters}")
+        print(f"{checked - len(mismatches)}/{checked} queries match")
+        sys.exit(1 if mismatches else 0)